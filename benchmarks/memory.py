@@ -0,0 +1,217 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Memory benchmarks of the playlist, tags and per-track caches
+
+Usage: python benchmarks/memory.py [size ...]
+
+Prints resident memory in megabytes taken by playlists of given sizes
+(100k and 500k entries by default) with tags of all tracks and the caches
+the player keeps for them: the tag cache, the file watcher, the sort keys
+of artist, album and title and the search index. Every structure is
+measured stored as before, keyed by uri strings ("dicts": a list of uris,
+a dict of occurence counts, dicts of tag dicts, cache entries, watched
+file names and collation keys and a search index of uris), and as it's
+stored now, in the TrackStore or in lists indexed by track ids. Every
+variant is measured in its own process, so freed memory doesn't affect the
+others.
+
+"""
+import locale
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from myplay.common import uri_to_path
+from myplay.playlist import Playlist
+from myplay.searchindex import SearchIndex, uri_tokens
+from myplay.sortkeys import SortKeyCache, collation_key
+from myplay.tagreader import TAGS
+from myplay.trackstore import TrackStore, TagMap
+
+SIZES = (100000, 500000)
+
+VARIANTS = ('dicts', 'trackstore')
+
+STAGES = ('playlist', 'tag cache', 'watcher', 'sort keys', 'search')
+
+SORT_KEYS = ('artist', 'album', 'title')
+
+TRACKS_PER_ALBUM = 12
+
+def make_tracks(size):
+    """Yield (uri, tags) of a collection sorted in artist/album directories
+
+    Strings are made separately for every track, like they are when loaded
+    from the journal and the tag cache.
+
+    """
+    for i in xrange(size):
+        album = i // TRACKS_PER_ALBUM
+        artist = album // 3
+        uri = 'file:///home/user/Music/Artist%%20%d/Album%%20%d/%02d%%20-%%20Track%%20%d.ogg' % (
+            artist, album, i % TRACKS_PER_ALBUM + 1, i)
+        tags = {
+            'title': 'Track %d' % i,
+            'artist': 'Artist %d' % artist,
+            'album': 'Album %d' % album,
+        }
+        yield uri, tags
+
+def file_stat(i):
+    return 1300000000.0 + i, 4000000 + i
+
+def rss():
+    """Return resident memory of this process in megabytes"""
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024
+
+class Dicts(object):
+    """Structures keyed by uri strings, as they were kept before TrackStore"""
+
+    def playlist(self, size):
+        self.uris = []
+        self.counts = {}
+        self.tags = {}
+        for uri, tag in make_tracks(size):
+            self.uris.append(uri)
+            self.counts[uri] = self.counts.get(uri, 0) + 1
+            self.tags[uri] = tag
+
+    def tag_cache(self, size):
+        # loaded from its own file, so uris and values are separate strings
+        self.entries = {}
+        for i, (uri, tag) in enumerate(make_tracks(size)):
+            mtime, file_size = file_stat(i)
+            self.entries[uri] = (mtime, file_size, tuple([tag.get(name) for name in TAGS]))
+
+    def watcher(self, size):
+        self.directories = {}
+        for uri in self.uris:
+            directory, name = os.path.split(uri_to_path(uri))
+            names = self.directories.get(directory)
+            if names is None:
+                names = self.directories[directory] = [None, {}]
+            names[1][name] = uri
+
+    def sort_keys(self, size):
+        self.sort_keys = {}
+        for key in SORT_KEYS:
+            keys = self.sort_keys[key] = {}
+            collated = {}
+            for uri in self.uris:
+                value = self.tags[uri].get(key) or ''
+                collation = collated.get(value)
+                if collation is None:
+                    collation = collated[value] = collation_key(value)
+                keys[uri] = collation
+
+    def search(self, size):
+        self.postings = {}
+        self.uri_words = {}
+        for uri in self.uris:
+            words = uri_tokens(uri, self.tags[uri])
+            for word in words:
+                posting = self.postings.get(word)
+                if posting is None:
+                    self.postings[word] = uri
+                elif isinstance(posting, set):
+                    posting.add(uri)
+                else:
+                    self.postings[word] = set((posting, uri))
+            self.uri_words[uri] = tuple(words)
+        self.words = sorted(self.postings)
+
+class Trackstore(object):
+    """Structures used now, keyed by TrackStore ids"""
+
+    def playlist(self, size):
+        self.store = TrackStore()
+        self.playlist = Playlist((), self.store)
+        tag_map = TagMap(self.store)
+        tracks = []
+        for track in make_tracks(size):
+            tracks.append(track)
+            if len(tracks) == 1000:
+                self._add(tracks, tag_map)
+                tracks = []
+        self._add(tracks, tag_map)
+
+    def _add(self, tracks, tag_map):
+        # only tracks in the playlist can have tags
+        self.playlist.insert(len(self.playlist), [uri for uri, tag in tracks])
+        for uri, tag in tracks:
+            tag_map[uri] = tag
+
+    def tag_cache(self, size):
+        for track_id in self.playlist.ids():
+            self.store.set_file_stat(track_id, file_stat(track_id))
+
+    def watcher(self, size):
+        # one entry per directory, files are listed by the store
+        self.directories = {}
+        for track_id in self.store.ids():
+            uri = self.store.uri(track_id)
+            prefix = uri[:uri.rfind('/') + 1]
+            if prefix not in self.directories:
+                self.directories[prefix] = (None, os.path.dirname(uri_to_path(uri)))
+
+    def sort_keys(self, size):
+        self.sort_keys = SortKeyCache(self.store)
+        self.sort_keys.sorted_positions(self.playlist, SORT_KEYS)
+
+    def search(self, size):
+        self.index = SearchIndex()
+        store = self.store
+        for track_id in store.ids():
+            self.index.update(track_id, store.uri(track_id), store.get_tags(track_id))
+
+def measure(variant, size):
+    data = globals()[variant.capitalize()]()
+    results = []
+    start = time.time()
+    for stage in STAGES:
+        before = rss()
+        getattr(data, stage.replace(' ', '_'))(size)
+        results.append('%.1f' % (rss() - before))
+    results.append('%.0f' % ((time.time() - start) * 1000))
+    print ' '.join(results)
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        locale.setlocale(locale.LC_COLLATE, 'C')
+        measure(sys.argv[2], int(sys.argv[3]))
+        return
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    columns = ('size', 'storage') + STAGES + ('total', 'build, ms')
+    row = '%-8s %-11s' + ' %10s' * (len(columns) - 2)
+    print 'RSS growth in MB per stage'
+    print row % columns
+    for size in sizes:
+        for variant in VARIANTS:
+            output = subprocess.Popen([sys.executable, __file__, '--measure', variant, str(size)],
+                                      stdout=subprocess.PIPE).communicate()[0]
+            values = output.split()
+            total = '%.1f' % sum(float(value) for value in values[:-1])
+            print row % ((size, variant) + tuple(values[:-1]) + (total, values[-1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Microbenchmarks of the playlist container
+
+Usage: python benchmarks/playlist.py [size ...]
+
+Prints time in milliseconds of common playlist operations for playlists
+of given sizes (10k, 100k and 1M entries by default). The "list" column
+is the plain list implementation used before the Playlist container.
+
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from myplay.playlist import Playlist
+from myplay.trackstore import TrackStore
+
+SIZES = (10000, 100000, 1000000)
+
+REMOVE_COUNT = 100
+INSERT_COUNT = 100
+
+def make_uris(size):
+    return ['file:///music/artist%d/album%d/track%d.ogg' % (i % 500, i % 50, i) for i in xrange(size)]
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return (time.time() - start) * 1000
+
+def list_remove(playlist, positions):
+    playlist[:] = [uri for i, uri in enumerate(playlist) if i not in positions]
+
+def list_insert(playlist, position, uris):
+    playlist[position:position] = uris
+
+def list_reorder(playlist, positions, current):
+    playlist[:] = [playlist[pos] for pos in positions]
+    return positions.index(current)
+
+def playlist_reorder(playlist, positions, current):
+    for i, pos in enumerate(positions):
+        if pos == current:
+            new_current = i
+    playlist.reorder(positions)
+    return new_current
+
+def list_positions(playlist, uri):
+    return [i for i, u in enumerate(playlist) if u == uri]
+
+def run(size):
+    uris = make_uris(size)
+    remove_positions = random.sample(xrange(size), REMOVE_COUNT)
+    insert_uris = make_uris(INSERT_COUNT)
+    permutation = range(size)
+    random.shuffle(permutation)
+    lookup = [uris[random.randrange(size)] for i in xrange(10)]
+
+    results = []
+
+    def bench(name, list_func, playlist_func):
+        results.append((name, timed(list_func), timed(playlist_func)))
+
+    l, p = list(uris), Playlist(uris)
+    bench('remove %d' % REMOVE_COUNT,
+          lambda: list_remove(l, remove_positions),
+          lambda: p.remove(remove_positions))
+    bench('insert %d at middle' % INSERT_COUNT,
+          lambda: list_insert(l, size // 2, insert_uris),
+          lambda: p.insert(size // 2, insert_uris))
+    store = TrackStore()
+    l, p = list(uris), Playlist(uris, store)
+    bench('reorder',
+          lambda: list_reorder(l, permutation, size - 1),
+          lambda: playlist_reorder(p, permutation, size - 1))
+    bench('contains x10',
+          lambda: [uri in l for uri in lookup],
+          lambda: [uri in p for uri in lookup])
+    bench('positions x10',
+          lambda: [list_positions(l, uri) for uri in lookup],
+          lambda: [p.ids_positions([store.id(uri)]) for uri in lookup])
+    return results
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print '%-10s %-22s %12s %12s' % ('size', 'operation', 'list, ms', 'Playlist, ms')
+    for size in sizes:
+        for name, list_time, playlist_time in run(size):
+            print '%-10d %-22s %12.2f %12.2f' % (size, name, list_time, playlist_time)
+
+if __name__ == '__main__':
+    main()
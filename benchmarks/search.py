@@ -0,0 +1,83 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmarks of the tag search index
+
+Usage: python benchmarks/search.py [size ...]
+
+Builds the search index for synthetic playlists of given sizes (10k and
+100k entries by default) and prints the build time, approximate memory used
+by the index and time of Find-like queries, including looking up positions
+of the matches in the playlist.
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from myplay.playlist import Playlist
+from myplay.searchindex import SearchIndex
+
+SIZES = (10000, 100000)
+
+QUERIES = ('artist17', 'album3 track', 'title 42', 'track4242', 'song of', 'a', 'nothing')
+
+FIND_LIMIT = 100
+
+REPEATS = 100
+
+def make_tracks(size):
+    tracks = []
+    for i in xrange(size):
+        uri = 'file:///music/artist%d/album%d/track%d.ogg' % (i % 500, i % 50, i)
+        tags = {
+            'title': 'Song of title %d' % i,
+            'artist': 'Artist%d' % (i % 500),
+            'album': 'Album%d' % (i % 50),
+        }
+        tracks.append((uri, tags))
+    return tracks
+
+def run(size):
+    tracks = make_tracks(size)
+    playlist = Playlist(uri for uri, tags in tracks)
+    ids = playlist.ids()
+    index = SearchIndex()
+    start = time.time()
+    for track_id, (uri, tags) in zip(ids, tracks):
+        index.update(track_id, uri, tags)
+    build_time = (time.time() - start) * 1000
+
+    print '%d entries: build %.0f ms, index memory %.1f MB' % (
+        size, build_time, index.memory_usage() / 1024.0 / 1024)
+    for query in QUERIES:
+        start = time.time()
+        for i in xrange(REPEATS):
+            positions = index.find(query, playlist, FIND_LIMIT)
+        elapsed = (time.time() - start) * 1000 / REPEATS
+        print '  %-16s %6d matches  %8.3f ms' % (repr(query), len(positions), elapsed)
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    for size in sizes:
+        run(size)
+
+if __name__ == '__main__':
+    main()
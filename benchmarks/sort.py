@@ -0,0 +1,97 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmarks of sorting the playlist by tags
+
+Usage: python benchmarks/sort.py [size ...]
+
+Prints time in milliseconds of sorting synthetic playlists of given sizes
+(10k and 100k entries by default) by different keys, both the first time,
+when collation keys are computed, and with keys already cached, as they are
+after the player has computed them while idle. The time of computing keys
+of all tracks for all sort keys in batches, like the player does, is
+printed too.
+
+"""
+import locale
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from myplay.playlist import Playlist
+from myplay.sortkeys import SortKeyCache
+from myplay.trackstore import TrackStore, TagMap
+
+SIZES = (10000, 100000)
+
+# the same as INDEX_BATCH of the player
+UPDATE_BATCH = 200
+
+KEYS = (['artist'], ['artist', 'album', 'title'], ['path'])
+
+def make_tracks(size):
+    """Return TrackStore and Playlist of size tracks in random order"""
+    uris = []
+    for i in xrange(size):
+        uris.append('file:///music/artist%d/album%d/track%d.ogg' % (i % 500, i % 50, i))
+    random.shuffle(uris)
+    store = TrackStore()
+    playlist = Playlist(uris, store)
+    tags = TagMap(store)
+    for i, uri in enumerate(uris):
+        tags[uri] = {
+            'title': 'Song of title %d' % i,
+            'artist': 'Artist%d' % (i % 500),
+            'album': 'Album%d' % (i % 50),
+        }
+    return store, playlist
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return (time.time() - start) * 1000
+
+def run(size):
+    store, playlist = make_tracks(size)
+    print '%d entries:' % size
+    cache = SortKeyCache(store)
+    ids = list(playlist.ids())
+    start = time.time()
+    for i in xrange(0, len(ids), UPDATE_BATCH):
+        cache.update(ids[i:i + UPDATE_BATCH])
+    print '  keys computed in batches of %d: %.0f ms' % (UPDATE_BATCH, (time.time() - start) * 1000)
+    for keys in KEYS:
+        cache = SortKeyCache(store)
+        cold = timed(cache.sorted_positions, playlist, keys)
+        warm = timed(cache.sorted_positions, playlist, keys)
+        print '  %-24s cold %6.0f ms  cached %6.0f ms' % (','.join(keys), cold, warm)
+
+def main():
+    try:
+        locale.setlocale(locale.LC_COLLATE, '')
+    except locale.Error:
+        pass
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    for size in sizes:
+        run(size)
+
+if __name__ == '__main__':
+    main()
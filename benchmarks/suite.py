@@ -0,0 +1,415 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Playback and tag scanning latency benchmarks
+
+Usage: python benchmarks/suite.py [options]
+
+Generates synthetic tagged audio files in a temporary directory, starts a
+private D-BUS session bus and runs Player and TagScanner on it with a fake
+audio sink, so it works on a plain Linux box without sound hardware or a
+desktop session. User's data and config directories are not touched.
+
+Measured values:
+
+ * service cold start: time from spawning the service process with a saved
+   playlist of given size to the replies of the first GetState and
+   ListRange calls
+ * time from SetCurrent/Next call to the first buffer reaching audio sink
+ * gap between the last buffer of a track and the first buffer of the next
+   one when a track ends by itself, with and without gapless playback
+ * tag scanning throughput in files per second for given playlist sizes,
+   with and without fast tag reader and for given numbers of pipelines
+ * time to the first buffer and bytes fetched when playing tracks served by
+   a local HTTP server for the first time and again from the stream cache
+
+Results are printed as JSON (or written to the file given with --output),
+so they can be compared between runs.
+
+"""
+import BaseHTTPServer
+import SimpleHTTPServer
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import dbus
+import dbus.mainloop.glib
+import glib
+import gobject
+import gst
+
+from myplay.common import BUS_NAME, OBJECT_IFACE, OBJECT_PATH, path_to_uri, uri_to_path
+from myplay.journal import PlaylistJournal
+from myplay.player import Player
+from myplay.tagscanner import TagScanner
+
+MEDIA_ENCODERS = (
+    ('ogg', 'vorbisenc ! oggmux'),
+    ('flac', 'flacenc'),
+    ('mp3', 'lame ! id3v2mux'),
+)
+
+SAMPLE_RATE = 44100
+SAMPLES_PER_BUFFER = 1024
+
+TRACK_SECONDS = 2
+
+FAKE_SINK = 'fakesink name=benchsink sync=true signal-handoffs=true'
+
+# buffers with timestamps below this are considered start of a new track
+TRACK_START_THRESHOLD = gst.SECOND / 10
+
+LOOP_TIMEOUT = 60
+
+def run_loop_until(predicate, timeout=LOOP_TIMEOUT):
+    context = glib.main_context_default()
+    wakeup_id = glib.timeout_add(10, lambda: True)
+    deadline = time.time() + timeout
+    try:
+        while not predicate():
+            if time.time() > deadline:
+                raise RuntimeError('timed out')
+            context.iteration(True)
+    finally:
+        glib.source_remove(wakeup_id)
+
+def start_bus():
+    process = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                               stdout=subprocess.PIPE)
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = process.stdout.readline().strip()
+    return process
+
+def available_encoders():
+    result = []
+    for name, description in MEDIA_ENCODERS:
+        elements = [part.split()[0] for part in description.split('!')]
+        if all(gst.element_factory_find(element) for element in elements + ['taginject']):
+            result.append((name, description))
+    return result
+
+def generate_track(path, encoder, number, seconds=TRACK_SECONDS):
+    tags = 'title="Track %d",artist="Artist %d",album="Album %d"' % (number, number % 10, number % 3)
+    pipeline = gst.parse_launch(
+        'audiotestsrc num-buffers=%d samplesperbuffer=%d freq=%d '
+        '! audio/x-raw-int,rate=%d,channels=2 ! audioconvert '
+        '! taginject tags=%s ! %s ! filesink location=%s' % (
+            seconds * SAMPLE_RATE // SAMPLES_PER_BUFFER, SAMPLES_PER_BUFFER,
+            220 + number * 20, SAMPLE_RATE, json.dumps(tags), encoder, json.dumps(path)))
+    pipeline.set_state(gst.STATE_PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(gst.CLOCK_TIME_NONE, gst.MESSAGE_EOS | gst.MESSAGE_ERROR)
+    pipeline.set_state(gst.STATE_NULL)
+    if message.type == gst.MESSAGE_ERROR:
+        raise RuntimeError('failed to generate %s: %s' % (path, message.parse_error()[1]))
+
+def generate_media(directory, count):
+    """Generate count tracks (by copying templates of each format), return their uris"""
+    templates = []
+    for name, encoder in available_encoders():
+        path = os.path.join(directory, 'template%d.%s' % (len(templates), name))
+        generate_track(path, encoder, len(templates))
+        templates.append(path)
+    if not templates:
+        raise RuntimeError('no usable encoders found')
+    uris = []
+    for i in xrange(count):
+        template = templates[i % len(templates)]
+        path = os.path.join(directory, 'track%06d%s' % (i, os.path.splitext(template)[1]))
+        shutil.copyfile(template, path)
+        uris.append(path_to_uri(path))
+    return uris
+
+class PlayerBench(object):
+
+    def __init__(self, bus, uris, gapless, stream_cache_size=0):
+        self.player = Player(audio_sink=FAKE_SINK, gapless=gapless, stream_cache_size=stream_cache_size)
+        self.player.add_to_connection(bus, OBJECT_PATH)
+        self.player.Clear()
+        self.player.Add(uris, 0)
+        self.buffers = []
+        sink = self.player._get_pipeline().get_property('audio-sink').get_by_name('benchsink')
+        sink.connect('handoff', self._on_handoff)
+
+    def _on_handoff(self, sink, buffer, pad):
+        # streaming thread
+        self.buffers.append((time.time(), buffer.timestamp, buffer.duration))
+
+    def close(self):
+        self.player.Stop()
+        self.player.remove_from_connection()
+        self.player.close()
+
+    def wait_track_start(self, mark):
+        """Wait for the first buffer of a new track after mark, return its index"""
+        def started():
+            for i in xrange(mark, len(self.buffers)):
+                if self.buffers[i][1] < TRACK_START_THRESHOLD:
+                    return True
+            return False
+        run_loop_until(started)
+        for i in xrange(mark, len(self.buffers)):
+            if self.buffers[i][1] < TRACK_START_THRESHOLD:
+                return i
+
+    def measure_set_current(self, repeats):
+        results = []
+        for i in xrange(repeats):
+            self.player.Stop()
+            mark = len(self.buffers)
+            start = time.time()
+            self.player.SetCurrent(i % self.player.GetLength(), True)
+            index = self.wait_track_start(mark)
+            results.append(self.buffers[index][0] - start)
+        self.player.Stop()
+        return results
+
+    def measure_next(self, repeats):
+        results = []
+        self.player.SetCurrent(0, True)
+        self.wait_track_start(len(self.buffers))
+        for i in xrange(repeats):
+            # let it play a bit, so buffers of the new track are distinguishable
+            run_loop_until(lambda: self.buffers[-1][1] > TRACK_START_THRESHOLD * 3)
+            if self.player.GetCurrent() == self.player.GetLength() - 1:
+                self.player.SetCurrent(0, True)
+                self.wait_track_start(len(self.buffers))
+                continue
+            mark = len(self.buffers)
+            start = time.time()
+            self.player.Next()
+            index = self.wait_track_start(mark)
+            results.append(self.buffers[index][0] - start)
+        self.player.Stop()
+        return results
+
+    def measure_track_switch(self, repeats):
+        """Return gaps between tracks switched automatically"""
+        results = []
+        for i in xrange(repeats):
+            self.player.SetCurrent(0, True)
+            self.wait_track_start(len(self.buffers))
+            run_loop_until(lambda: self.buffers[-1][1] > TRACK_START_THRESHOLD * 3)
+            index = self.wait_track_start(len(self.buffers))
+            last_time, last_timestamp, last_duration = self.buffers[index - 1]
+            results.append(self.buffers[index][0] - last_time - float(last_duration) / gst.SECOND)
+        self.player.Stop()
+        return results
+
+def summary(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'min_ms': values[0] * 1000,
+        'median_ms': values[len(values) // 2] * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+def bench_playback(bus, uris, repeats):
+    results = {}
+    for gapless in (False, True):
+        bench = PlayerBench(bus, uris[:3], gapless)
+        try:
+            name = gapless and 'gapless' or 'non_gapless'
+            if not gapless:
+                results['set_current_to_first_buffer'] = summary(bench.measure_set_current(repeats))
+                results['next_to_first_buffer'] = summary(bench.measure_next(repeats))
+            results['track_switch_gap_' + name] = summary(bench.measure_track_switch(repeats))
+        finally:
+            bench.close()
+    return results
+
+class MediaServer(BaseHTTPServer.HTTPServer):
+    """HTTP server of files in a directory, counting bytes sent"""
+
+    def __init__(self, directory):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _MediaHandler)
+        self.directory = directory
+        self.bytes_sent = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def uri(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.server_port, urllib.quote(os.path.basename(path)))
+
+class _MediaHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, urllib.unquote(path.split('?')[0]).lstrip('/'))
+
+    def copyfile(self, source, outputfile):
+        while True:
+            data = source.read(16384)
+            if not data:
+                break
+            outputfile.write(data)
+            self.server.bytes_sent += len(data)
+
+    def log_message(self, *args):
+        pass
+
+def bench_stream_cache(bus, media_dir, uris, repeats):
+    server = MediaServer(media_dir)
+    remote_uris = [server.uri(uri_to_path(uri)) for uri in uris[:repeats]]
+    bench = PlayerBench(bus, remote_uris, False, stream_cache_size=64)
+    cache = bench.player._stream_cache
+    results = {}
+    try:
+        for name in ('uncached', 'cached'):
+            times = []
+            sent = server.bytes_sent
+            for i, uri in enumerate(remote_uris):
+                bench.player.Stop()
+                mark = len(bench.buffers)
+                start = time.time()
+                bench.player.SetCurrent(i, True)
+                index = bench.wait_track_start(mark)
+                times.append(bench.buffers[index][0] - start)
+                # the source reads ahead of playback, wait until it reaches the end
+                run_loop_until(lambda: cache.lookup(uri) is not None)
+            bench.player.Stop()
+            results[name] = dict(summary(times), bytes_fetched=server.bytes_sent - sent)
+    finally:
+        bench.close()
+        server.shutdown()
+    return results
+
+def start_service(data_home):
+    env = dict(os.environ, XDG_DATA_HOME=data_home,
+               PYTHONPATH=os.path.join(os.path.dirname(__file__), os.pardir))
+    return subprocess.Popen([sys.executable, '-c', 'from myplay.service import main; main()'], env=env)
+
+def bench_startup(bus, temp_dir, sizes, repeats):
+    results = []
+    for size in sizes:
+        data_home = os.path.join(temp_dir, 'startup%d' % size)
+        data_dir = os.path.join(data_home, 'myplay')
+        os.makedirs(data_dir)
+        journal = PlaylistJournal(os.path.join(data_dir, 'playlist'), None)
+        journal.load()
+        journal.record('add', 0, [path_to_uri('/nonexistent/track%07d.ogg' % i) for i in xrange(size)])
+        journal.close()
+
+        first_reply = []
+        first_page = []
+        for i in xrange(repeats):
+            start = time.time()
+            process = start_service(data_home)
+            try:
+                deadline = start + LOOP_TIMEOUT
+                while not bus.name_has_owner(BUS_NAME):
+                    if time.time() > deadline or process.poll() is not None:
+                        raise RuntimeError('service failed to start')
+                    time.sleep(0.001)
+                player = dbus.Interface(bus.get_object(BUS_NAME, OBJECT_PATH), OBJECT_IFACE)
+                player.GetState()
+                first_reply.append(time.time() - start)
+                player.ListRange(0, 100)
+                first_page.append(time.time() - start)
+            finally:
+                process.terminate()
+                process.wait()
+                while bus.name_has_owner(BUS_NAME):
+                    time.sleep(0.001)
+        results.append({
+            'playlist_size': size,
+            'first_reply': summary(first_reply),
+            'first_page': summary(first_page),
+        })
+    return results
+
+def bench_scan(uris, sizes, pipelines_list):
+    results = []
+    for size in sizes:
+        for fast_path in (True, False):
+            for pipelines in pipelines_list:
+                scanned = []
+                scanner = TagScanner(lambda uri, tags: scanned.append(uri), pipelines, fast_path)
+                start = time.time()
+                scanner.add(uris[:size])
+                run_loop_until(lambda: len(scanned) >= size, LOOP_TIMEOUT + size)
+                elapsed = time.time() - start
+                results.append({
+                    'files': size,
+                    'fast_path': fast_path,
+                    'pipelines': pipelines,
+                    'seconds': elapsed,
+                    'files_per_second': size / elapsed,
+                })
+    return results
+
+def parse_list(value):
+    return [int(item) for item in value.split(',')]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--output', help='write JSON results to this file instead of stdout')
+    parser.add_option('--sizes', default='100,1000', help='comma-separated playlist sizes for tag scanning')
+    parser.add_option('--pipelines', default='1,4', help='comma-separated numbers of scan pipelines')
+    parser.add_option('--repeats', type='int', default=5, help='number of measurements of each playback latency')
+    options, args = parser.parse_args()
+    sizes = parse_list(options.sizes)
+
+    gobject.threads_init()
+    dbus.mainloop.glib.threads_init()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    temp_dir = tempfile.mkdtemp(prefix='myplay-bench-')
+    for name in ('XDG_DATA_HOME', 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME'):
+        os.environ[name] = os.path.join(temp_dir, name.lower())
+    bus_process = start_bus()
+    try:
+        media_dir = os.path.join(temp_dir, 'media')
+        os.makedirs(media_dir)
+        uris = generate_media(media_dir, max(sizes + [3, options.repeats]))
+
+        bus = dbus.SessionBus()
+        results = {
+            'timestamp': time.time(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'gstreamer': '.'.join(str(part) for part in gst.version()),
+            'startup': bench_startup(bus, temp_dir, sizes, options.repeats),
+            'playback': bench_playback(bus, uris, options.repeats),
+            'scan': bench_scan(uris, sizes, parse_list(options.pipelines)),
+            'stream_cache': bench_stream_cache(bus, media_dir, uris, options.repeats),
+        }
+    finally:
+        bus_process.terminate()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        open(options.output, 'w').write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
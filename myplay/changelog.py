@@ -0,0 +1,71 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import collections
+
+# maximum total size of logged changes, counting every position or uri in
+# their arguments as an item, so a few reorders of a huge playlist don't
+# take more memory than many small changes
+MAX_ITEMS = 100000
+
+class ChangeLog(object):
+    """Bounded log of recent playlist changes, keyed by version
+
+    Versions are journal sequence numbers, so they are consecutive and they
+    survive service restarts, as the log is also filled while replaying the
+    journal. Oldest changes are dropped when the log grows over max_items.
+
+    """
+
+    def __init__(self, max_items=MAX_ITEMS):
+        self._changes = collections.deque()
+        self._items = 0
+        self._max_items = max_items
+
+    def _size(self, op, args):
+        if op == 'batch':
+            return sum(self._size(batch_op, batch_args) for batch_op, batch_args in args[0])
+        size = 1
+        for arg in args:
+            if isinstance(arg, list):
+                size += len(arg)
+        return size
+
+    def append(self, version, op, args):
+        if self._changes and version != self._changes[-1][0] + 1:
+            # there's a gap, changes before it are useless
+            self.clear()
+        self._changes.append((version, op, args))
+        self._items += self._size(op, args)
+        while self._items > self._max_items and len(self._changes) > 1:
+            self._items -= self._size(*self._changes.popleft()[1:])
+
+    def clear(self):
+        self._changes.clear()
+        self._items = 0
+
+    def since(self, version):
+        """Return list of (version, op, args) after given version or None if they aren't all logged"""
+        changes = self._changes
+        if not changes:
+            return None
+        first = changes[0][0]
+        last = changes[-1][0]
+        if version < first - 1 or version > last:
+            return None
+        return list(changes)[version - first + 1:]
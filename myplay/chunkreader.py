@@ -0,0 +1,95 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import threading
+
+import glib
+
+# number of uris passed to the main loop at once
+CHUNK_SIZE = 500
+
+# maximum number of chunks passed to the main loop and not handled by it
+# yet, the thread waits when there are more, so a fast reader and a busy
+# main loop don't queue the whole input in memory
+MAX_PENDING_CHUNKS = 4
+
+class ChunkReader(object):
+    """Consumes an iterable of uris in a worker thread
+
+    Uris are passed to chunk_callback(reader, uris) in lists of up to
+    CHUNK_SIZE items, then finish_callback(reader) is called. Both callbacks
+    are invoked from the main loop and never after "cancel" was called.
+    If the iterable raises EnvironmentError or ValueError, e.g. for
+    unreadable directories or malformed playlists, uris read so far are
+    passed and the exception is left in the "error" attribute for
+    finish_callback, otherwise it's None.
+
+    """
+
+    def __init__(self, uris, chunk_callback, finish_callback):
+        self._uris = uris
+        self._chunk_callback = chunk_callback
+        self._finish_callback = finish_callback
+        self._cancelled = threading.Event()
+        self._pending = threading.Semaphore(MAX_PENDING_CHUNKS)
+        self.error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+        # wake up the thread if it waits for the main loop
+        self._pending.release()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.isSet()
+
+    def _run(self):
+        chunk = []
+        try:
+            for uri in self._uris:
+                if self.cancelled:
+                    return
+                chunk.append(uri)
+                if len(chunk) >= CHUNK_SIZE:
+                    self._send(chunk)
+                    chunk = []
+        except (EnvironmentError, ValueError), e:
+            self.error = e
+        if chunk:
+            self._send(chunk)
+        glib.idle_add(self._on_finish)
+
+    def _send(self, chunk):
+        self._pending.acquire()
+        glib.idle_add(self._on_chunk, chunk)
+
+    def _on_chunk(self, uris):
+        self._pending.release()
+        if not self.cancelled:
+            self._chunk_callback(self, uris)
+        return False
+
+    def _on_finish(self):
+        if not self.cancelled:
+            self._finish_callback(self)
+        return False
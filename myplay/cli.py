@@ -0,0 +1,253 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Command line client for the MyPlay service
+
+Usage: myplay-cli COMMAND [ARGUMENTS]
+
+Commands:
+
+  status                      print state, current position and length
+  list                        print playlist entries with their titles
+  play, pause, stop, next, previous
+  current POSITION            make entry at POSITION current
+  shuffle on|off              turn shuffle on or off
+  enqueue POSITION...         play entries next, in given order
+  add FILE_OR_URI...          add entries to the end of the playlist
+  remove POSITION...          remove entries
+  clear                       remove all entries
+  sort [-r] KEY...            sort by artist, album, title or path,
+                              -r sorts in descending order
+  execute                     read operations from standard input and
+                              apply them at once
+  stats [on|off]              print service statistics or turn collecting
+                              them on or off
+  profile start FILE          start profiling the service
+  profile stop                stop profiling, write results to FILE
+
+Operations for "execute" are given one per line:
+
+  add POSITION FILE_OR_URI    insert entry at POSITION
+  append FILE_OR_URI          add entry to the end of the playlist
+  remove POSITION...
+  move POSITION... to POSITION
+  reorder POSITION...
+  current POSITION
+  clear, next, previous, play, pause, stop
+
+Positions refer to the playlist as left by previous lines. Consecutive
+lines adding adjacent entries are sent as one operation, so piping lots of
+files is cheap.
+
+"""
+import os
+import sys
+
+import dbus.mainloop.glib
+import glib
+
+from myplay.client import Client, make_op
+from myplay.common import path_to_uri
+from myplay.playlistio import URI_RE
+from myplay.tagreader import TAG_TITLE, TAG_ARTIST
+
+STATE_NAMES = ('stopped', 'playing', 'paused')
+
+LIST_PAGE_SIZE = 1000
+
+class UsageError(Exception):
+    pass
+
+def to_uri(value):
+    if URI_RE.match(value):
+        return value
+    return path_to_uri(value)
+
+def parse_ops(lines, length):
+    """Return list of Execute operations for lines, given current playlist length"""
+    ops = []
+    pending_add = None
+    for number, line in enumerate(lines):
+        words = line.split(None, 2)
+        if not words or words[0].startswith('#'):
+            continue
+        op, args = words[0], line.split()[1:]
+        try:
+            if op in ('add', 'append'):
+                if op == 'add':
+                    position, uri = int(words[1]), words[2].strip()
+                else:
+                    position, uri = length, line.split(None, 1)[1].strip()
+                uri = to_uri(uri)
+                if pending_add is not None and position == pending_add[0] + len(pending_add[1]):
+                    pending_add[1].append(uri)
+                else:
+                    if pending_add is not None:
+                        ops.append(make_op('add', *pending_add))
+                    pending_add = (position, [uri])
+                length += 1
+                continue
+            if pending_add is not None:
+                ops.append(make_op('add', *pending_add))
+                pending_add = None
+            if op in ('remove', 'reorder'):
+                positions = [int(arg) for arg in args]
+                if op == 'remove':
+                    length -= len(set(positions))
+                ops.append(make_op(op, positions))
+            elif op == 'move':
+                if args[-2] != 'to':
+                    raise ValueError
+                ops.append(make_op(op, [int(arg) for arg in args[:-2]], int(args[-1])))
+            elif op == 'current':
+                ops.append(make_op(op, int(args[0])))
+            elif op in ('clear', 'next', 'previous', 'play', 'pause', 'stop'):
+                if op == 'clear':
+                    length = 0
+                ops.append(make_op(op))
+            else:
+                raise UsageError('line %d: unknown operation: %s' % (number + 1, op))
+        except (IndexError, ValueError):
+            raise UsageError('line %d: invalid arguments for %s' % (number + 1, op))
+    if pending_add is not None:
+        ops.append(make_op('add', *pending_add))
+    return ops
+
+class Application(object):
+
+    def __init__(self, command, args):
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self._loop = glib.MainLoop()
+        self._command = command
+        self._args = args
+        self.status = 0
+        self._started = False
+        self._client = Client(mirror_playlist=False)
+        self._client.connect('reset', self._on_reset)
+        self._client.connect('error', self._on_error)
+
+    def run(self):
+        self._loop.run()
+
+    def _done(self, *args):
+        self._client.close()
+        self._loop.quit()
+
+    def _on_error(self, client, error):
+        sys.stderr.write('error: %s\n' % error)
+        self.status = 1
+        self._done()
+
+    def _call(self, method, *args):
+        self._client.call(method, *args, reply_handler=self._done)
+
+    def _on_reset(self, client):
+        if self._started:
+            # reloaded after service restart
+            return
+        self._started = True
+        command, args = self._command, self._args
+        try:
+            if command == 'status':
+                print 'state: %s' % STATE_NAMES[client.state]
+                print 'current: %d' % client.current
+                print 'length: %d' % client.length
+                self._done()
+            elif command == 'list':
+                self._list(0)
+            elif command in ('play', 'pause', 'stop', 'next', 'previous', 'clear'):
+                self._call(command.capitalize())
+            elif command == 'current':
+                self._call('SetCurrent', int(args[0]), False)
+            elif command == 'shuffle':
+                if len(args) != 1 or args[0] not in ('on', 'off'):
+                    raise UsageError('shuffle takes "on" or "off"')
+                self._call('SetShuffle', args[0] == 'on')
+            elif command == 'enqueue':
+                self._call('Enqueue', [int(arg) for arg in args])
+            elif command == 'add':
+                if not args:
+                    raise UsageError('nothing to add')
+                self._call('Add', [to_uri(arg) for arg in args], client.length)
+            elif command == 'remove':
+                self._call('Remove', [int(arg) for arg in args])
+            elif command == 'sort':
+                descending = bool(args) and args[0] == '-r'
+                if descending:
+                    args = args[1:]
+                if not args:
+                    raise UsageError('no sort keys given')
+                self._call('SortBy', args, descending)
+            elif command == 'stats':
+                if args:
+                    if args[0] not in ('on', 'off'):
+                        raise UsageError('stats takes "on" or "off"')
+                    self._call('SetStatsEnabled', args[0] == 'on')
+                else:
+                    self._client.call('GetStats', reply_handler=self._print_stats)
+            elif command == 'profile':
+                if args[0] == 'start':
+                    self._call('StartProfiling', os.path.abspath(args[1]))
+                elif args[0] == 'stop':
+                    self._call('StopProfiling')
+                else:
+                    raise UsageError('profile takes "start FILE" or "stop"')
+            elif command == 'execute':
+                ops = parse_ops(sys.stdin, client.length)
+                if ops:
+                    self._client.execute(ops, reply_handler=self._done)
+                else:
+                    self._done()
+            else:
+                raise UsageError('unknown command: %s' % command)
+        except (IndexError, ValueError):
+            self._usage_error(UsageError('invalid arguments for %s' % command))
+        except UsageError, e:
+            self._usage_error(e)
+
+    def _usage_error(self, error):
+        sys.stderr.write('%s\n' % error)
+        self.status = 2
+        self._done()
+
+    def _print_stats(self, result):
+        for name in sorted(result):
+            fields = ' '.join('%s=%g' % item for item in sorted(result[name].iteritems()))
+            print '%s: %s' % (name, fields)
+        self._done()
+
+    def _list(self, offset):
+        def reply_handler(tracks):
+            for i, (uri, tag) in enumerate(tracks):
+                title = tag.get(TAG_TITLE, '')
+                if tag.get(TAG_ARTIST):
+                    title = '%s - %s' % (tag[TAG_ARTIST], title)
+                print '%d\t%s\t%s' % (offset + i, uri, title)
+            if len(tracks) == LIST_PAGE_SIZE:
+                self._list(offset + LIST_PAGE_SIZE)
+            else:
+                self._done()
+        self._client.list_range(offset, LIST_PAGE_SIZE, reply_handler)
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+    app = Application(sys.argv[1], sys.argv[2:])
+    app.run()
+    sys.exit(app.status)
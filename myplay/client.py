@@ -0,0 +1,374 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import dbus
+import gobject
+
+from myplay.common import BUS_NAME, OBJECT_IFACE, OBJECT_PATH, CURRENT_UNSET, STATE_READY
+from myplay.common import utf8_tracks
+
+def make_op(op, *args):
+    """Return typed Execute operation, see Player.Execute for arguments"""
+    if op == 'add':
+        position, uris = args
+        value = dbus.Struct((dbus.UInt32(position), dbus.Array(uris, signature='s')), signature='uas')
+    elif op in ('remove', 'reorder'):
+        value = dbus.Array(args[0], signature='u')
+    elif op == 'move':
+        positions, position = args
+        value = dbus.Struct((dbus.Array(positions, signature='u'), dbus.UInt32(position)), signature='auu')
+    elif op == 'current':
+        value = dbus.Int32(args[0])
+    else:
+        value = dbus.Boolean(True)
+    return dbus.Struct((op, value), signature='sv')
+
+class Client(gobject.GObject):
+    """Asynchronous player client keeping a local mirror of player's state
+
+    All calls to the player are made without waiting for replies, so they
+    never block the main loop. State, current position, playlist length
+    and version, as well as shuffle mode and the play queue, are mirrored
+    from the player's signals and are available as attributes. If mirror_playlist is true, the uris of the playlist and
+    their tags are mirrored too, in the "playlist" list and "tags" dict.
+
+    Changes are reported with GObject signals, after the mirror is updated:
+
+     * reset: the whole state was (re)loaded, e.g. on connect
+     * added (position, tracks), removed (positions), cleared,
+       reordered (positions), current-changed (old, new),
+       state-changed (old, new), tags-changed (tracks),
+       shuffle-changed (shuffle), queue-changed (positions)
+     * error (exception): a call without error_handler failed
+
+    When the service is restarted (e.g. after quitting when idle), the
+    mirror is brought up to date with GetChangesSince, so only the changes
+    made meanwhile are reported, if the player still knows them.
+
+    """
+
+    __gsignals__ = {
+        'reset': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+        'added': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, object)),
+        'removed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (object, )),
+        'cleared': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+        'reordered': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (object, )),
+        'current-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int)),
+        'state-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (int, int)),
+        'tags-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (object, )),
+        'shuffle-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (bool, )),
+        'queue-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (object, )),
+        'error': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (object, )),
+    }
+
+    def __init__(self, bus=None, mirror_playlist=True):
+        super(Client, self).__init__()
+        if bus is None:
+            bus = dbus.SessionBus()
+        self._bus = bus
+        self._mirror_playlist = mirror_playlist
+
+        self.loaded = False
+        self.version = 0
+        self.state = STATE_READY
+        self.current = CURRENT_UNSET
+        self.length = 0
+        self.shuffle = False
+        self.queue = []
+        self.playlist = mirror_playlist and [] or None
+        self.tags = {}
+
+        # signals received while waiting for a reply with the state are
+        # already reflected in it, so they are dropped
+        self._loading = False
+
+        # following name owner changes doesn't block on service activation,
+        # calls to the well-known name start the service if needed
+        proxy = bus.get_object(BUS_NAME, OBJECT_PATH, follow_name_owner_changes=True, introspect=False)
+        self._player = dbus.Interface(proxy, OBJECT_IFACE)
+
+        for signal, handler in (
+                ('Added', self._on_added),
+                ('Removed', self._on_removed),
+                ('Cleared', self._on_cleared),
+                ('Reordered', self._on_reordered),
+                ('CurrentChanged', self._on_current_changed),
+                ('StateChanged', self._on_state_changed),
+                ('TagsChanged', self._on_tags_changed),
+                ('Executed', self._on_executed),
+                ('ShuffleChanged', self._apply_shuffle_changed),
+                ('QueueChanged', self._apply_queue_changed)):
+            bus.add_signal_receiver(handler, signal, OBJECT_IFACE, BUS_NAME, OBJECT_PATH)
+        self._owner_watch = bus.watch_name_owner(BUS_NAME, self._on_name_owner_changed)
+        self._load()
+
+    def close(self):
+        self._owner_watch.cancel()
+
+    def call(self, method, *args, **kwargs):
+        """Call player method without blocking
+
+        Accepts reply_handler and error_handler keyword arguments, errors of
+        calls without error_handler are reported with the "error" signal.
+
+        """
+        reply_handler = kwargs.pop('reply_handler', None) or (lambda *result: None)
+        error_handler = kwargs.pop('error_handler', None) or self._on_error
+        getattr(self._player, method)(*args, reply_handler=reply_handler, error_handler=error_handler)
+
+    def _on_error(self, error):
+        self.emit('error', error)
+
+    # playback
+
+    def play(self):
+        self.call('Play')
+
+    def pause(self):
+        self.call('Pause')
+
+    def stop(self):
+        self.call('Stop')
+
+    def next(self):
+        self.call('Next')
+
+    def previous(self):
+        self.call('Previous')
+
+    def set_current(self, position, play=False):
+        self.call('SetCurrent', position, play)
+
+    def set_shuffle(self, shuffle):
+        self.call('SetShuffle', shuffle)
+
+    def enqueue(self, positions):
+        self.call('Enqueue', positions)
+
+    def clear_queue(self):
+        self.call('ClearQueue')
+
+    # playlist
+
+    def add(self, uris, position=None):
+        if position is None:
+            position = self.length
+        self.call('Add', uris, position)
+
+    def add_directory(self, uri, position=None, recursive=True):
+        if position is None:
+            position = self.length
+        self.call('AddDirectory', uri, position, recursive)
+
+    def remove(self, positions):
+        self.call('Remove', positions)
+
+    def clear(self):
+        self.call('Clear')
+
+    def reorder(self, positions):
+        self.call('Reorder', positions)
+
+    def sort_by(self, keys, descending=False):
+        self.call('SortBy', keys, descending)
+
+    def execute(self, ops, reply_handler=None, error_handler=None):
+        """Apply operations at once, ops is a list of make_op results"""
+        self.call('Execute', dbus.Array(ops, signature='(sv)'),
+                  reply_handler=reply_handler, error_handler=error_handler)
+
+    def list_range(self, offset, count, reply_handler, error_handler=None):
+        """Fetch (uri, tags) pairs of a part of the playlist"""
+        def on_reply(tracks):
+            reply_handler(utf8_tracks(tracks))
+        self.call('ListRange', offset, count, reply_handler=on_reply, error_handler=error_handler)
+
+    def hint_visible(self, offset, count):
+        self._player.HintVisible(offset, count, ignore_reply=True)
+
+    # mirror
+
+    def _load(self):
+        self._loading = True
+        if self._mirror_playlist:
+            self.call('GetSnapshot', reply_handler=self._on_snapshot, error_handler=self._on_load_error)
+        else:
+            self.call('GetStatus', reply_handler=self._on_status, error_handler=self._on_load_error)
+
+    def _on_load_error(self, error):
+        self._loading = False
+        self._on_error(error)
+
+    def _on_status(self, version, state, current, length):
+        self._loading = False
+        self.loaded = True
+        self.version = int(version)
+        self.state = int(state)
+        self.current = int(current)
+        self.length = int(length)
+        self.emit('reset')
+        self._load_play_order()
+
+    def _load_play_order(self):
+        # play order isn't versioned, like the state
+        self.call('GetShuffle', reply_handler=self._apply_shuffle_changed)
+        self.call('GetQueue', reply_handler=self._apply_queue_changed)
+
+    def _on_snapshot(self, version, state, current, tracks):
+        tracks = utf8_tracks(tracks)
+        self.playlist = [uri for uri, tag in tracks]
+        self.tags = dict(tracks)
+        self._on_status(version, state, current, len(tracks))
+
+    def _on_name_owner_changed(self, owner):
+        if not owner or not self.loaded:
+            # service quit, it's activated again with the next call
+            return
+        self._loading = True
+        self.call('GetChangesSince', dbus.UInt64(self.version),
+                  reply_handler=self._on_changes, error_handler=self._on_load_error)
+
+    def _on_changes(self, resync, version, changes):
+        if resync:
+            self._load()
+            return
+        self._loading = False
+        for change_version, op, value in changes:
+            self._apply_change(op, value)
+        self.version = int(version)
+        # the state isn't versioned, ask for it separately
+        self.call('GetState', reply_handler=lambda state: self._apply_state_changed(self.state, state))
+        self._load_play_order()
+
+    def _apply_change(self, op, value):
+        if op == 'add':
+            self._apply_added(value[1], value[0])
+        elif op == 'remove':
+            self._apply_removed(value)
+        elif op == 'reorder':
+            self._apply_reordered(value)
+        elif op == 'clear':
+            self._apply_cleared()
+        elif op == 'current':
+            self._apply_current_changed(self.current, value)
+        elif op == 'tags':
+            self._apply_tags_changed(value)
+        elif op == 'batch':
+            for batch_op, batch_value in value:
+                self._apply_change(batch_op, batch_value)
+
+    # every versioned change is announced with exactly one signal, so
+    # version is increased by one for each of them, except for Execute,
+    # whose signals are followed by Executed with the resulting version
+
+    def _changed(self):
+        if self._loading:
+            return False
+        self.version += 1
+        return True
+
+    def _on_added(self, tracks, position):
+        if self._changed():
+            self._apply_added(tracks, position)
+
+    def _on_removed(self, positions):
+        if self._changed():
+            self._apply_removed(positions)
+
+    def _on_cleared(self):
+        if self._changed():
+            self._apply_cleared()
+
+    def _on_reordered(self, positions):
+        if self._changed():
+            self._apply_reordered(positions)
+
+    def _on_current_changed(self, old, new):
+        if self._changed():
+            self._apply_current_changed(old, new)
+
+    def _on_tags_changed(self, tracks):
+        if self._changed():
+            self._apply_tags_changed(tracks)
+
+    def _on_executed(self, version):
+        if not self._loading:
+            self.version = int(version)
+
+    def _on_state_changed(self, old, new):
+        if not self._loading:
+            self._apply_state_changed(old, new)
+
+    def _apply_added(self, tracks, position):
+        tracks = utf8_tracks(tracks)
+        position = int(position)
+        self.length += len(tracks)
+        if self.playlist is not None:
+            self.playlist[position:position] = [uri for uri, tag in tracks]
+            self.tags.update(tracks)
+        self.emit('added', position, tracks)
+
+    def _apply_removed(self, positions):
+        positions = [int(pos) for pos in positions]
+        self.length -= len(positions)
+        if self.playlist is not None:
+            removed = set(positions)
+            self.playlist = [uri for i, uri in enumerate(self.playlist) if i not in removed]
+        self.emit('removed', positions)
+
+    def _apply_cleared(self):
+        self.length = 0
+        if self.playlist is not None:
+            self.playlist = []
+            self.tags = {}
+        self.emit('cleared')
+
+    def _apply_reordered(self, positions):
+        positions = [int(pos) for pos in positions]
+        if self.playlist is not None:
+            playlist = self.playlist
+            self.playlist = [playlist[pos] for pos in positions]
+        self.emit('reordered', positions)
+
+    def _apply_current_changed(self, old, new):
+        self.current = int(new)
+        self.emit('current-changed', int(old), self.current)
+
+    def _apply_state_changed(self, old, new):
+        new = int(new)
+        if new != self.state:
+            self.state = new
+            self.emit('state-changed', int(old), new)
+
+    def _apply_tags_changed(self, tracks):
+        tracks = utf8_tracks(tracks)
+        if self.playlist is not None:
+            self.tags.update(tracks)
+        self.emit('tags-changed', tracks)
+
+    def _apply_shuffle_changed(self, shuffle):
+        shuffle = bool(shuffle)
+        if shuffle != self.shuffle:
+            self.shuffle = shuffle
+            self.emit('shuffle-changed', shuffle)
+
+    def _apply_queue_changed(self, positions):
+        queue = [int(pos) for pos in positions]
+        if queue != self.queue:
+            self.queue = queue
+            self.emit('queue-changed', queue)
@@ -16,6 +16,9 @@
 # You should have received a copy of the GNU General Public License
 # along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import urllib
+
 BUS_NAME = 'org.nadako.MyPlay'
 OBJECT_IFACE = 'org.nadako.myplay.Player'
 OBJECT_PATH = '/org/nadako/myplay/player'
@@ -25,3 +28,27 @@ STATE_PLAYING = 1
 STATE_PAUSED = 2
 
 CURRENT_UNSET = -1
+
+def uri_to_path(uri):
+    """Return local filesystem path for a file:// uri or None for other uris"""
+    if not uri.startswith('file://'):
+        return None
+    path = uri[len('file://'):]
+    if not path.startswith('/'):
+        # skip host part, like in file://localhost/path
+        path = path[path.find('/'):]
+    return urllib.url2pathname(path)
+
+def path_to_uri(path):
+    return 'file://' + urllib.pathname2url(os.path.abspath(path))
+
+def to_utf8(value):
+    """Return str from a dbus.String or other unicode string, encoded in UTF-8"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def utf8_tracks(tracks):
+    """Convert (uri, tags) pairs received over D-Bus to UTF-8 encoded strs"""
+    return [(to_utf8(uri), dict((to_utf8(k), to_utf8(v)) for k, v in tags.iteritems()))
+            for uri, tags in tracks]
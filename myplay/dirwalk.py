@@ -0,0 +1,58 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+
+from myplay.common import path_to_uri
+
+AUDIO_EXTENSIONS = frozenset((
+    '.aac', '.ape', '.flac', '.m4a', '.mp2', '.mp3', '.mpc', '.oga', '.ogg',
+    '.opus', '.spx', '.wav', '.wma', '.wv',
+))
+
+def is_audio_file(name):
+    return os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS
+
+def walk_audio_files(path, recursive=True):
+    """Yield paths of audio files in directory, sorted by name, files before subdirectories
+
+    Names with audio extensions are taken for files without stat'ing them,
+    only other names are checked for being directories, and only when
+    recursive. Symbolic links to directories aren't followed.
+
+    """
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    names.sort()
+    subdirs = []
+    for name in names:
+        full_path = os.path.join(path, name)
+        if is_audio_file(name):
+            yield full_path
+        elif recursive and os.path.isdir(full_path) and not os.path.islink(full_path):
+            subdirs.append(full_path)
+    for subdir in subdirs:
+        for full_path in walk_audio_files(subdir, recursive):
+            yield full_path
+
+def walk_audio_uris(path, recursive=True):
+    """Like walk_audio_files, but yield uris"""
+    for full_path in walk_audio_files(path, recursive):
+        yield path_to_uri(full_path)
@@ -0,0 +1,143 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+
+import glib
+
+from myplay.common import uri_to_path
+from myplay.trackstore import split_uri
+
+# delay in milliseconds for collecting file events before reporting them
+COALESCE_DELAY = 1000
+
+CHANGED = 'changed'
+DELETED = 'deleted'
+
+class FileWatcher(object):
+    """Watches local files for changes using GIO directory monitors
+
+    Uris are added with "add" and removed with "remove", non-local ones are
+    ignored. There's one monitor per directory, shared by all watched files
+    in it and cancelled when the last of them is removed.
+
+    Watched files aren't stored, uris_func(prefix) is called to get the
+    watched uris of directory with given uri prefix, e.g. from a TrackStore,
+    so only directories take memory. Removed uris must already be gone from
+    what it returns.
+
+    Events are collected for COALESCE_DELAY milliseconds, only the last one
+    for each uri is kept, then callback(changed_uris, deleted_uris) is called.
+    Files created or moved in are reported as changed.
+
+    """
+
+    def __init__(self, callback, uris_func):
+        self._callback = callback
+        self._uris_func = uris_func
+        # uri prefix -> (monitor, directory path)
+        self._directories = {}
+        self._pending = {}
+        self._flush_id = 0
+
+    def add(self, uris):
+        last_prefix = None
+        for uri in uris:
+            prefix = split_uri(uri)[0]
+            # uris usually come in groups from the same directory
+            if prefix == last_prefix or prefix in self._directories:
+                continue
+            last_prefix = prefix
+            path = uri_to_path(uri)
+            if path is None:
+                continue
+            directory = os.path.dirname(path)
+            self._directories[prefix] = (self._monitor(directory, prefix), directory)
+
+    def remove(self, uris):
+        prefixes = set()
+        for uri in uris:
+            self._pending.pop(uri, None)
+            prefixes.add(split_uri(uri)[0])
+        for prefix in prefixes:
+            entry = self._directories.get(prefix)
+            if entry is not None and not self._uris_func(prefix):
+                monitor = entry[0]
+                if monitor is not None:
+                    monitor.cancel()
+                del self._directories[prefix]
+
+    def clear(self):
+        for monitor, directory in self._directories.itervalues():
+            if monitor is not None:
+                monitor.cancel()
+        self._directories = {}
+        self._pending = {}
+
+    def close(self):
+        self.clear()
+        if self._flush_id:
+            glib.source_remove(self._flush_id)
+            self._flush_id = 0
+
+    def _monitor(self, directory, prefix):
+        import gio
+        try:
+            monitor = gio.File(directory).monitor_directory()
+        except gio.Error:
+            # e.g. directory doesn't exist or we ran out of inotify watches
+            return None
+        monitor.connect('changed', self._on_changed, prefix)
+        return monitor
+
+    def _on_changed(self, monitor, file, other_file, event_type, prefix):
+        import gio
+        if event_type in (gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT, gio.FILE_MONITOR_EVENT_CREATED):
+            event = CHANGED
+        elif event_type == gio.FILE_MONITOR_EVENT_DELETED:
+            event = DELETED
+        else:
+            return
+        entry = self._directories.get(prefix)
+        if entry is None:
+            return
+        path = file.get_path()
+        uris = self._uris_func(prefix)
+        if path != entry[1]:
+            # unless the directory itself is gone
+            uris = [uri for uri in uris if uri_to_path(uri) == path]
+            if not uris:
+                return
+        for uri in uris:
+            self._pending[uri] = event
+        if not self._flush_id:
+            self._flush_id = glib.timeout_add(COALESCE_DELAY, self._flush)
+
+    def _flush(self):
+        self._flush_id = 0
+        changed = []
+        deleted = []
+        for uri, event in self._pending.iteritems():
+            if event == CHANGED:
+                changed.append(uri)
+            else:
+                deleted.append(uri)
+        self._pending = {}
+        if changed or deleted:
+            self._callback(changed, deleted)
+        return False
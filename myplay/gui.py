@@ -18,41 +18,36 @@
 #
 import ConfigParser
 
-import dbus
 import dbus.mainloop.glib
 import os
-import gio
 import glib
 import gtk
-import gst
 
-from myplay.common import BUS_NAME, OBJECT_IFACE, OBJECT_PATH
+from myplay.client import Client
 from myplay.common import STATE_READY, STATE_PLAYING, STATE_PAUSED, CURRENT_UNSET
+from myplay.common import uri_to_path
+from myplay.playlistmodel import PlaylistModel
 
 DND_REODER = 0
 DND_ADD = 1
 
-COL_CURRENT = 0
-COL_URI = 1
-COL_DISPLAY_PATH = 2
-COL_TITLE = 3
-COL_ARTIST = 4
-COL_ALBUM = 5
+# playlist changes of more rows than this are done with view detached from the model
+BULK_UPDATE_ROWS = 100
 
 class Application(object):
 
     def __init__(self):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(BUS_NAME, OBJECT_PATH, follow_name_owner_changes=True)
-        self._player = dbus.Interface(proxy, OBJECT_IFACE)
-        bus.add_signal_receiver(self.on_added_signal, 'Added', OBJECT_IFACE)
-        bus.add_signal_receiver(self.on_removed_signal, 'Removed', OBJECT_IFACE)
-        bus.add_signal_receiver(self.on_cleared_signal, 'Cleared', OBJECT_IFACE)
-        bus.add_signal_receiver(self.on_reordered_signal, 'Reordered', OBJECT_IFACE)
-        bus.add_signal_receiver(self.on_current_changed_signal, 'CurrentChanged', OBJECT_IFACE)
-        bus.add_signal_receiver(self.on_state_changed_signal, 'StateChanged', OBJECT_IFACE)
-        bus.add_signal_receiver(self.on_tag_changed_signal, 'TagChanged', OBJECT_IFACE)
+        # the playlist itself is fetched by the model page by page
+        self._client = Client(mirror_playlist=False)
+        self._client.connect('reset', self.on_client_reset)
+        self._client.connect('added', self.on_client_added)
+        self._client.connect('removed', self.on_client_removed)
+        self._client.connect('cleared', self.on_client_cleared)
+        self._client.connect('reordered', self.on_client_reordered)
+        self._client.connect('current-changed', self.on_client_current_changed)
+        self._client.connect('state-changed', self.on_client_state_changed)
+        self._client.connect('tags-changed', self.on_client_tags_changed)
         
         builder = gtk.Builder()
         builder.add_from_file(os.path.join(os.path.dirname(__file__), 'gui.ui'))
@@ -65,7 +60,8 @@ class Application(object):
         selection.set_mode(gtk.SELECTION_MULTIPLE)
         selection.connect('changed', self.on_selection_changed)
         
-        self._playlist_view.enable_model_drag_source(
+        # playlist model doesn't implement GtkTreeDragSource, so drag the whole view
+        self._playlist_view.drag_source_set(
             gtk.gdk.BUTTON1_MASK,
             [('positions', gtk.TARGET_SAME_WIDGET, DND_REODER)],
             gtk.gdk.ACTION_DEFAULT|gtk.gdk.ACTION_MOVE)
@@ -77,7 +73,7 @@ class Application(object):
             gtk.gdk.ACTION_DEFAULT)
         self._playlist_view.connect('drag-data-received', self.on_drag_data_received)
         
-        self._playlist_store = builder.get_object('playlist_store')
+        self._playlist_store = PlaylistModel(self._client)
 
         self._playlist_store.connect('row-inserted', self._update_clear_button)
         self._playlist_store.connect('row-deleted', self._update_clear_button)
@@ -151,10 +147,9 @@ class Application(object):
         if self._window_config['maximized']:
             self._window.maximize()
 
-        self._update_state(self._player.GetState())
-        current = self._player.GetCurrent()
-        self._update_playlist(self._player.List(), current)
-        self._set_current(current)
+        # actual state is shown when the client loads it
+        self._update_state(STATE_READY)
+        self._set_current(CURRENT_UNSET)
 
     def _update_clear_button(self, *args):
         if self._get_playlist_length():
@@ -180,25 +175,29 @@ class Application(object):
             a['stop'].set_sensitive(True)
             self._play_pause_button.set_related_action(a['play'])
     
-    def _get_path_or_uri(self, uri):
-        if uri.startswith('file://'):
-            return gio.File(uri=uri).get_path() or uri
-        return uri
-    
-    def _update_playlist(self, list, current):
-        self._playlist_store.clear()
-        for i, track in enumerate(list):
-            row = self._make_row(*track)
-            row[COL_CURRENT] = (i == current) and 'gtk-media-play' or None
-            self._playlist_store.append(row)
+    def _update_playlist(self, length, current):
+        self._update_detached(self._playlist_store.reset, length, current)
+
+    def _update_detached(self, func, *args):
+        """Call func with the view detached, so no signals are emitted for every changed row"""
+        vadjustment = self._playlist_view.get_vadjustment()
+        value = vadjustment.get_value()
+        self._playlist_view.set_model(None)
+        self._playlist_store.detached = True
+        try:
+            func(*args)
+        finally:
+            self._playlist_store.detached = False
+        self._playlist_view.set_model(self._playlist_store)
+        vadjustment.set_value(value)
+        # the model didn't emit row-inserted and row-deleted
+        self._update_clear_button()
 
     def _get_playlist_length(self):
         return self._playlist_store.iter_n_children(None)
 
     def _set_current(self, value):
-        def func(model, path, iter):
-            model.set(iter, COL_CURRENT, 'gtk-media-play' if (path[0] == value) else None)
-        self._playlist_store.foreach(func)
+        self._playlist_store.set_current(value)
         playlist_len = self._get_playlist_length()
         if value == CURRENT_UNSET or playlist_len == 0:
             self._actions['next'].set_sensitive(False)
@@ -218,61 +217,45 @@ class Application(object):
         gtk.main()
 
     def quit(self):
+        self._client.close()
         gtk.main_quit()
 
-    def on_tag_changed_signal(self, uri, tag):
-        def func(model, path, iter):
-            row_uri, row_path = model.get(iter, 1, 2)
-            if row_uri == uri:
-                cols = (
-                    COL_TITLE, tag.get(gst.TAG_TITLE) or row_path,
-                    COL_ARTIST, tag.get(gst.TAG_ARTIST),
-                    COL_ALBUM, tag.get(gst.TAG_ALBUM),
-                )
-                model.set(iter, *cols)
-        self._playlist_store.foreach(func)
-
-    def on_state_changed_signal(self, old_state, new_state):
+    def on_client_reset(self, client):
+        self._update_playlist(client.length, client.current)
+        self._set_current(client.current)
+        self._update_state(client.state)
+
+    def on_client_tags_changed(self, client, tracks):
+        self._playlist_store.update_tags(dict(tracks))
+
+    def on_client_state_changed(self, client, old_state, new_state):
         self._update_state(new_state)
     
-    def on_current_changed_signal(self, old_current, new_current):
+    def on_client_current_changed(self, client, old_current, new_current):
         self._set_current(new_current)
 
-    def _make_row(self, uri, tag):
-        uri = str(uri)
-        path = self._get_path_or_uri(uri)
-        title = tag.get(gst.TAG_TITLE) or path
-        artist = tag.get(gst.TAG_ARTIST)
-        album = tag.get(gst.TAG_ALBUM)
-        return [None, uri, path, title, artist, album]
-
-    def on_added_signal(self, tracks, position):
-        first, tracks = tracks[0], tracks[1:]
-        if position == self._get_playlist_length():
-            iter = self._playlist_store.append(self._make_row(*first))
+    def on_client_added(self, client, position, tracks):
+        if len(tracks) > BULK_UPDATE_ROWS:
+            self._update_detached(self._playlist_store.insert, position, tracks)
         else:
-            before = self._playlist_store.get_iter((position, ))
-            iter = self._playlist_store.insert_before(before, self._make_row(*first))
-        for track in tracks:
-            iter = self._playlist_store.insert_after(iter, self._make_row(*track))
-        if self._player.GetState() != STATE_PLAYING:
+            self._playlist_store.insert(position, tracks)
+        if client.state != STATE_PLAYING:
             self._actions['play'].set_sensitive(True)
     
-    def on_removed_signal(self, positions):
-        iters = []
-        for pos in positions:
-            iters.append(self._playlist_store.get_iter((pos, )))
-        for iter in iters:
-            self._playlist_store.remove(iter)
+    def on_client_removed(self, client, positions):
+        if len(positions) > BULK_UPDATE_ROWS:
+            self._update_detached(self._playlist_store.remove, positions)
+        else:
+            self._playlist_store.remove(positions)
         if not self._get_playlist_length():
             self._actions['play'].set_sensitive(False)
     
-    def on_cleared_signal(self):
-        self._playlist_store.clear()
+    def on_client_cleared(self, client):
+        self._update_detached(self._playlist_store.clear)
         self._actions['play'].set_sensitive(False)
     
-    def on_reordered_signal(self, positions):
-        self._playlist_store.reorder([int(p) for p in positions])
+    def on_client_reordered(self, client, positions):
+        self._playlist_store.reorder(positions)
 
     def on_add_action_activate(self, action):
         dialog = gtk.FileChooserDialog('Add files', self._window)
@@ -280,35 +263,35 @@ class Application(object):
         dialog.set_select_multiple(True)
         dialog.set_local_only(False)
         if dialog.run() == gtk.RESPONSE_OK:
-            self._player.Add(dialog.get_uris(), self._get_playlist_length())
+            self._client.add(dialog.get_uris(), self._get_playlist_length())
         dialog.destroy()
 
     def on_remove_action_activate(self, action):
         selection = self._playlist_view.get_selection()
         paths = selection.get_selected_rows()[1]
         if paths:
-            self._player.Remove([i[0] for i in paths])
+            self._client.remove([i[0] for i in paths])
 
     def on_clear_action_activate(self, action):
-        self._player.Clear()
+        self._client.clear()
 
     def on_previous_action_activate(self, action):
-        self._player.Previous()
+        self._client.previous()
     
     def on_next_action_activate(self, action):
-        self._player.Next()
+        self._client.next()
 
     def on_play_action_activate(self, action):
-        self._player.Play()
+        self._client.play()
 
     def on_pause_action_activate(self, action):
-        self._player.Pause()
+        self._client.pause()
 
     def on_stop_action_activate(self, action):
-        self._player.Stop()
+        self._client.stop()
 
     def on_playlist_view_row_activated(self, view, path, column):
-        self._player.SetCurrent(path[0], True)
+        self._client.set_current(path[0], True)
 
     def on_playlist_view_key_press_event(self, view, event):
         if gtk.gdk.keyval_name(event.keyval) == 'Delete':
@@ -338,9 +321,29 @@ class Application(object):
                 positions[p] = None
             positions[position:position] =  moved
             positions = [p for p in positions if p is not None]
-            self._player.Reorder(positions)
+            self._client.reorder(positions)
         elif info == DND_ADD:
-            self._player.Add(selection.get_uris(), position)
+            if position < 0:
+                position = self._get_playlist_length()
+            self._add_uris(selection.get_uris(), position)
+
+    def _add_uris(self, uris, position):
+        """Add files, then contents of directories, which are read by the player in background"""
+        files = []
+        directories = []
+        for uri in uris:
+            path = uri_to_path(uri)
+            if path is not None and os.path.isdir(path):
+                directories.append(uri)
+            else:
+                files.append(uri)
+        if files:
+            self._client.add(files, position)
+            position += len(files)
+        # jobs move their positions when something is inserted before or at
+        # them, so contents of directories end up in the order they were given
+        for uri in directories:
+            self._client.add_directory(uri, position, True)
 
     def on_main_window_configure_event(self, window, event):
         if not self._window_config['maximized']:
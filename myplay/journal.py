@@ -0,0 +1,308 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+import cPickle as pickle
+
+import glib
+
+from myplay.common import CURRENT_UNSET
+from myplay.stats import stats
+
+# delay in milliseconds before writing recorded operations to disk
+FLUSH_DELAY = 500
+
+# delay in milliseconds before writing sequence numbers taken by "advance",
+# when no operations are waiting to be written
+ADVANCE_FLUSH_DELAY = 30000
+
+# number of journal records after which the snapshot is rewritten
+COMPACT_THRESHOLD = 1000
+
+RECORD_HEADER = struct.Struct('<Ii')
+
+class InvalidRecord(Exception):
+    """Journal record doesn't fit the playlist it's applied to"""
+
+def apply_record(playlist, current, op, args, check=False):
+    """Apply journal operation to playlist and current, return new (playlist, current)
+
+    If check is true, positions of the operation are checked against the
+    playlist first and InvalidRecord is raised, without changing anything,
+    if they don't fit it.
+
+    """
+    if op == 'add':
+        position, uris = args
+        if check and position > len(playlist):
+            raise InvalidRecord(op, position)
+        playlist[position:position] = uris
+    elif op == 'remove':
+        positions = set(args[0])
+        if check and positions and max(positions) >= len(playlist):
+            raise InvalidRecord(op, max(positions))
+        playlist = [uri for i, uri in enumerate(playlist) if i not in positions]
+    elif op == 'reorder':
+        if check and sorted(args[0]) != range(len(playlist)):
+            raise InvalidRecord(op, len(args[0]))
+        playlist = [playlist[pos] for pos in args[0]]
+    elif op == 'clear':
+        playlist = []
+    elif op == 'current':
+        current = args[0]
+    elif op == 'batch':
+        if check:
+            # changes of a batch are applied all or none
+            playlist = list(playlist)
+        for batch_op, batch_args in args[0]:
+            playlist, current = apply_record(playlist, current, batch_op, batch_args, check)
+    # other operations, like 'skip' written for PlaylistJournal.advance or
+    # 'tags' of older versions, don't change the playlist
+    return playlist, current
+
+class PlaylistJournal(object):
+    """Playlist storage made of a snapshot and an append-only operation journal
+
+    Operations are recorded with the "record" method, collected in memory and
+    appended to the journal file in one write after a short delay, so the cost
+    of saving a change depends on the size of the change, not on the playlist
+    size. Every record carries a sequence number and a checksum, so a record
+    torn by a crash is detected and ignored when loading.
+
+    When the journal grows long enough, the playlist state, returned by the
+    snapshot_func callable as a (playlist, current) tuple, is written to the
+    snapshot file in a background thread. The journal is rotated before that,
+    and the old one is removed after the snapshot is safely renamed in place.
+    Records with sequence numbers already covered by the snapshot are skipped
+    when loading, so a crash in any moment of this process is harmless.
+
+    Changes that aren't saved, like tag updates, only take sequence numbers
+    with "advance". Consecutive numbers taken this way are written as one
+    small 'skip' record, which isn't counted for compaction, so sequence
+    numbers never go back after restart.
+
+    """
+
+    def __init__(self, path, snapshot_func):
+        self._snapshot_path = path
+        self._journal_path = path + '.journal'
+        self._old_journal_path = path + '.journal.old'
+        self._snapshot_func = snapshot_func
+        self._journal = None
+        self._pending = []
+        self._seq = 0
+        self._journal_records = 0
+        self._flush_id = 0
+        self._flush_delay = 0
+        self._compact_thread = None
+        self._compact_success = False
+
+    @property
+    def seq(self):
+        """Sequence number of the last recorded operation"""
+        return self._seq
+
+    def load(self, replay_func=None):
+        """Return (playlist, current) read from the snapshot and the journal
+
+        If replay_func is given, it's called with (seq, op, args) for every
+        journal record applied on top of the snapshot, except 'skip' ones.
+
+        If the snapshot can't be read, the journal is replayed on an empty
+        playlist, skipping records that don't fit it, so the service still
+        starts with what can be recovered.
+
+        """
+        playlist = []
+        current = CURRENT_UNSET
+        seq = 0
+        check = False
+        if os.path.exists(self._snapshot_path):
+            try:
+                data = pickle.load(open(self._snapshot_path, 'rb'))
+                playlist = data['playlist']
+                current = data['current']
+                seq = data.get('seq', 0)
+            except:
+                sys.stderr.write('myplay: playlist snapshot %s is corrupt\n' % self._snapshot_path)
+                check = True
+        for path in (self._old_journal_path, self._journal_path):
+            for record_seq, op, args in self._read_records(path):
+                if record_seq <= seq:
+                    continue
+                seq = record_seq
+                if op == 'skip':
+                    continue
+                try:
+                    playlist, current = apply_record(playlist, current, op, args, check)
+                except InvalidRecord, e:
+                    sys.stderr.write('myplay: skipped journal record %d: %s\n' % (seq, e))
+                    continue
+                if replay_func is not None:
+                    replay_func(seq, op, args)
+                self._journal_records += 1
+        self._seq = seq
+        return playlist, current
+
+    def _read_records(self, path):
+        if not os.path.exists(path):
+            return
+        f = open(path, 'r+b')
+        try:
+            while True:
+                offset = f.tell()
+                header = f.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                data = ''
+                if len(header) == RECORD_HEADER.size:
+                    length, crc = RECORD_HEADER.unpack(header)
+                    data = f.read(length)
+                if not data or len(data) < length or zlib.crc32(data) != crc:
+                    # torn write, cut it off so new records can be appended
+                    f.truncate(offset)
+                    break
+                yield pickle.loads(data)
+        finally:
+            f.close()
+
+    def record(self, op, *args):
+        self._seq += 1
+        self._pending.append((self._seq, op, args))
+        self._schedule_flush(FLUSH_DELAY)
+
+    def advance(self):
+        """Take the next sequence number for a change that isn't recorded"""
+        self._seq += 1
+        if self._pending and self._pending[-1][1] == 'skip':
+            self._pending[-1] = (self._seq, 'skip', ())
+        else:
+            self._pending.append((self._seq, 'skip', ()))
+        self._schedule_flush(ADVANCE_FLUSH_DELAY)
+
+    def _schedule_flush(self, delay):
+        if self._flush_id:
+            if self._flush_delay <= delay:
+                return
+            glib.source_remove(self._flush_id)
+        self._flush_delay = delay
+        self._flush_id = glib.timeout_add(delay, self._on_flush_timeout)
+
+    def _on_flush_timeout(self):
+        self._flush_id = 0
+        self.flush()
+        return False
+
+    def flush(self):
+        if self._flush_id:
+            glib.source_remove(self._flush_id)
+            self._flush_id = 0
+        if not self._pending:
+            return
+
+        if stats.enabled:
+            start = time.time()
+            stats.count('journal', 'records', len(self._pending))
+        chunks = []
+        for record in self._pending:
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            chunks.append(RECORD_HEADER.pack(len(data), zlib.crc32(data)))
+            chunks.append(data)
+            if record[1] != 'skip':
+                self._journal_records += 1
+        self._pending = []
+
+        if self._journal is None:
+            self._journal = open(self._journal_path, 'ab')
+        data = ''.join(chunks)
+        self._journal.write(data)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        if stats.enabled:
+            stats.observe('journal.flush', time.time() - start)
+            stats.count('journal', 'bytes_written', len(data))
+
+        if self._journal_records >= COMPACT_THRESHOLD and self._compact_thread is None:
+            self._compact()
+
+    def _compact(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self._old_journal_path):
+            # previous compaction failed, keep its records too
+            old = open(self._old_journal_path, 'ab')
+            old.write(open(self._journal_path, 'rb').read())
+            old.close()
+            os.unlink(self._journal_path)
+        elif os.path.exists(self._journal_path):
+            os.rename(self._journal_path, self._old_journal_path)
+        self._journal_records = 0
+
+        playlist, current = self._snapshot_func()
+        self._compact_thread = threading.Thread(
+            target=self._write_snapshot,
+            args=(list(playlist), current, self._seq))
+        self._compact_thread.setDaemon(True)
+        self._compact_thread.start()
+
+    def _write_snapshot(self, playlist, current, seq):
+        start = time.time()
+        tmp_path = self._snapshot_path + '.tmp'
+        try:
+            f = open(tmp_path, 'wb')
+            try:
+                data = {'playlist': playlist, 'current': current, 'seq': seq}
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            finally:
+                f.close()
+            os.rename(tmp_path, self._snapshot_path)
+            if stats.enabled:
+                stats.observe('journal.snapshot', time.time() - start)
+                stats.count('journal', 'snapshot_bytes_written', size)
+        except EnvironmentError:
+            self._compact_success = False
+        else:
+            self._compact_success = True
+        glib.idle_add(self._on_compacted)
+
+    def _on_compacted(self):
+        if self._compact_thread is None:
+            # already finished by close()
+            return False
+        self._compact_thread = None
+        if self._compact_success and os.path.exists(self._old_journal_path):
+            os.unlink(self._old_journal_path)
+        return False
+
+    def close(self):
+        self.flush()
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+            self._on_compacted()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -16,18 +16,64 @@
 # You should have received a copy of the GNU General Public License
 # along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
 #
+import Queue
+import cProfile
 import os
-import cPickle as pickle
+import threading
+import time
+from array import array
 
+import dbus
 import dbus.service
 import glib
-import gst
 
 from myplay.common import OBJECT_IFACE, CURRENT_UNSET, STATE_READY, STATE_PLAYING, STATE_PAUSED
-from myplay.tagscanner import TagScanner
+from myplay.common import uri_to_path
+from myplay.changelog import ChangeLog
+from myplay.chunkreader import ChunkReader
+from myplay.dirwalk import walk_audio_uris
+from myplay.filewatch import FileWatcher
+from myplay.journal import PlaylistJournal
+from myplay.playlist import Playlist
+from myplay.playlistio import get_format, read_playlist, write_playlist
+from myplay.playorder import PlayOrder, position_after_insert, position_after_remove
+from myplay.searchindex import SearchIndex
+from myplay.sortkeys import SortKeyCache, SORT_KEYS
+from myplay.stats import stats
+from myplay.streamcache import StreamCache
+from myplay.tagcache import TagCache
+from myplay.tagscanner import TagScanner, PRIORITY_PLAYING, PRIORITY_VISIBLE
+from myplay.trackstore import TrackStore, TagMap
 
 GST_PLAY_FLAG_AUDIO = 1 << 1
 
+TAG_CACHE_SAVE_DELAY = 30
+
+# number of playlist entries whose cached tags are checked in one idle callback
+# after the service has started
+STARTUP_SCAN_BATCH = 500
+
+# number of tracks added to the search index and given sort keys and of
+# playlist entries added to the positions index in one idle callback, see
+# _on_index_idle
+INDEX_BATCH = 200
+POSITIONS_INDEX_BATCH = 20000
+
+# number of playlist entries passed to the thread writing ExportPlaylist
+# file at once, and number of such chunks made ahead
+EXPORT_CHUNK = 500
+EXPORT_PENDING_CHUNKS = 2
+
+# number of seconds the player keeps from becoming idle while tags are being
+# scanned, after everything else is done, 0 doesn't wait for the scan and a
+# negative value waits until it's finished
+IDLE_SCAN_TIME = 600
+
+# TagsChanged signal is emitted after this number of milliseconds since first
+# change, or when this number of tracks changed, whichever comes first
+TAGS_CHANGED_DELAY = 500
+TAGS_CHANGED_MAX = 1000
+
 class InvalidPosition(dbus.service.DBusException):
     _dbus_error_name = 'org.nadako.myplay.InvalidPosition'
 
@@ -37,6 +83,117 @@ class InvalidLength(dbus.service.DBusException):
 class EmptySequence(dbus.service.DBusException):
     _dbus_error_name = 'org.nadako.myplay.EmptySequence'
 
+class InvalidSortKey(dbus.service.DBusException):
+    _dbus_error_name = 'org.nadako.myplay.InvalidSortKey'
+
+class InvalidUri(dbus.service.DBusException):
+    _dbus_error_name = 'org.nadako.myplay.InvalidUri'
+
+class InvalidJob(dbus.service.DBusException):
+    _dbus_error_name = 'org.nadako.myplay.InvalidJob'
+
+class InvalidOperation(dbus.service.DBusException):
+    _dbus_error_name = 'org.nadako.myplay.InvalidOperation'
+
+class UnsupportedFormat(dbus.service.DBusException):
+    _dbus_error_name = 'org.nadako.myplay.UnsupportedFormat'
+
+class IOFailed(dbus.service.DBusException):
+    _dbus_error_name = 'org.nadako.myplay.IOFailed'
+
+def _check_permutation(positions, length):
+    """Raise InvalidLength or InvalidPosition unless positions are a permutation of range(length)"""
+    if len(positions) != length:
+        raise InvalidLength(len(positions))
+    seen = bytearray(length)
+    for pos in positions:
+        if pos < 0 or pos >= length or seen[pos]:
+            raise InvalidPosition(pos)
+        seen[pos] = 1
+
+class _AddJob(ChunkReader):
+    """Chunk reader keeping track of where to insert read uris"""
+
+    def __init__(self, job_id, position, uris, chunk_callback, finish_callback):
+        super(_AddJob, self).__init__(uris, chunk_callback, finish_callback)
+        self.job_id = job_id
+        self.position = position
+        self.added = 0
+
+class _ExportJob(object):
+    """Writes the playlist to a file in a worker thread
+
+    The playlist and the track store aren't thread-safe, so (uri, tags)
+    pairs are made in the main loop, in chunks of EXPORT_CHUNK entries
+    from a copy of track ids of the playlist, and the thread asks for the
+    next chunk when it starts writing one, so only a few chunks are in
+    memory at once. Tracks removed from the store meanwhile must be passed
+    to "forget" before their ids are reused.
+
+    When the file is written or writing failed, finish_callback(job, error)
+    is called from the main loop, with None or the exception.
+
+    """
+
+    def __init__(self, path, ids, store, finish_callback):
+        self._path = path
+        self._ids = array('I', ids)
+        self._store = store
+        self._finish_callback = finish_callback
+        self._offset = 0
+        self._gone = {}
+        self._chunks = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+
+    def start(self):
+        for i in xrange(EXPORT_PENDING_CHUNKS):
+            self._make_chunk()
+        self._thread.start()
+
+    def forget(self, tracks):
+        """Keep uris and tags of (track id, uri) pairs of tracks removed from the store"""
+        for track_id, uri in tracks:
+            if track_id not in self._gone:
+                self._gone[track_id] = (uri, self._store.get_tags(track_id) or {})
+
+    def _make_chunk(self):
+        ids = self._ids[self._offset:self._offset + EXPORT_CHUNK]
+        self._offset += len(ids)
+        store = self._store
+        chunk = []
+        for track_id in ids:
+            track = self._gone.get(track_id)
+            if track is None:
+                track = (store.uri(track_id), store.get_tags(track_id) or {})
+            chunk.append(track)
+        # an empty chunk ends the playlist
+        self._chunks.put(chunk)
+        return False
+
+    def _tracks(self):
+        while True:
+            chunk = self._chunks.get()
+            if not chunk:
+                return
+            glib.idle_add(self._make_chunk)
+            for track in chunk:
+                yield track
+
+    def _run(self):
+        error = None
+        try:
+            write_playlist(self._path, self._tracks())
+        except Exception, e:
+            error = e
+        finally:
+            # always reply and let the service become idle
+            glib.idle_add(self._on_finished, error)
+
+    def _on_finished(self, error):
+        self._finish_callback(self, error)
+        return False
+
 class Player(dbus.service.Object):
     
     @dbus.service.method(OBJECT_IFACE, out_signature='a(sa{ss})')
@@ -45,6 +202,86 @@ class Player(dbus.service.Object):
         for uri in self._playlist:
             res.append((uri, self._tags.get(uri, {})))
         return tuple(res)
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='tuiu')
+    def GetStatus(self):
+        """Return (version, state, current, length) at once"""
+        return self._journal.seq, self._state, self._current, len(self._playlist)
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='tuia(sa{ss})')
+    def GetSnapshot(self):
+        """Return (version, state, current, tracks) at once"""
+        return self._journal.seq, self._state, self._current, self.List()
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='uu', out_signature='a(sa{ss})')
+    def ListRange(self, offset, count):
+        if offset > len(self._playlist):
+            raise InvalidPosition(offset)
+        return tuple((uri, self._tags.get(uri, {})) for uri in self._playlist[offset:offset + count])
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='uu')
+    def HintVisible(self, offset, count):
+        """Scan tags of tracks shown by the client before the rest"""
+        self._prioritize_scan(self._playlist[offset:offset + count], PRIORITY_VISIBLE)
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='as')
+    def GetMissing(self):
+        """Return uris of playlist entries whose files are gone"""
+        return list(self._missing)
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='t')
+    def GetVersion(self):
+        """Return version of the playlist, increased by every change
+
+        Changes are playlist modifications, current track changes and tag
+        updates, that is, everything announced by the Added, Removed,
+        Cleared, Reordered, CurrentChanged and TagsChanged signals.
+
+        """
+        return self._journal.seq
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='t', out_signature='bta(tsv)')
+    def GetChangesSince(self, version):
+        """Return (resync, version, changes) for changes made after given version
+
+        Each change is a (version, operation, arguments) struct, where
+        arguments are (position, tracks) for 'add', positions for 'remove'
+        and 'reorder', an empty array for 'clear', position for 'current' and
+        tracks for 'tags'. Tracks are (uri, tags) pairs with current tags.
+
+        If the changes are no longer known, resync is true and the client
+        should reload the whole playlist.
+
+        """
+        current_version = self._journal.seq
+        if version == current_version:
+            return False, current_version, []
+        changes = self._changes.since(version)
+        if changes is None:
+            return True, current_version, []
+        return False, current_version, [self._change_to_dbus(*change) for change in changes]
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='su', out_signature='au')
+    def Find(self, query, limit):
+        """Return up to limit sorted positions of entries matching query
+
+        Entries match if for every word of the query their title, artist,
+        album or path has a word starting with it, case-insensitively.
+        The index is built by the first query, then kept up to date while
+        the service is idle, so tracks added right before a query may be
+        found only by the next ones.
+
+        """
+        if not self._search_built:
+            # not built at start, as the service often quits before any
+            # query, but once, by the first one
+            self._search_built = True
+            self._index(self._playlist.unique())
+        return self._search_index.find(query.encode('utf-8'), self._playlist, limit)
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='u')
+    def GetLength(self):
+        return len(self._playlist)
     
     @dbus.service.method(OBJECT_IFACE, in_signature='asu')
     def Add(self, uris, position):
@@ -53,16 +290,72 @@ class Player(dbus.service.Object):
         if position < 0 or position > len(self._playlist):
             raise InvalidPosition(position)
 
-        uris = [str(uri) for uri in uris]
-        self._playlist[position:position] = uris
-        self._save_playlist()
-        
-        add_info = [(uri, self._tags.get(uri, {})) for uri in uris]
-        self.Added(add_info, position)
+        self._insert(int(position), [str(uri) for uri in uris])
 
-        no_tags = [uri for uri, tag in add_info if not tag]
-        if no_tags:
-            self._tag_scanner.add(no_tags)
+    @dbus.service.method(OBJECT_IFACE, in_signature='sub', out_signature='u')
+    def AddDirectory(self, uri, position, recursive):
+        """Start adding audio files from directory, return id of the job
+
+        The directory is read in a background thread, found files are added
+        in chunks, each announced with the Added signal followed by
+        AddProgress. AddFinished is emitted when the job is done or cancelled,
+        preceded by AddFailed if reading stopped on an error.
+
+        """
+        if position < 0 or position > len(self._playlist):
+            raise InvalidPosition(position)
+        path = uri_to_path(str(uri))
+        if path is None or not os.path.isdir(path):
+            raise InvalidUri(uri)
+        return self._start_job(int(position), walk_audio_uris(path, recursive))
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='su', out_signature='u')
+    def ImportPlaylist(self, path, position):
+        """Start adding entries of M3U, PLS or XSPF playlist, return id of the job
+
+        The playlist is read in the background like directories in AddDirectory.
+
+        """
+        if position < 0 or position > len(self._playlist):
+            raise InvalidPosition(position)
+        path = str(path)
+        if get_format(path) is None:
+            raise UnsupportedFormat(path)
+        if not os.path.isfile(path):
+            raise InvalidUri(path)
+        return self._start_job(int(position), read_playlist(path))
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='s',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def ExportPlaylist(self, path, reply_handler, error_handler):
+        """Write playlist to M3U, PLS or XSPF file, chosen by extension"""
+        path = str(path)
+        if get_format(path) is None:
+            raise UnsupportedFormat(path)
+        # the playlist is written as it is now, while it can change
+        def finished(job, error):
+            self._exports.remove(job)
+            self._update_idle()
+            if error is None:
+                reply_handler()
+            elif isinstance(error, EnvironmentError):
+                error_handler(IOFailed(str(error)))
+            else:
+                # passed to the caller as org.freedesktop.DBus.Python error
+                error_handler(error)
+        job = _ExportJob(path, self._playlist.ids(), self._store, finished)
+        self._exports.append(job)
+        self._update_idle()
+        job.start()
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='u')
+    def CancelAdd(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            raise InvalidJob(job_id)
+        job.cancel()
+        self._emit('AddFinished', job_id, job.added, True)
+        self._update_idle()
     
     @dbus.service.method(OBJECT_IFACE, in_signature='au')
     def Remove(self, positions):
@@ -73,41 +366,173 @@ class Player(dbus.service.Object):
             if pos < 0 or pos >= playlist_len:
                 raise InvalidPosition(pos)
 
-        self._playlist[:] = [uri for i, uri in enumerate(self._playlist) if i not in positions]
-        self._save_playlist()
-        self.Removed(positions)
+        # signals and the journal get every position once, so mirrors
+        # of the playlist can subtract their number from the length
+        positions = sorted(set(int(pos) for pos in positions))
+        gone = self._playlist.remove(positions)
+        self._record('remove', positions)
+        # ids of tracks that are gone are reused by next inserts, so
+        # forget what's kept by their ids right away
+        self._tag_cache.retire(gone)
+        for job in self._exports:
+            job.forget(gone)
+        for track_id, uri in gone:
+            self._search_index.remove(track_id)
+            self._sort_keys.invalidate(track_id)
+        gone = [uri for track_id, uri in gone]
+        self._file_watcher.remove(gone)
+        self._missing.difference_update(gone)
+        self._schedule_indexing()
+        queue_changed = self._play_order.remove(positions, playlist_len)
+        for job in self._jobs.itervalues():
+            job.position -= len([pos for pos in positions if pos < job.position])
+        self._emit('Removed', positions)
+        if queue_changed:
+            self._emit('QueueChanged', self._play_order.queue)
 
-        if self._current in positions:
-            self.SetCurrent(CURRENT_UNSET)
+        if self._current != CURRENT_UNSET:
+            new_current = position_after_remove(self._current, positions)
+            if new_current is None:
+                self.SetCurrent(CURRENT_UNSET)
+            else:
+                self._follow_current(new_current)
+        self._update_next()
     
     @dbus.service.method(OBJECT_IFACE)
     def Clear(self):
-        self._playlist[:] = []
-        self._save_playlist()
-        self.Cleared()
+        gone = [(track_id, self._store.uri(track_id)) for track_id in self._store.ids()]
+        self._tag_cache.retire(gone)
+        for job in self._exports:
+            job.forget(gone)
+        self._playlist.clear()
+        self._record('clear')
+        self._file_watcher.clear()
+        self._missing.clear()
+        self._search_index.clear()
+        self._index_uris = []
+        self._sort_keys.clear()
+        queue_changed = self._play_order.clear()
+        for job in self._jobs.itervalues():
+            job.position = 0
+        self._emit('Cleared')
+        if queue_changed:
+            self._emit('QueueChanged', self._play_order.queue)
         self.SetCurrent(CURRENT_UNSET)
+        self._update_next()
     
     @dbus.service.method(OBJECT_IFACE, in_signature='au')
     def Reorder(self, positions):
         if not positions:
             raise EmptySequence
-        playlist_len = len(self._playlist)
-        if len(positions) != playlist_len:
-            raise InvalidLength(self._playlist)
+        positions = [int(pos) for pos in positions]
+        # a repeated position would drop entries without releasing them
+        _check_permutation(positions, len(self._playlist))
 
-        new_playlist = []
-        for pos in positions:
-            if pos < 0 or pos >= playlist_len:
-                raise InvalidPosition(pos)
-            new_playlist.append(self._playlist[pos])
+        new_current = CURRENT_UNSET
+        if self._current != CURRENT_UNSET:
+            new_current = positions.index(self._current)
 
-        self._playlist[:] = new_playlist
-        self._save_playlist()
+        self._playlist.reorder(positions)
+        self._record('reorder', positions)
+        self._schedule_indexing()
+        queue_changed = self._play_order.reorder(positions)
 
-        self.Reordered(positions)
-    
-        if self._current != CURRENT_UNSET:
-            self._change_current(positions.index(self._current), True)
+        self._emit('Reordered', positions)
+        if queue_changed:
+            self._emit('QueueChanged', self._play_order.queue)
+
+        self._follow_current(new_current)
+        self._update_next()
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='asb')
+    def SortBy(self, keys, descending):
+        """Sort playlist by list of keys: artist, album, title or path
+
+        Entries are compared case-insensitively using the collation of the
+        service's locale, entries with equal keys keep their order. The
+        playlist is reordered like with Reorder.
+
+        """
+        if not keys:
+            raise EmptySequence
+        keys = [str(key) for key in keys]
+        for key in keys:
+            if key not in SORT_KEYS:
+                raise InvalidSortKey(key)
+        # computes keys missing yet, all of them the first time
+        self._sort_keys_built = True
+        if self._playlist:
+            self.Reorder(self._sort_keys.sorted_positions(self._playlist, keys, descending))
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='a(sv)')
+    def Execute(self, ops):
+        """Apply a list of (operation, arguments) pairs at once
+
+        Operations and their arguments are:
+
+         * add: (position, uris), like Add
+         * remove: positions, like Remove
+         * reorder: positions, like Reorder
+         * move: (positions, position), move entries at positions, in given
+           order, so they start at position of the playlist without them
+         * clear, next, previous, play, pause, stop: arguments are ignored
+         * current: position, like SetCurrent without playing
+
+        Positions refer to the playlist as left by previous operations. All
+        operations are validated first, so either all of them are applied,
+        or an error is raised and nothing is changed. Changes are recorded
+        as one version, their signals are emitted after all operations are
+        applied, followed by the Executed signal with the new version.
+        Playback is changed only after that.
+
+        """
+        ops = self._validate_ops(ops)
+        if not ops:
+            return
+
+        self._batch = []
+        self._batch_signals = []
+        self._batch_stream_changed = False
+        old_current = self._current
+        state_op = None
+        try:
+            for op, args in ops:
+                if op == 'add':
+                    self.Add(args[1], args[0])
+                elif op == 'remove':
+                    self.Remove(args)
+                elif op == 'reorder':
+                    self.Reorder(args)
+                elif op == 'move':
+                    self.Reorder(self._move_positions(*args))
+                elif op == 'clear':
+                    self.Clear()
+                elif op == 'current':
+                    self.SetCurrent(args)
+                elif op == 'next':
+                    self.Next()
+                elif op == 'previous':
+                    self.Previous()
+                else:
+                    state_op = op
+        finally:
+            records, self._batch = self._batch, None
+            signals, self._batch_signals = self._batch_signals, None
+
+        if records:
+            self._record('batch', records)
+        for signal, args in self._coalesce_signals(signals, old_current):
+            self._emit(signal, *args)
+        self._emit('Executed', self._journal.seq)
+
+        if self._batch_stream_changed:
+            self._update_pipeline()
+        if state_op == 'play':
+            self.Play()
+        elif state_op == 'pause':
+            self.Pause()
+        elif state_op == 'stop':
+            self.Stop()
 
     @dbus.service.method(OBJECT_IFACE, out_signature='i')
     def GetCurrent(self):
@@ -124,48 +549,161 @@ class Player(dbus.service.Object):
 
     @dbus.service.method(OBJECT_IFACE)
     def Next(self):
-        if self._current != CURRENT_UNSET and not self._current_is_last():
-            self._change_current(self._current + 1)
+        position = self._next_position()
+        if position != CURRENT_UNSET:
+            self._change_current(position)
     
     @dbus.service.method(OBJECT_IFACE)
     def Previous(self):
-        if self._current != CURRENT_UNSET and not self._current_is_first():
-            self._change_current(self._current - 1)
+        position = self._play_order.previous(self._current)
+        if position != CURRENT_UNSET:
+            self._change_current(position)
     
     @dbus.service.method(OBJECT_IFACE)
     def Play(self):
         if self._state != STATE_PLAYING:
             if self._current == CURRENT_UNSET:
                 if self._playlist:
-                    self._change_current(0)
+                    self._change_current(self._play_order.first())
                 else:
                     return
+            import gst
+            pipeline = self._get_pipeline()
             if self._state == STATE_READY:
-                self._player.set_property('uri', self._playlist[self._current])
-            self._player.set_state(gst.STATE_PLAYING)
+                pipeline.set_property('uri', self._playback_uri(self._playlist[self._current]))
+            self._set_pipeline_state(gst.STATE_PLAYING)
             self._change_state(STATE_PLAYING)
 
     @dbus.service.method(OBJECT_IFACE)
     def Pause(self):
         if self._state == STATE_PLAYING:
-            self._player.set_state(gst.STATE_PAUSED)
+            import gst
+            self._set_pipeline_state(gst.STATE_PAUSED)
             self._change_state(STATE_PAUSED)
     
     @dbus.service.method(OBJECT_IFACE)
     def Stop(self):
         if self._state != STATE_READY:
-            self._player.set_state(gst.STATE_NULL)
+            import gst
+            self._set_pipeline_state(gst.STATE_NULL)
+            self._cancel_gapless()
             self._player.set_property('uri', '')
+            if self._stream_cache is not None:
+                self._stream_cache.abort_downloads()
             self._change_state(STATE_READY)
 
     @dbus.service.method(OBJECT_IFACE, out_signature='u')
     def GetState(self):
         return self._state
 
+    @dbus.service.method(OBJECT_IFACE, in_signature='b')
+    def SetShuffle(self, shuffle):
+        """Turn shuffle on or off, a new random order starts with the current entry"""
+        shuffle = bool(shuffle)
+        if shuffle != self._play_order.shuffle:
+            self._play_order.set_shuffle(shuffle, len(self._playlist), self._current)
+            self._emit('ShuffleChanged', shuffle)
+            self._update_next()
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='b')
+    def GetShuffle(self):
+        return self._play_order.shuffle
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='au')
+    def Enqueue(self, positions):
+        """Append positions to the queue of entries played next"""
+        if not positions:
+            raise EmptySequence
+        playlist_len = len(self._playlist)
+        for pos in positions:
+            if pos < 0 or pos >= playlist_len:
+                raise InvalidPosition(pos)
+        self._play_order.enqueue([int(pos) for pos in positions])
+        self._emit('QueueChanged', self._play_order.queue)
+        self._update_next()
+
+    @dbus.service.method(OBJECT_IFACE)
+    def ClearQueue(self):
+        if self._play_order.clear_queue():
+            self._emit('QueueChanged', self._play_order.queue)
+            self._update_next()
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='au')
+    def GetQueue(self):
+        return dbus.Array(self._play_order.queue, signature='u')
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='b')
+    def SetStatsEnabled(self, enabled):
+        """Turn collecting of statistics on or off, turning it on resets them"""
+        if enabled and not stats.enabled:
+            stats.reset()
+        stats.enabled = bool(enabled)
+
+    @dbus.service.method(OBJECT_IFACE, out_signature='a{sa{sd}}')
+    def GetStats(self):
+        """Return {name: {field: value}} of service statistics
+
+        Counter groups are "signals" (emitted signals per name), "journal"
+        (records and bytes written) and "scan" (files scanned by the fast
+        reader and pipelines). Histograms, with count, total, mean, min,
+        max and percentiles in milliseconds, are "method.NAME" (D-BUS
+        method call latency), "scan.fast" and "scan.pipeline" (time per
+        file), "journal.flush", "journal.snapshot" and "pipeline.STATE"
+        (time for playback pipeline to reach the state). Current sizes are
+        always returned in "queues", the rest only while statistics are
+        enabled.
+
+        """
+        result = stats.to_dict()
+        queues = {
+            'scan_queue': self._tag_scanner.queued,
+            'scanning': self._tag_scanner.scanning,
+            'add_jobs': len(self._jobs),
+            'playlist': len(self._playlist),
+            'changed_tags': len(self._changed_tags),
+        }
+        result['queues'] = dict((name, float(value)) for name, value in queues.iteritems())
+        return dbus.Dictionary(result, signature='sa{sd}')
+
+    @dbus.service.method(OBJECT_IFACE, in_signature='s')
+    def StartProfiling(self, path):
+        """Start profiling the service, results are written to path by StopProfiling"""
+        if self._profile is not None:
+            raise InvalidOperation('already profiling')
+        self._profile_path = str(path)
+        self._profile = cProfile.Profile()
+        self._update_idle()
+        self._profile.enable()
+
+    @dbus.service.method(OBJECT_IFACE)
+    def StopProfiling(self):
+        """Stop profiling, write cProfile stats to the path given to StartProfiling"""
+        if self._profile is None:
+            raise InvalidOperation('not profiling')
+        profile, self._profile = self._profile, None
+        profile.disable()
+        self._update_idle()
+        try:
+            profile.dump_stats(self._profile_path)
+        except EnvironmentError, e:
+            raise IOFailed(str(e))
+
     @dbus.service.signal(OBJECT_IFACE, signature='a(sa{ss})i')
     def Added(self, tracks, position):
         pass
     
+    @dbus.service.signal(OBJECT_IFACE, signature='uu')
+    def AddProgress(self, job_id, added):
+        pass
+
+    @dbus.service.signal(OBJECT_IFACE, signature='uub')
+    def AddFinished(self, job_id, added, cancelled):
+        pass
+
+    @dbus.service.signal(OBJECT_IFACE, signature='us')
+    def AddFailed(self, job_id, error):
+        """Emitted before AddFinished when reading of the directory or playlist failed"""
+
     @dbus.service.signal(OBJECT_IFACE, signature='au')
     def Removed(self, positions):
         pass
@@ -186,35 +724,133 @@ class Player(dbus.service.Object):
     def StateChanged(self, old_state, new_state):
         pass
 
+    @dbus.service.signal(OBJECT_IFACE, signature='t')
+    def Executed(self, version):
+        pass
+
+    @dbus.service.signal(OBJECT_IFACE, signature='b')
+    def ShuffleChanged(self, shuffle):
+        pass
+
+    @dbus.service.signal(OBJECT_IFACE, signature='au')
+    def QueueChanged(self, positions):
+        pass
+
+    @dbus.service.signal(OBJECT_IFACE, signature='asas')
+    def MissingChanged(self, missing, restored):
+        pass
+
     @dbus.service.signal(OBJECT_IFACE, signature='sa{ss}')
     def TagChanged(self, uri, tag_dict):
         pass
 
-    def __init__(self, idle_callback=None):
+    @dbus.service.signal(OBJECT_IFACE, signature='a(sa{ss})')
+    def TagsChanged(self, tracks):
+        pass
+
+    def __init__(self, idle_callback=None, scan_pipelines=1,
+                 tags_changed_delay=TAGS_CHANGED_DELAY, tags_changed_max=TAGS_CHANGED_MAX,
+                 tag_changed_signal=True, gapless=True, audio_sink=None,
+                 stream_cache_size=0, stats_enabled=False, idle_scan_time=IDLE_SCAN_TIME):
         super(Player, self).__init__()
+
+        stats.enabled = stats_enabled
+        self._profile = None
+        self._profile_path = None
+        self._state_change = None
         
-        self._tag_scanner = TagScanner(self._on_tag_scanned)
-        self._tags = {}
+        # remote files are cached while they are played, if enabled
+        self._stream_cache = None
+        resolve_func = None
+        if stream_cache_size > 0:
+            self._stream_cache = StreamCache(os.path.join(glib.get_user_cache_dir(), 'myplay', 'streams'),
+                                             stream_cache_size * 1024 * 1024)
+            resolve_func = self._stream_cache.lookup
+
+        self._changed_tags = {}
+        self._tags_changed_id = 0
+        self._tags_changed_delay = tags_changed_delay
+        self._tags_changed_max = tags_changed_max
+        self._tag_changed_signal = tag_changed_signal
+        self._tag_scanner = TagScanner(self._on_tag_scanned, scan_pipelines, resolve_func=resolve_func)
+        self._idle_scan_time = idle_scan_time
+        self._idle_scan_id = 0
+        self._idle_scan_expired = False
+        # uris of the playlist and tags of its tracks
+        self._store = TrackStore()
+        self._tags = TagMap(self._store)
         
         data_dir = os.path.join(glib.get_user_data_dir(), 'myplay')
         if not os.path.exists(data_dir):
             os.makedirs(data_dir)
         
-        self._playlist_path = os.path.join(data_dir, 'playlist')
+        self._journal = PlaylistJournal(os.path.join(data_dir, 'playlist'), self._get_playlist_state)
+        self._file_watcher = FileWatcher(self._on_files_changed, self._store.dir_uris)
+        self._search_index = SearchIndex()
+        self._search_built = False
+        # uris of tracks to add to the search index or compute sort keys
+        # of, see _on_index_idle
+        self._index_uris = []
+        self._index_id = 0
+        self._sort_keys = SortKeyCache(self._store)
+        # like the search index, sort keys are computed by the first SortBy
+        self._sort_keys_built = False
+        self._changes = ChangeLog()
+        self._missing = set()
 
         self._init_playlist()
-        if self._playlist:
-            self._tag_scanner.add(self._playlist)
-        
-        self._player = gst.element_factory_make('playbin2', 'player')
-        self._player.set_property('flags', GST_PLAY_FLAG_AUDIO)
-        player_bus = self._player.get_bus()
-        player_bus.add_signal_watch()
-        player_bus.connect('message', self._on_player_message)
+
+        # loads cached tags of the playlist tracks into the store, checking
+        # them against the files and scanning the rest is left for the main
+        # loop, so the first calls are answered as soon as the playlist is
+        # loaded
+        self._tag_cache = TagCache(os.path.join(data_dir, 'tags'), self._store)
+        self._tag_cache_timeout_id = 0
+
+        self._play_order_path = os.path.join(data_dir, 'playorder')
+        self._play_order = PlayOrder()
+        self._play_order.load(self._play_order_path, self._journal.seq, len(self._playlist))
+        # (position, uri, playback uri) of the next track, see _update_next
+        self._next_track = None
+        # track queued by _on_about_to_finish, until its stream starts
+        self._gapless_queued = None
+        self._gapless_lock = threading.Lock()
+
+        self._startup_uris = self._playlist.unique()
+        self._schedule_indexing()
+        self._startup_scan_id = glib.idle_add(self._on_startup_scan)
+        # the scan left unfinished when the service quit last time is
+        # continued after the startup scan, see _resume_scan
+        self._scan_queue_path = os.path.join(data_dir, 'scanqueue')
+        self._scan_resumed = False
+        self._update_next()
+
+        # playback pipeline is created on first Play, see _get_pipeline
+        self._player = None
+        self._gapless = gapless
+        self._audio_sink = audio_sink
+
+        self._jobs = {}
+        self._last_job_id = 0
+        self._batch = None
+        self._batch_signals = None
+        self._batch_stream_changed = False
+        self._exports = []
 
         self._state = STATE_READY
         self._idle_callback = idle_callback
-        self.idle = True
+        self._tag_scanner.busy_callback = self._on_scanner_busy
+        self._update_idle()
+
+    def _message_cb(self, connection, message):
+        # measure latency of method calls, see GetStats
+        if not stats.enabled:
+            return super(Player, self)._message_cb(connection, message)
+        start = time.time()
+        try:
+            return super(Player, self)._message_cb(connection, message)
+        finally:
+            stats.observe('method.%s' % message.get_member(), time.time() - start)
 
     @apply
     def idle():
@@ -226,67 +862,575 @@ class Player(dbus.service.Object):
                 self._idle_callback(self, value)
         return property(fget, fset)
 
-    def _current_is_last(self):
-        if not self._playlist:
-            # check so this function won't return True on empty playlist 
-            return False
-        return self._current == (len(self._playlist) - 1)
+    def _record(self, op, *args):
+        if self._batch is not None:
+            self._batch.append((op, args))
+            return
+        self._journal.record(op, *args)
+        self._changes.append(self._journal.seq, op, args)
+
+    def _emit(self, signal, *args):
+        if self._batch_signals is not None:
+            self._batch_signals.append((signal, args))
+            return
+        if stats.enabled:
+            stats.count('signals', signal)
+        getattr(self, signal)(*args)
+
+    def _validate_ops(self, ops):
+        """Check operations against the playlist length, return them with plain Python arguments"""
+        result = []
+        length = len(self._playlist)
+        for op, args in ops:
+            op = str(op)
+            if op == 'add':
+                position, uris = int(args[0]), [str(uri) for uri in args[1]]
+                if not uris:
+                    raise EmptySequence
+                if position < 0 or position > length:
+                    raise InvalidPosition(position)
+                length += len(uris)
+                args = (position, uris)
+            elif op in ('remove', 'reorder', 'move'):
+                if op == 'move':
+                    positions, position = [int(pos) for pos in args[0]], int(args[1])
+                else:
+                    positions = [int(pos) for pos in args]
+                if not positions:
+                    raise EmptySequence
+                for pos in positions:
+                    if pos < 0 or pos >= length:
+                        raise InvalidPosition(pos)
+                if op == 'remove':
+                    args = sorted(set(positions))
+                    length -= len(args)
+                elif op == 'reorder':
+                    _check_permutation(positions, length)
+                    args = positions
+                else:
+                    if len(set(positions)) != len(positions):
+                        raise InvalidOperation('duplicate positions in move')
+                    if position < 0 or position > length - len(positions):
+                        raise InvalidPosition(position)
+                    args = (positions, position)
+            elif op == 'current':
+                args = int(args)
+                if args != CURRENT_UNSET and (args < 0 or args >= length):
+                    raise InvalidPosition(args)
+            elif op == 'clear':
+                length = 0
+                args = None
+            elif op in ('next', 'previous', 'play', 'pause', 'stop'):
+                args = None
+            else:
+                raise InvalidOperation(op)
+            result.append((op, args))
+        return result
+
+    def _move_positions(self, positions, position):
+        """Return Reorder positions for moving entries at positions to position"""
+        moved = set(positions)
+        order = [pos for pos in xrange(len(self._playlist)) if pos not in moved]
+        order[position:position] = positions
+        return order
+
+    def _coalesce_signals(self, signals, old_current):
+        """Merge Added signals for adjacent tracks and replace CurrentChanged signals with one"""
+        result = []
+        queue = None
+        for signal, args in signals:
+            if signal == 'CurrentChanged':
+                continue
+            if signal == 'QueueChanged':
+                queue = args
+                continue
+            if signal == 'Added' and result and result[-1][0] == 'Added':
+                tracks, position = result[-1][1]
+                if args[1] == position + len(tracks):
+                    result[-1] = (signal, (tracks + args[0], position))
+                    continue
+            result.append((signal, args))
+        if queue is not None:
+            result.append(('QueueChanged', queue))
+        if self._current != old_current:
+            result.append(('CurrentChanged', (old_current, self._current)))
+        return result
+
+    def _update_pipeline(self):
+        """Make playback follow the current track"""
+        if self._state == STATE_PAUSED or self._current == CURRENT_UNSET:
+            self.Stop()
+        elif self._state == STATE_PLAYING:
+            import gst
+            # reset player without changing player state
+            self._set_pipeline_state(gst.STATE_NULL)
+            self._cancel_gapless()
+            if self._stream_cache is not None:
+                self._stream_cache.abort_downloads()
+            self._player.set_property('uri', self._playback_uri(self._playlist[self._current]))
+            self._set_pipeline_state(gst.STATE_PLAYING)
+
+    def _tracks_to_dbus(self, uris):
+        return dbus.Array([(uri, self._tags.get(uri, {})) for uri in uris], signature='(sa{ss})')
+
+    def _change_to_dbus(self, version, op, args):
+        return dbus.Struct((dbus.UInt64(version), op, self._change_value(op, args)), signature='tsv')
+
+    def _change_value(self, op, args):
+        if op == 'batch':
+            return dbus.Array([dbus.Struct((batch_op, self._change_value(batch_op, batch_args)), signature='sv')
+                               for batch_op, batch_args in args[0]], signature='(sv)')
+        elif op == 'add':
+            position, uris = args
+            value = dbus.Struct((dbus.UInt32(position), self._tracks_to_dbus(uris)), signature='ua(sa{ss})')
+        elif op in ('remove', 'reorder'):
+            value = dbus.Array(args[0], signature='u')
+        elif op == 'clear':
+            value = dbus.Array([], signature='u')
+        elif op == 'current':
+            value = dbus.Int32(args[0])
+        else:
+            value = self._tracks_to_dbus(args[0])
+        return value
+
+    def _update_idle(self):
+        idle = self._state == STATE_READY and not self._jobs and not self._exports and self._profile is None
+        if not idle:
+            # the scan gets full idle_scan_time again when clients are gone
+            self._cancel_idle_scan()
+            self._idle_scan_expired = False
+        elif self._idle_scan_time and not self._idle_scan_expired and self._scan_busy():
+            idle = False
+            if not self._idle_scan_id and self._idle_scan_time > 0:
+                self._idle_scan_id = glib.timeout_add_seconds(self._idle_scan_time, self._on_idle_scan_timeout)
+        else:
+            self._cancel_idle_scan()
+        if idle != self.idle:
+            self.idle = idle
+
+    def _scan_busy(self):
+        return self._startup_scan_id != 0 or self._tag_scanner.busy
+
+    def _on_scanner_busy(self, busy):
+        self._update_idle()
+
+    def _cancel_idle_scan(self):
+        if self._idle_scan_id:
+            glib.source_remove(self._idle_scan_id)
+            self._idle_scan_id = 0
+
+    def _on_idle_scan_timeout(self):
+        # give up waiting, the rest of the scan is saved by close
+        self._idle_scan_id = 0
+        self._idle_scan_expired = True
+        self._update_idle()
+        return False
+
+    def _insert(self, position, uris):
+        self._playlist.insert(position, uris)
+        self._record('add', position, uris)
+        self._file_watcher.add(uris)
+        for job in self._jobs.itervalues():
+            if position <= job.position:
+                job.position += len(uris)
+
+        no_tags = self._lookup_tags(uris)
+        if self._search_built or self._sort_keys_built:
+            self._index_uris.extend(uris)
+            self._schedule_indexing()
+
+        new_current = self._current
+        if new_current != CURRENT_UNSET:
+            new_current = position_after_insert(new_current, position, len(uris))
+        queue_changed = self._play_order.insert(position, len(uris), new_current)
 
-    def _current_is_first(self):
-        return self._current == 0
+        add_info = [(uri, self._tags.get(uri, {})) for uri in uris]
+        self._emit('Added', add_info, position)
+        if queue_changed:
+            self._emit('QueueChanged', self._play_order.queue)
+        self._follow_current(new_current)
+
+        if no_tags:
+            self._tag_scanner.add(no_tags)
+        self._update_next()
+
+    def _on_files_changed(self, changed, deleted):
+        missing = [uri for uri in deleted if uri not in self._missing]
+        restored = [uri for uri in changed if uri in self._missing]
+        self._missing.update(missing)
+        self._missing.difference_update(restored)
+        for uri in changed:
+            self._tag_cache.invalidate(uri)
+        for uri in deleted:
+            self._tag_cache.invalidate(uri)
+        self._tag_scanner.add(changed)
+        if missing or restored:
+            self._emit('MissingChanged', missing, restored)
+
+    def _start_job(self, position, uris):
+        self._last_job_id += 1
+        job_id = self._last_job_id
+        job = _AddJob(job_id, position, uris, self._on_job_chunk, self._on_job_finished)
+        self._jobs[job_id] = job
+        self._update_idle()
+        job.start()
+        return job_id
+
+    def _on_job_chunk(self, job, uris):
+        position = min(job.position, len(self._playlist))
+        # reset before inserting, so the job doesn't shift itself
+        job.position = -1
+        self._insert(position, uris)
+        job.position = position + len(uris)
+        job.added += len(uris)
+        self._emit('AddProgress', job.job_id, job.added)
+
+    def _on_job_finished(self, job):
+        del self._jobs[job.job_id]
+        if job.error is not None:
+            self._emit('AddFailed', job.job_id, str(job.error))
+        self._emit('AddFinished', job.job_id, job.added, False)
+        self._update_idle()
+
+    def _get_pipeline(self):
+        if self._player is None:
+            import gst
+            self._player = gst.element_factory_make('playbin2', 'player')
+            self._player.set_property('flags', GST_PLAY_FLAG_AUDIO)
+            if self._audio_sink:
+                sink = gst.parse_bin_from_description(self._audio_sink, True)
+            else:
+                sink = gst.element_factory_make('autoaudiosink')
+            self._player.set_property('audio-sink', sink)
+            player_bus = self._player.get_bus()
+            player_bus.add_signal_watch()
+            player_bus.connect('message', self._on_player_message)
+            if self._gapless:
+                self._player.connect('about-to-finish', self._on_about_to_finish)
+                sink.get_pad('sink').add_event_probe(self._on_sink_event)
+            if self._stream_cache is not None:
+                self._player.connect('source-setup', self._on_source_setup)
+        return self._player
+
+    def _set_pipeline_state(self, state):
+        import gst
+        if not stats.enabled:
+            self._player.set_state(state)
+            return
+        start = time.time()
+        if self._player.set_state(state) == gst.STATE_CHANGE_ASYNC:
+            # finished with a state-changed message, see _on_player_message
+            self._state_change = (state, start)
+        else:
+            stats.observe('pipeline.' + state.value_nick, time.time() - start)
+
+    def _playback_uri(self, uri):
+        """Return uri to play for playlist uri, the cached copy if there's one"""
+        if self._stream_cache is None:
+            return uri
+        return self._stream_cache.lookup_uri(uri)
+
+    def _on_source_setup(self, player, source):
+        # the uri property is already set to the uri the source is for,
+        # including the next one queued by about-to-finish
+        self._stream_cache.attach(source, player.get_property('uri'))
+
+    def _on_startup_scan(self):
+        uris = self._startup_uris[-STARTUP_SCAN_BATCH:]
+        del self._startup_uris[-STARTUP_SCAN_BATCH:]
+        # skip uris removed since startup
+        uris = [uri for uri in uris if uri in self._playlist]
+        self._file_watcher.add(uris)
+        no_tags = []
+        missing = []
+        for uri in uris:
+            if self._tag_cache.lookup(uri) is None:
+                path = uri_to_path(uri)
+                if path is not None and not os.path.exists(path):
+                    missing.append(uri)
+                no_tags.append(uri)
+        if missing:
+            self._missing.update(missing)
+            self._emit('MissingChanged', missing, [])
+        if no_tags:
+            self._tag_scanner.add(no_tags)
+        if self._startup_uris:
+            return True
+        self._resume_scan()
+        self._startup_scan_id = 0
+        self._update_idle()
+        return False
+
+    def _resume_scan(self, start=True):
+        """Queue uris left unscanned when the service quit last time
+
+        It's done after the startup scan, not on activation, so scan
+        pipelines, and GStreamer with them, aren't loaded before they're
+        needed, and the fast reader gets new uris first.
+
+        """
+        if not self._scan_resumed:
+            self._scan_resumed = True
+            self._tag_scanner.load(self._scan_queue_path, self._playlist.__contains__, start)
+
+    def _next_position(self):
+        """Return position of the track to play after current one or CURRENT_UNSET"""
+        return self._play_order.next(self._current, len(self._playlist))
+
+    def _on_about_to_finish(self, player):
+        # called from the streaming thread, queue next track, so playbin2
+        # switches to it without tearing down the pipeline, the track is
+        # found by the main loop beforehand, as the playlist isn't
+        # thread-safe
+        current, next_track = self._current, self._next_track
+        if next_track is None:
+            return
+        position, uri, playback_uri = next_track
+        player.set_property('uri', playback_uri)
+        with self._gapless_lock:
+            self._gapless_queued = (current, position, uri)
+
+    def _on_sink_event(self, pad, event):
+        # called from the streaming thread, the new segment of the queued
+        # track reaches the sink when the previous track has been played
+        import gst
+        if event.type == gst.EVENT_NEWSEGMENT:
+            with self._gapless_lock:
+                queued, self._gapless_queued = self._gapless_queued, None
+            if queued is not None:
+                glib.idle_add(self._on_gapless_switch, *queued)
+        return True
+
+    def _on_gapless_switch(self, old, position, uri):
+        # current track could be changed while we were waiting for the main loop,
+        # in that case player is already reset and we have nothing to do
+        if self._current == old and self._state == STATE_PLAYING and \
+                position < len(self._playlist) and self._playlist[position] == uri:
+            self._change_current(position, keep_stream=True)
+        return False
+
+    def _cancel_gapless(self):
+        with self._gapless_lock:
+            self._gapless_queued = None
     
     def _on_player_message(self, element, message):
+        import gst
         t = message.type
         if t == gst.MESSAGE_EOS:
-            if not self._current_is_last():
-                self.Next()
+            position = self._next_position()
+            if position != CURRENT_UNSET:
+                self._change_current(position)
             else:
                 self.Stop()
+        elif t == gst.MESSAGE_STATE_CHANGED and self._state_change is not None and message.src == self._player:
+            old, new, pending = message.parse_state_changed()
+            state, start = self._state_change
+            if new == state and pending == gst.STATE_VOID_PENDING:
+                self._state_change = None
+                stats.observe('pipeline.' + state.value_nick, time.time() - start)
 
     def _on_tag_scanned(self, uri, tag):
-        if not (uri in self._tags and self._tags[uri] == tag):
-            self._tags[uri] = tag
-            self.TagChanged(uri, tag)
+        track_id = self._store.id(uri)
+        if track_id is None:
+            # removed while it was scanned
+            return
+        old = self._store.get_tags(track_id) or {}
+        self._store.set_tags(track_id, tag)
+        self._tag_cache.store(uri)
+        self._schedule_tag_cache_save()
+        if tag != old:
+            # tracks not indexed yet are indexed with their current tags
+            if track_id in self._search_index:
+                self._search_index.update(track_id, uri, tag)
+            self._sort_keys.invalidate(track_id)
+            if self._search_built or self._sort_keys_built:
+                self._index_uris.append(uri)
+                self._schedule_indexing()
+            if self._tag_changed_signal:
+                self._emit('TagChanged', uri, tag)
+            self._changed_tags[uri] = tag
+            if len(self._changed_tags) >= self._tags_changed_max:
+                self._emit_tags_changed()
+            elif not self._tags_changed_id:
+                self._tags_changed_id = glib.timeout_add(self._tags_changed_delay, self._emit_tags_changed)
+
+    def _emit_tags_changed(self):
+        if self._tags_changed_id:
+            glib.source_remove(self._tags_changed_id)
+            self._tags_changed_id = 0
+        if self._changed_tags:
+            tracks = self._changed_tags.items()
+            self._changed_tags = {}
+            # tag updates get a version, but only the change log keeps
+            # their uris, they aren't written to the journal
+            self._journal.advance()
+            self._changes.append(self._journal.seq, 'tags', [uri for uri, tag in tracks])
+            self._emit('TagsChanged', tracks)
+        return False
+
+    def _schedule_indexing(self):
+        if not self._index_id:
+            self._index_id = glib.idle_add(self._on_index_idle)
+
+    def _on_index_idle(self):
+        """Keep the search index, sort keys and playlist positions index up to date
+
+        Tracks are added to the search index and given sort keys, once they
+        were built by Find and SortBy, and playlist entries are added to the
+        positions index, in small batches, so later queries and sorts don't
+        need to build anything and the main loop isn't blocked for long.
+
+        """
+        if self._index_uris:
+            self._index(self._index_uris[-INDEX_BATCH:])
+            del self._index_uris[-INDEX_BATCH:]
+            return True
+        if not self._playlist.index_positions(POSITIONS_INDEX_BATCH):
+            return True
+        self._index_id = 0
+        return False
+
+    def _index(self, uris):
+        store = self._store
+        ids = []
+        for uri in uris:
+            track_id = store.id(uri)
+            # skip tracks removed since
+            if track_id is None:
+                continue
+            ids.append(track_id)
+            if self._search_built and track_id not in self._search_index:
+                self._search_index.update(track_id, uri, store.get_tags(track_id) or {})
+        if self._sort_keys_built:
+            self._sort_keys.update(ids)
+
+    def _lookup_tags(self, uris):
+        """Fill tags for given uris from the tag cache, return uris that need scanning"""
+        no_tags = []
+        seen = set()
+        for uri in uris:
+            if uri in self._tags or uri in seen:
+                continue
+            seen.add(uri)
+            # valid cached tags are in the store already
+            if self._tag_cache.lookup(uri) is None:
+                no_tags.append(uri)
+        return no_tags
+
+    def _prioritize_scan(self, uris, priority):
+        """Make uris without tags and uris waiting for rescan scanned first"""
+        self._tag_scanner.add([uri for uri in uris if uri not in self._tags], priority)
+        self._tag_scanner.prioritize(uris, priority)
+
+    def _update_next(self):
+        """Find the track played after the current one, called after every change that can affect it"""
+        uris = []
+        if self._current != CURRENT_UNSET:
+            uris.append(self._playlist[self._current])
+        position = self._next_position()
+        if position == CURRENT_UNSET:
+            self._next_track = None
+        else:
+            uri = self._playlist[position]
+            uris.append(uri)
+            # read by _on_about_to_finish from the streaming thread
+            self._next_track = (position, uri, self._playback_uri(uri))
+        self._prioritize_scan(uris, PRIORITY_PLAYING)
+
+    def _schedule_tag_cache_save(self):
+        if not self._tag_cache_timeout_id:
+            self._tag_cache_timeout_id = glib.timeout_add_seconds(TAG_CACHE_SAVE_DELAY, self._on_tag_cache_timeout)
+
+    def _on_tag_cache_timeout(self):
+        self._tag_cache_timeout_id = 0
+        self._save_tag_cache()
+        return False
+
+    def _save_tag_cache(self):
+        if self._tag_cache.dirty:
+            self._tag_cache.save()
+
+    def close(self):
+        """Write any pending data to disk, called before service quits"""
+        for job in self._jobs.itervalues():
+            job.cancel()
+        self._jobs = {}
+        self._file_watcher.close()
+        if self._tags_changed_id:
+            glib.source_remove(self._tags_changed_id)
+            self._tags_changed_id = 0
+        if self._tag_cache_timeout_id:
+            glib.source_remove(self._tag_cache_timeout_id)
+            self._tag_cache_timeout_id = 0
+        if self._startup_scan_id:
+            glib.source_remove(self._startup_scan_id)
+            self._startup_scan_id = 0
+        if self._index_id:
+            glib.source_remove(self._index_id)
+            self._index_id = 0
+        self._cancel_idle_scan()
+        self._save_tag_cache()
+        # keep the saved queue if it wasn't resumed yet
+        self._resume_scan(start=False)
+        try:
+            if self._tag_scanner.busy:
+                self._tag_scanner.save(self._scan_queue_path)
+            elif os.path.exists(self._scan_queue_path):
+                os.remove(self._scan_queue_path)
+        except EnvironmentError:
+            pass
+        if self._stream_cache is not None:
+            self._stream_cache.abort_downloads()
+            if self._stream_cache.dirty:
+                try:
+                    self._stream_cache.save()
+                except EnvironmentError:
+                    pass
+        self._journal.close()
+        try:
+            self._play_order.save(self._play_order_path, self._journal.seq, len(self._playlist))
+        except EnvironmentError:
+            pass
     
     def _init_playlist(self):
-        self._playlist = []
-        self._current = CURRENT_UNSET
-        if os.path.exists(self._playlist_path):
-            try:
-                data = pickle.load(open(self._playlist_path, 'rb'))
-                self._playlist = data['playlist']
-                self._current = data['current']
-            except:
-                pass
-    
-    def _save_playlist(self):
-        if self._playlist:
-            data = {'playlist': self._playlist, 'current': self._current}
-            pickle.dump(data, open(self._playlist_path, 'wb'))
-        elif os.path.exists(self._playlist_path):
-            os.unlink(self._playlist_path)
+        playlist, self._current = self._journal.load(self._changes.append)
+        self._playlist = Playlist(playlist, self._store)
+
+    def _get_playlist_state(self):
+        return self._playlist, self._current
 
     def _change_state(self, new):
         old = self._state
         if new != old:
             self._state = new
-            self.StateChanged(old, new)
-            if new == STATE_READY:
-                self.idle = True
-            else:
-                self.idle = False
+            self._emit('StateChanged', old, new)
+            self._update_idle()
+
+    def _follow_current(self, new):
+        """Move current position to new one of the same entry after a playlist change
 
-    def _change_current(self, new, reorder=False):
+        The entry stays playing and the queue isn't touched, unlike with
+        _change_current.
+
+        """
+        old = self._current
+        if old != new:
+            self._current = new
+            self._record('current', new)
+            self._emit('CurrentChanged', old, new)
+
+    def _change_current(self, new, keep_stream=False):
         old = self._current
         if old != new:
             self._current = new
-            self._save_playlist()
-            self.CurrentChanged(old, new)
-            if not reorder:
-                if self._state == STATE_PAUSED or new == CURRENT_UNSET:
-                    self.Stop()
-                elif self._state == STATE_PLAYING:
-                    # reset player without changing player state
-                    self._player.set_state(gst.STATE_NULL)
-                    self._player.set_property('uri', self._playlist[new])
-                    self._player.set_state(gst.STATE_PLAYING)
+            self._record('current', new)
+            self._emit('CurrentChanged', old, new)
+            if new != CURRENT_UNSET and self._play_order.played(new):
+                self._emit('QueueChanged', self._play_order.queue)
+            self._update_next()
+            if not keep_stream:
+                if self._batch is None:
+                    self._update_pipeline()
+                else:
+                    # batches update playback when they're done
+                    self._batch_stream_changed = True
@@ -0,0 +1,186 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+from array import array
+
+from myplay.trackstore import TrackStore
+
+# removing less than 1/REMOVE_INPLACE_RATIO of the playlist is done with
+# in-place deletes, removing more rebuilds the array in one pass
+REMOVE_INPLACE_RATIO = 64
+
+class Playlist(object):
+    """Sequence of uris kept as an array of TrackStore ids
+
+    Uris and their occurence counts are stored in the TrackStore, which can
+    be shared with the owner of the playlist to keep tags of its tracks, see
+    TagMap. Uris are passed to and returned from the methods as strings.
+
+    Complexity of operations for playlist of n entries, where k is the number
+    of uris added or removed:
+
+     * len, item access, "uri in playlist": O(1), not counting the binary
+       search of the file name in its directory
+     * unique: O(number of distinct uris), without scanning the playlist
+     * insert: O(k) plus one memmove of the tail after the insert position
+     * remove: O(k log k) plus up to k memmoves for small k, O(n) for big k
+     * reorder: O(n), as it's given the whole new order
+     * ids_positions: O(number of occurences), using an index of positions
+       by track id, see index_positions
+
+    Memmoves are done by the array implementation in C and are very cheap
+    comparing to doing anything per entry in Python, see benchmarks/playlist.py.
+
+    Positions passed to the methods are expected to be valid, checking them
+    is up to the caller.
+
+    """
+
+    def __init__(self, uris=(), store=None):
+        if store is None:
+            store = TrackStore()
+        self._store = store
+        self._ids = store.ref_all(uris)
+        self._reset_positions()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        uri = self._store.uri
+        for track_id in self._ids:
+            yield uri(track_id)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            uri = self._store.uri
+            return [uri(track_id) for track_id in self._ids[position]]
+        return self._store.uri(self._ids[position])
+
+    def __contains__(self, uri):
+        return self._store.id(uri) is not None
+
+    def unique(self):
+        """Return list of distinct uris in the playlist, in no particular order"""
+        uri = self._store.uri
+        return [uri(track_id) for track_id in self._store.ids()]
+
+    def ids(self):
+        """Return array of track ids of the entries, it mustn't be changed"""
+        return self._ids
+
+    def ids_positions(self, track_ids):
+        """Return sorted list of positions of entries with any of given distinct track ids"""
+        self.index_positions()
+        first = self._first_positions
+        more = self._more_positions
+        count = len(first)
+        positions = []
+        for track_id in track_ids:
+            if track_id < count and first[track_id] >= 0:
+                if track_id in more:
+                    positions.extend(more[track_id])
+                else:
+                    positions.append(first[track_id])
+        positions.sort()
+        return positions
+
+    def _reset_positions(self):
+        # first position of every track id, -1 for ids not in the playlist,
+        # all positions of ids occuring more than once and the number of
+        # entries from the start of the playlist these include
+        self._first_positions = array('i')
+        self._more_positions = {}
+        self._indexed = 0
+
+    def index_positions(self, count=None):
+        """Add up to count more entries to the index of positions, all if count is None
+
+        Return True if the index is complete. Appending entries keeps the
+        index, other changes clear it, so it's built again in O(n) by the
+        next call. The owner can build it in parts while idle, so finding
+        positions stays cheap.
+
+        """
+        ids = self._ids
+        start = self._indexed
+        end = len(ids)
+        if count is not None:
+            end = min(end, start + count)
+        if start < end:
+            first = self._first_positions
+            more = self._more_positions
+            missing = max(ids[start:end]) + 1 - len(first)
+            if missing > 0:
+                first.extend(array('i', [-1]) * missing)
+            for i in xrange(start, end):
+                track_id = ids[i]
+                if first[track_id] < 0:
+                    first[track_id] = i
+                elif track_id in more:
+                    more[track_id].append(i)
+                else:
+                    more[track_id] = [first[track_id], i]
+            self._indexed = end
+        return end == len(ids)
+
+    def insert(self, position, uris):
+        if position < self._indexed:
+            self._reset_positions()
+        self._ids[position:position] = self._store.ref_all(uris)
+
+    def remove(self, positions):
+        """Remove entries at given positions
+
+        Return list of (track id, uri) of tracks that aren't in the
+        playlist anymore. Their ids are reused by next inserts.
+
+        """
+        self._reset_positions()
+        positions = set(positions)
+        ids = self._ids
+        removed = [ids[pos] for pos in positions]
+        if len(positions) * REMOVE_INPLACE_RATIO < len(ids):
+            for pos in sorted(positions, reverse=True):
+                del ids[pos]
+        else:
+            self._ids = array('I', [track_id for i, track_id in enumerate(ids) if i not in positions])
+
+        gone = []
+        store = self._store
+        for track_id in removed:
+            uri = store.uri(track_id)
+            if store.unref(track_id):
+                gone.append((track_id, uri))
+        return gone
+
+    def reorder(self, positions):
+        """Reorder playlist so new playlist[i] is old playlist[positions[i]]
+
+        Positions must be a permutation of the playlist positions, as track
+        occurence counts aren't updated.
+
+        """
+        ids = self._ids
+        self._ids = array('I', [ids[pos] for pos in positions])
+        self._reset_positions()
+
+    def clear(self):
+        self._ids = array('I')
+        self._store.clear()
+        self._reset_positions()
@@ -0,0 +1,166 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Reading and writing M3U, PLS and XSPF playlists
+
+Readers are generators yielding uris one by one and writers consume an
+iterable of (uri, tags_dict) pairs, so neither keeps the whole playlist in
+memory. Relative paths and uris in playlist files are resolved against the
+directory of the playlist file, local files are written as absolute paths to
+M3U and PLS files and as file:// uris to XSPF.
+
+"""
+import os
+import re
+import urlparse
+from xml.sax.saxutils import escape
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from myplay.common import path_to_uri, uri_to_path
+from myplay.tagreader import TAG_TITLE, TAG_ARTIST, TAG_ALBUM
+
+FORMATS = ('m3u', 'm3u8', 'pls', 'xspf')
+
+XSPF_NS = '{http://xspf.org/ns/0/}'
+
+URI_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+
+class PlaylistError(ValueError):
+    pass
+
+def get_format(path):
+    """Return format name for playlist file path or None if it's unknown"""
+    ext = os.path.splitext(path)[1][1:].lower()
+    if ext in FORMATS:
+        return ext
+    return None
+
+def _resolve(entry, base_dir):
+    if URI_RE.match(entry):
+        return entry
+    return path_to_uri(os.path.join(base_dir, entry))
+
+def read_playlist(path):
+    """Yield uris from playlist file, raise PlaylistError for unknown formats"""
+    format = get_format(path)
+    if format is None:
+        raise PlaylistError('unknown playlist format: %s' % path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    f = open(path, 'rb')
+    try:
+        if format == 'xspf':
+            reader = _read_xspf(f, path_to_uri(path))
+        elif format == 'pls':
+            reader = _read_pls(f, base_dir)
+        else:
+            reader = _read_m3u(f, base_dir)
+        for uri in reader:
+            yield uri
+    finally:
+        f.close()
+
+def _read_m3u(f, base_dir):
+    for line in f:
+        line = line.strip()
+        if line.startswith('\xef\xbb\xbf'):
+            line = line[3:]
+        if line and not line.startswith('#'):
+            yield _resolve(line, base_dir)
+
+def _read_pls(f, base_dir):
+    for line in f:
+        key, sep, value = line.strip().partition('=')
+        if sep and key.lower().startswith('file') and value:
+            yield _resolve(value, base_dir)
+
+def _read_xspf(f, base_uri):
+    track_list = None
+    try:
+        for event, elem in ElementTree.iterparse(f, ('start', 'end')):
+            if event == 'start':
+                if elem.tag == XSPF_NS + 'trackList':
+                    track_list = elem
+                continue
+            if elem.tag == XSPF_NS + 'location' and elem.text:
+                yield urlparse.urljoin(base_uri, elem.text.strip().encode('utf-8'))
+            elif elem.tag == XSPF_NS + 'track' and track_list is not None:
+                # drop parsed tracks, so memory use doesn't grow
+                track_list.clear()
+    except SyntaxError, e:
+        # ParseError in 2.7, ExpatError in 2.6
+        raise PlaylistError(str(e))
+
+def write_playlist(path, tracks):
+    """Write (uri, tags) pairs to playlist file in format given by its extension"""
+    format = get_format(path)
+    if format is None:
+        raise PlaylistError('unknown playlist format: %s' % path)
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        if format == 'xspf':
+            _write_xspf(f, tracks)
+        elif format == 'pls':
+            _write_pls(f, tracks)
+        else:
+            _write_m3u(f, tracks)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def _location(uri):
+    return uri_to_path(uri) or uri
+
+def _write_m3u(f, tracks):
+    f.write('#EXTM3U\n')
+    for uri, tags in tracks:
+        title = tags.get(TAG_TITLE)
+        if title:
+            artist = tags.get(TAG_ARTIST)
+            if artist:
+                title = '%s - %s' % (artist, title)
+            f.write('#EXTINF:-1,%s\n' % title.replace('\n', ' '))
+        f.write(_location(uri) + '\n')
+
+def _write_pls(f, tracks):
+    f.write('[playlist]\n')
+    count = 0
+    for uri, tags in tracks:
+        count += 1
+        f.write('File%d=%s\n' % (count, _location(uri)))
+        title = tags.get(TAG_TITLE)
+        if title:
+            f.write('Title%d=%s\n' % (count, title.replace('\n', ' ')))
+    f.write('NumberOfEntries=%d\nVersion=2\n' % count)
+
+def _write_xspf(f, tracks):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+            '  <trackList>\n')
+    for uri, tags in tracks:
+        f.write('    <track>\n      <location>%s</location>\n' % escape(uri))
+        for tag, element in ((TAG_TITLE, 'title'), (TAG_ARTIST, 'creator'), (TAG_ALBUM, 'album')):
+            value = tags.get(tag)
+            if value:
+                f.write('      <%s>%s</%s>\n' % (element, escape(value), element))
+        f.write('    </track>\n')
+    f.write('  </trackList>\n</playlist>\n')
@@ -0,0 +1,270 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import gio
+import gtk
+
+from myplay.common import CURRENT_UNSET
+from myplay.tagreader import TAG_TITLE, TAG_ARTIST, TAG_ALBUM
+
+COL_CURRENT = 0
+COL_URI = 1
+COL_DISPLAY_PATH = 2
+COL_TITLE = 3
+COL_ARTIST = 4
+COL_ALBUM = 5
+
+COLUMN_TYPES = (str, str, str, str, str, str)
+
+# number of rows fetched from the player in one ListRange call
+PAGE_SIZE = 100
+
+# maximum number of pages kept in memory
+MAX_PAGES = 50
+
+def get_path_or_uri(uri):
+    if uri.startswith('file://'):
+        return gio.File(uri=uri).get_path() or uri
+    return uri
+
+def make_row(uri, tag):
+    uri = str(uri)
+    path = get_path_or_uri(uri)
+    title = tag.get(TAG_TITLE) or path
+    artist = tag.get(TAG_ARTIST)
+    album = tag.get(TAG_ALBUM)
+    return [None, uri, path, title, artist, album]
+
+class PlaylistModel(gtk.GenericTreeModel):
+    """Tree model showing player's playlist without loading it as a whole
+
+    The model only knows the playlist length, rows are fetched from the player
+    using asynchronous ListRange calls of the given myplay.client.Client in pages of PAGE_SIZE rows when the view
+    asks for their values, that is, when they get close to the visible area.
+    At most MAX_PAGES pages are kept, least recently used ones are dropped.
+
+    Rows that aren't fetched yet are shown empty and updated when the reply
+    comes. Structural changes invalidate fetched pages, replies to calls made
+    before the change are ignored.
+
+    Positions of fetched rows are indexed by uri, so tag changes only touch
+    affected rows. Current track is kept as a position, so changing it only
+    touches old and new current rows.
+
+    While "detached" is set, structural changes don't emit a signal for
+    every row, so setting the length of a big playlist is cheap. It must
+    only be set while no view shows the model, the view reads the model
+    again when it's attached.
+
+    Row references are positions. The model doesn't leak a reference to
+    every row reference it returns, so it keeps them itself, see
+    _get_rowref, and drops them when iters are invalidated by a change.
+
+    """
+
+    def __init__(self, client):
+        super(PlaylistModel, self).__init__()
+        self.props.leak_references = False
+        self.detached = False
+        self._client = client
+        self._rowrefs = {}
+        self._length = 0
+        self._current = CURRENT_UNSET
+        self._pages = {}
+        self._page_lru = []
+        self._pending = set()
+        self._generation = 0
+        self._uri_positions = {}
+
+    def _invalidate(self):
+        self._pages = {}
+        self._page_lru = []
+        self._pending = set()
+        self._generation += 1
+        self._uri_positions = {}
+        # positions change, so iters pointing to old row references
+        # mustn't be used anymore
+        self.invalidate_iters()
+        self._rowrefs = {}
+
+    def _get_rowref(self, position):
+        """Return row reference of position, kept alive until iters are invalidated"""
+        return self._rowrefs.setdefault(position, position)
+
+    def _index_page(self, page, rows, add):
+        start = page * PAGE_SIZE
+        for offset, row in enumerate(rows):
+            uri = row[COL_URI]
+            if add:
+                self._uri_positions.setdefault(uri, set()).add(start + offset)
+            else:
+                positions = self._uri_positions[uri]
+                positions.discard(start + offset)
+                if not positions:
+                    del self._uri_positions[uri]
+
+    def _get_row(self, position):
+        page = position // PAGE_SIZE
+        rows = self._pages.get(page)
+        if rows is None:
+            self._fetch(page)
+            return None
+        if self._page_lru[-1] != page:
+            self._page_lru.remove(page)
+            self._page_lru.append(page)
+        offset = position % PAGE_SIZE
+        if offset < len(rows):
+            return rows[offset]
+        return None
+
+    def _fetch(self, page):
+        if page in self._pending:
+            return
+        self._pending.add(page)
+        generation = self._generation
+        def reply_handler(tracks):
+            self._on_page_fetched(generation, page, tracks)
+        def error_handler(error):
+            if generation == self._generation:
+                self._pending.discard(page)
+        self._client.list_range(page * PAGE_SIZE, PAGE_SIZE, reply_handler, error_handler)
+        # rows are fetched when they get close to the visible area, so
+        # ask the player to scan their tags first
+        self._client.hint_visible(page * PAGE_SIZE, PAGE_SIZE)
+
+    def _on_page_fetched(self, generation, page, tracks):
+        if generation != self._generation:
+            return
+        self._pending.discard(page)
+        rows = [make_row(*track) for track in tracks]
+        self._pages[page] = rows
+        self._index_page(page, rows, True)
+        self._page_lru.append(page)
+        if len(self._page_lru) > MAX_PAGES:
+            old_page = self._page_lru.pop(0)
+            self._index_page(old_page, self._pages.pop(old_page), False)
+        start = page * PAGE_SIZE
+        for position in xrange(start, min(start + len(tracks), self._length)):
+            path = (position, )
+            self.row_changed(path, self.get_iter(path))
+
+    def reset(self, length, current):
+        self.clear()
+        self._current = current
+        self._insert_rows(0, length)
+
+    def insert(self, position, tracks):
+        self._invalidate()
+        self._insert_rows(position, len(tracks))
+
+    def _insert_rows(self, position, count):
+        self._length += count
+        if self.detached:
+            return
+        for i in xrange(position, position + count):
+            path = (i, )
+            self.row_inserted(path, self.get_iter(path))
+
+    def remove(self, positions):
+        self._invalidate()
+        if self.detached:
+            self._length -= len(positions)
+            return
+        for position in sorted(positions, reverse=True):
+            self._length -= 1
+            self.row_deleted((position, ))
+
+    def clear(self):
+        self._invalidate()
+        if self.detached:
+            self._length = 0
+        while self._length:
+            self._length -= 1
+            self.row_deleted((self._length, ))
+
+    def reorder(self, positions):
+        self._invalidate()
+        self.rows_reordered(None, None, positions)
+
+    def set_current(self, current):
+        old, self._current = self._current, current
+        for position in (old, current):
+            if 0 <= position < self._length:
+                path = (position, )
+                self.row_changed(path, self.get_iter(path))
+
+    def update_tags(self, tags):
+        """Update fetched rows using given uri->tag_dict mapping"""
+        for uri, tag in tags.iteritems():
+            for position in self._uri_positions.get(uri, ()):
+                self._pages[position // PAGE_SIZE][position % PAGE_SIZE] = make_row(uri, tag)
+                path = (position, )
+                self.row_changed(path, self.get_iter(path))
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY
+
+    def on_get_n_columns(self):
+        return len(COLUMN_TYPES)
+
+    def on_get_column_type(self, index):
+        return COLUMN_TYPES[index]
+
+    def on_get_iter(self, path):
+        if path[0] < self._length:
+            return self._get_rowref(path[0])
+        return None
+
+    def on_get_path(self, rowref):
+        return (rowref, )
+
+    def on_get_value(self, rowref, column):
+        if column == COL_CURRENT:
+            if rowref == self._current:
+                return 'gtk-media-play'
+            return None
+        row = self._get_row(rowref)
+        if row is None:
+            return None
+        return row[column]
+
+    def on_iter_next(self, rowref):
+        if rowref + 1 < self._length:
+            return self._get_rowref(rowref + 1)
+        return None
+
+    def on_iter_children(self, parent):
+        if parent is None and self._length:
+            return self._get_rowref(0)
+        return None
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return self._length
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and n < self._length:
+            return self._get_rowref(n)
+        return None
+
+    def on_iter_parent(self, child):
+        return None
@@ -0,0 +1,396 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import bisect
+import os
+import random
+from array import array
+import cPickle as pickle
+
+from myplay.common import CURRENT_UNSET
+
+# number of keys in a block of _BlockList, blocks are split when they grow
+# over twice as big
+BLOCK_SIZE = 512
+
+# removing more than 1/REMOVE_REBUILD_RATIO of keys from a _BlockList
+# rebuilds it in one pass
+REMOVE_REBUILD_RATIO = 16
+
+def position_after_insert(pos, position, count):
+    """Return new position of entry at pos after count entries are inserted at position"""
+    if pos >= position:
+        return pos + count
+    return pos
+
+def position_after_remove(pos, removed):
+    """Return new position of entry at pos after removing entries at sorted distinct positions
+
+    Return None if the entry itself is removed.
+
+    """
+    i = bisect.bisect_left(removed, pos)
+    if i < len(removed) and removed[i] == pos:
+        return None
+    return pos - i
+
+class _BlockList(object):
+    """Sequence of distinct non-negative int keys, kept in blocks
+
+    Keys are stored in arrays of about BLOCK_SIZE items. The id of the
+    block holding every key is kept in an array indexed by the key, and
+    start indexes of the blocks are recomputed after changes, when they're
+    needed, which is O(number of blocks). So the index of a key, the key at
+    an index, inserting and removing keys are all O(n / BLOCK_SIZE +
+    BLOCK_SIZE) rather than O(n).
+
+    """
+
+    def __init__(self, keys=()):
+        self._build(keys)
+
+    def _build(self, keys):
+        self._blocks = {}
+        self._sequence = []
+        self._block_of = array('i')
+        self._last_block_id = 0
+        self._len = 0
+        self._starts = None
+        self._block_indexes = None
+        keys = array('i', keys)
+        for i in xrange(0, len(keys), BLOCK_SIZE):
+            self._sequence.append(self._new_block(keys[i:i + BLOCK_SIZE]))
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for block_id in self._sequence:
+            for key in self._blocks[block_id]:
+                yield key
+
+    def _new_block(self, keys):
+        self._last_block_id += 1
+        block_id = self._last_block_id
+        self._blocks[block_id] = keys
+        self._set_block(keys, block_id)
+        return block_id
+
+    def _set_block(self, keys, block_id):
+        block_of = self._block_of
+        if keys and max(keys) >= len(block_of):
+            block_of.extend(array('i', [0]) * (max(keys) + 1 - len(block_of)))
+        for key in keys:
+            block_of[key] = block_id
+
+    def _get_starts(self):
+        if self._starts is None:
+            starts = []
+            indexes = {}
+            start = 0
+            for i, block_id in enumerate(self._sequence):
+                starts.append(start)
+                indexes[block_id] = i
+                start += len(self._blocks[block_id])
+            self._starts = starts
+            self._block_indexes = indexes
+        return self._starts
+
+    def _locate(self, index):
+        """Return (number of block in sequence, offset in block) for index"""
+        starts = self._get_starts()
+        i = max(bisect.bisect_right(starts, index) - 1, 0)
+        return i, index - starts[i]
+
+    def index(self, key):
+        self._get_starts()
+        block_id = self._block_of[key]
+        return self._starts[self._block_indexes[block_id]] + self._blocks[block_id].index(key)
+
+    def __getitem__(self, index):
+        i, offset = self._locate(index)
+        return self._blocks[self._sequence[i]][offset]
+
+    def insert(self, index, keys):
+        """Insert list of keys at index"""
+        self.insert_many([(index, keys)])
+
+    def insert_many(self, items):
+        """Insert lists of keys at indexes given as (index, keys) pairs
+
+        Indexes refer to the sequence before any of the keys are inserted,
+        keys given for equal indexes are inserted in the given order.
+
+        """
+        if not self._sequence:
+            self._sequence.append(self._new_block(array('i')))
+            self._starts = None
+        touched = set()
+        # going from the end keeps starts of the blocks before valid
+        for number, (index, keys) in sorted(enumerate(items), key=lambda item: (-item[1][0], -item[0])):
+            i, offset = self._locate(index)
+            block_id = self._sequence[i]
+            self._blocks[block_id][offset:offset] = array('i', keys)
+            self._set_block(keys, block_id)
+            self._len += len(keys)
+            touched.add(block_id)
+        for block_id in touched:
+            self._split(block_id)
+        self._starts = None
+
+    def _split(self, block_id):
+        block = self._blocks[block_id]
+        if len(block) <= 2 * BLOCK_SIZE:
+            return
+        new_ids = [self._new_block(block[i:i + BLOCK_SIZE])
+                   for i in xrange(BLOCK_SIZE, len(block), BLOCK_SIZE)]
+        del block[BLOCK_SIZE:]
+        i = self._sequence.index(block_id)
+        self._sequence[i + 1:i + 1] = new_ids
+
+    def remove(self, keys):
+        """Remove keys from the sequence"""
+        if len(keys) * REMOVE_REBUILD_RATIO > self._len:
+            removed = set(keys)
+            self._build([key for key in self if key not in removed])
+            return
+        for key in keys:
+            block_id = self._block_of[key]
+            block = self._blocks[block_id]
+            del block[block.index(key)]
+            if not block:
+                del self._blocks[block_id]
+                self._sequence.remove(block_id)
+        self._len -= len(keys)
+        self._starts = None
+
+class PlayOrder(object):
+    """Order of playing playlist entries: the "up next" queue and shuffle
+
+    Queued positions are played first, in the order they were queued. If
+    shuffle is on, the rest is played in the order of a random permutation
+    of playlist entries, otherwise sequentially.
+
+    The permutation is built when shuffle is turned on and then updated
+    along with the playlist: added entries are put in random places among
+    the ones not played yet and removed ones are dropped, so the order of
+    the others is kept.
+
+    Entries are identified by int keys that don't change when positions
+    do. Keys are kept in two _BlockLists, one in playlist order and one in
+    play order, so adding or removing entries and finding the next or the
+    previous one are O(sqrt(n))-like instead of renumbering the whole
+    permutation. Reorder rebuilds the playlist order list, as it's given
+    all positions anyway.
+
+    """
+
+    def __init__(self):
+        self.shuffle = False
+        self.queue = []
+        self._random = random.Random()
+        self._reset(())
+
+    def _reset(self, order, length=0):
+        # keys are positions of the entries at this point
+        self._entries = _BlockList(xrange(length))
+        self._order = _BlockList(order)
+        self._free_keys = []
+        self._next_key = length
+
+    def _new_keys(self, count):
+        if not count:
+            return []
+        keys = self._free_keys[-count:]
+        del self._free_keys[-count:]
+        while len(keys) < count:
+            keys.append(self._next_key)
+            self._next_key += 1
+        return keys
+
+    def set_shuffle(self, shuffle, length, current):
+        """Turn shuffle on or off, the current entry is the first in a new order"""
+        self.shuffle = shuffle
+        if not shuffle:
+            self._reset(())
+            return
+        order = range(length)
+        self._random.shuffle(order)
+        if current != CURRENT_UNSET:
+            i = order.index(current)
+            order[0], order[i] = order[i], order[0]
+        self._reset(order, length)
+
+    def _order_position(self, i):
+        """Return playlist position of i-th entry of the order"""
+        return self._entries.index(self._order[i])
+
+    def next(self, current, length):
+        """Return position to play after current or CURRENT_UNSET"""
+        queue = self.queue
+        if queue:
+            return queue[0]
+        if self.shuffle:
+            order = self._order
+            if current == CURRENT_UNSET:
+                return self._order_position(0) if order else CURRENT_UNSET
+            i = order.index(self._entries[current]) + 1
+            return self._order_position(i) if i < len(order) else CURRENT_UNSET
+        if current != CURRENT_UNSET and current + 1 < length:
+            return current + 1
+        return CURRENT_UNSET
+
+    def previous(self, current):
+        """Return position played before current or CURRENT_UNSET"""
+        if current == CURRENT_UNSET:
+            return CURRENT_UNSET
+        if self.shuffle:
+            i = self._order.index(self._entries[current])
+            return self._order_position(i - 1) if i > 0 else CURRENT_UNSET
+        return current - 1 if current > 0 else CURRENT_UNSET
+
+    def first(self):
+        """Return position to start playing from"""
+        if self.queue:
+            return self.queue[0]
+        if self.shuffle and self._order:
+            return self._order_position(0)
+        return 0
+
+    def played(self, position):
+        """Remove position from the queue when it's made current, return True if queue changed"""
+        if position in self.queue:
+            self.queue.remove(position)
+            return True
+        return False
+
+    def enqueue(self, positions):
+        self.queue.extend(positions)
+
+    def clear_queue(self):
+        """Clear queue, return True if it wasn't empty"""
+        if self.queue:
+            self.queue = []
+            return True
+        return False
+
+    def insert(self, position, count, current):
+        """Renumber positions for count entries inserted at position, return True if queue changed
+
+        Current is the position of the current entry after the insert.
+
+        """
+        queue_changed = self._renumber_queue(lambda pos: position_after_insert(pos, position, count))
+        if not self.shuffle:
+            return queue_changed
+        keys = self._new_keys(count)
+        self._entries.insert(position, keys)
+        # new entries go to random places after the current one
+        start = 0
+        if current != CURRENT_UNSET and current < len(self._entries):
+            start = self._order.index(self._entries[current]) + 1
+        self._random.shuffle(keys)
+        length = len(self._order)
+        self._order.insert_many([(self._random.randint(start, length), [key]) for key in keys])
+        return queue_changed
+
+    def remove(self, positions, length):
+        """Renumber positions for entries removed from playlist of given length, return True if queue changed"""
+        removed = sorted(set(positions))
+        queue_changed = self._renumber_queue(lambda pos: position_after_remove(pos, removed))
+        if not self.shuffle:
+            return queue_changed
+        entries = self._entries
+        keys = [entries[pos] for pos in removed]
+        entries.remove(keys)
+        self._order.remove(keys)
+        self._free_keys.extend(keys)
+        return queue_changed
+
+    def reorder(self, positions):
+        """Renumber positions after playlist reorder, return True if queue changed
+
+        Positions must be a permutation of the playlist positions, Player
+        checks them before the playlist is changed.
+
+        """
+        new_positions = array('i', [0]) * len(positions)
+        for i, pos in enumerate(positions):
+            new_positions[pos] = i
+        queue_changed = self._renumber_queue(new_positions.__getitem__)
+        if self.shuffle:
+            # the play order keeps its keys, only their positions change
+            keys = array('i', self._entries)
+            self._entries = _BlockList([keys[pos] for pos in positions])
+        return queue_changed
+
+    def clear(self):
+        """Forget all positions, return True if queue changed"""
+        if self.shuffle:
+            self._reset(())
+        return self.clear_queue()
+
+    def _renumber_queue(self, func):
+        if not self.queue:
+            return False
+        queue = [func(pos) for pos in self.queue]
+        queue = [pos for pos in queue if pos is not None]
+        changed = queue != self.queue
+        self.queue = queue
+        return changed
+
+    def save(self, path, seq, length):
+        """Write the order for playlist of given version and length to file"""
+        order = array('i')
+        if self.shuffle:
+            positions = array('i', [0]) * self._next_key
+            for i, key in enumerate(self._entries):
+                positions[key] = i
+            order = array('i', [positions[key] for key in self._order])
+        data = {'seq': seq, 'length': length, 'shuffle': self.shuffle,
+                'queue': self.queue, 'order': order.tostring()}
+        tmp_path = path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def load(self, path, seq, length):
+        """Read the order saved by save, return False if it's not for given playlist version and length
+
+        If the order is out of date, only the shuffle setting is kept.
+
+        """
+        try:
+            data = pickle.load(open(path, 'rb'))
+        except:
+            return False
+        if data['seq'] != seq or data['length'] != length:
+            if data['shuffle']:
+                self.set_shuffle(True, length, CURRENT_UNSET)
+            return False
+        self.shuffle = data['shuffle']
+        self.queue = data['queue']
+        order = array('i')
+        order.fromstring(data['order'])
+        if self.shuffle:
+            self._reset(order, length)
+        return True
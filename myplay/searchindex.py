@@ -0,0 +1,225 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import bisect
+import itertools
+import math
+import re
+import sys
+import urllib
+
+from myplay.common import uri_to_path
+from myplay.tagreader import TAGS
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# queries whose most selective word matches many tracks are answered by
+# checking playlist entries in order until enough of them match, instead of
+# collecting all matching tracks and their positions. About limit * n / count
+# entries are checked then, so it's done when that's cheaper, checking an
+# entry being about WALK_COST times as expensive as collecting a track
+WALK_COST = 2
+
+# but not for less matching tracks than this
+MIN_WALK_TRACKS = 2000
+
+def tokenize(text):
+    """Return set of lowercased words of utf-8 text, as utf-8 strings"""
+    words = WORD_RE.findall(text.decode('utf-8', 'replace').lower())
+    return set(intern(word.encode('utf-8')) for word in words)
+
+def uri_tokens(uri, tags):
+    path = uri_to_path(uri) or urllib.unquote(uri)
+    tokens = tokenize(path)
+    for tag in TAGS:
+        value = tags.get(tag)
+        if value:
+            tokens.update(tokenize(value))
+    return tokens
+
+def _has_prefixes(words, prefixes):
+    for prefix in prefixes:
+        for word in words:
+            if word.startswith(prefix):
+                break
+        else:
+            return False
+    return True
+
+class SearchIndex(object):
+    """Inverted index of words in tags and paths of tracks
+
+    Tracks are identified by their TrackStore ids. Every word maps to the
+    track id having it or, if there are more of them, to a set of ids, which
+    saves memory on the many words that are unique to one file. Words are
+    also kept in a sorted list, so all words starting with a prefix are
+    found with binary search. New words are appended and the list is sorted
+    on the next query, removed words are dropped from it at the same time,
+    so building the index is O(n log n).
+
+    A query matches tracks having, for every word of the query, a word that
+    starts with it.
+
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._words = []
+        self._words_dirty = False
+        # words of every track, indexed by track id, None if not indexed
+        self._track_words = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, track_id):
+        return track_id < len(self._track_words) and self._track_words[track_id] is not None
+
+    def update(self, track_id, uri, tags):
+        """Index track with given uri and tags, replacing what was indexed for it before"""
+        words = uri_tokens(uri, tags)
+        missing = track_id + 1 - len(self._track_words)
+        if missing > 0:
+            self._track_words.extend([None] * missing)
+        old_words = self._track_words[track_id]
+        if old_words is None:
+            old_words = ()
+            self._count += 1
+        for word in old_words:
+            if word not in words:
+                self._remove_posting(word, track_id)
+        for word in words:
+            if word not in old_words:
+                self._add_posting(word, track_id)
+        self._track_words[track_id] = tuple(words)
+
+    def remove(self, track_id):
+        if track_id not in self:
+            return
+        for word in self._track_words[track_id]:
+            self._remove_posting(word, track_id)
+        self._track_words[track_id] = None
+        self._count -= 1
+
+    def clear(self):
+        self.__init__()
+
+    def _add_posting(self, word, track_id):
+        posting = self._postings.get(word)
+        if posting is None:
+            self._postings[word] = track_id
+            self._words.append(word)
+            self._words_dirty = True
+        elif isinstance(posting, set):
+            posting.add(track_id)
+        else:
+            self._postings[word] = set((posting, track_id))
+
+    def _remove_posting(self, word, track_id):
+        posting = self._postings[word]
+        if isinstance(posting, set):
+            posting.discard(track_id)
+            if len(posting) == 1:
+                self._postings[word] = posting.pop()
+        else:
+            del self._postings[word]
+            self._words_dirty = True
+
+    def _sorted_words(self):
+        if self._words_dirty:
+            # the word can be re-added after removal, so use a set
+            self._words = sorted(set(word for word in self._words if word in self._postings))
+            self._words_dirty = False
+        return self._words
+
+    def _prefix_range(self, prefix):
+        words = self._sorted_words()
+        return bisect.bisect_left(words, prefix), bisect.bisect_left(words, prefix + '\xff')
+
+    def _count_matches(self, start, end, limit):
+        """Return number of tracks having words in given range, counting up to limit"""
+        count = 0
+        postings = self._postings
+        # every word has at least one track, so no more than limit + 1 are needed
+        for word in self._words[start:min(end, start + limit + 1)]:
+            posting = postings[word]
+            if isinstance(posting, set):
+                count += len(posting)
+            else:
+                count += 1
+            if count > limit:
+                break
+        return count
+
+    def _prefix_matches(self, start, end):
+        result = set()
+        postings = self._postings
+        for word in self._words[start:end]:
+            posting = postings[word]
+            if isinstance(posting, set):
+                result.update(posting)
+            else:
+                result.add(posting)
+        return result
+
+    def find(self, query, playlist, limit):
+        """Return up to limit sorted positions of entries of the Playlist matching query"""
+        prefixes = tokenize(query)
+        if not prefixes:
+            return []
+        max_count = max(MIN_WALK_TRACKS, int(math.sqrt(WALK_COST * limit * len(playlist))))
+        ranges = []
+        for prefix in prefixes:
+            start, end = self._prefix_range(prefix)
+            ranges.append((self._count_matches(start, end, max_count), start, end, prefix))
+        ranges.sort()
+        count, start, end, prefix = ranges[0]
+        if not count:
+            return []
+        others = [prefix for count, start, end, prefix in ranges[1:]]
+        track_words = self._track_words
+
+        if count > max_count:
+            prefixes = [prefix] + others
+            indexed = len(track_words)
+            matches = (i for i, track_id in enumerate(playlist.ids())
+                       if track_id < indexed and track_words[track_id] is not None
+                       and _has_prefixes(track_words[track_id], prefixes))
+            return list(itertools.islice(matches, limit))
+
+        ids = self._prefix_matches(start, end)
+        if others:
+            ids = [track_id for track_id in ids if _has_prefixes(track_words[track_id], others)]
+        return playlist.ids_positions(ids)[:limit]
+
+    def memory_usage(self):
+        """Return approximate number of bytes used by the index structures
+
+        Words are counted once.
+
+        """
+        size = sys.getsizeof(self._postings) + sys.getsizeof(self._sorted_words()) + sys.getsizeof(self._track_words)
+        for word, posting in self._postings.iteritems():
+            size += sys.getsizeof(word)
+            if isinstance(posting, set):
+                size += sys.getsizeof(posting)
+        for words in self._track_words:
+            if words is not None:
+                size += sys.getsizeof(words)
+        return size
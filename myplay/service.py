@@ -16,9 +16,15 @@
 # You should have received a copy of the GNU General Public License
 # along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
 #
+import ConfigParser
+import locale
+import multiprocessing
+import os
+
 import dbus
 import dbus.mainloop.glib
 import dbus.service
+import glib
 import gobject
 
 from myplay.common import BUS_NAME, OBJECT_PATH
@@ -26,15 +32,48 @@ from myplay.player import Player
 
 IDLE_TIMEOUT = 5
 
+# (section, option, type, Player argument) of options read from service.cfg
+CONFIG_OPTIONS = (
+    ('scanner', 'pipelines', 'int', 'scan_pipelines'),
+    ('scanner', 'idle-time', 'int', 'idle_scan_time'),
+    ('signals', 'tags-changed-delay', 'int', 'tags_changed_delay'),
+    ('signals', 'tags-changed-max', 'int', 'tags_changed_max'),
+    ('signals', 'tag-changed', 'boolean', 'tag_changed_signal'),
+    ('playback', 'gapless', 'boolean', 'gapless'),
+    ('playback', 'audio-sink', 'str', 'audio_sink'),
+    ('cache', 'size', 'int', 'stream_cache_size'),
+    ('stats', 'enabled', 'boolean', 'stats_enabled'),
+)
+
+def load_config():
+    """Read Player arguments from the service.cfg in user's config directory"""
+    config = {
+        'scan_pipelines': min(multiprocessing.cpu_count(), 4),
+    }
+    path = os.path.join(glib.get_user_config_dir(), 'myplay', 'service.cfg')
+    cp = ConfigParser.RawConfigParser()
+    cp.read(path)
+    for section, option, type, name in CONFIG_OPTIONS:
+        if not cp.has_option(section, option):
+            continue
+        getter = getattr(cp, type == 'str' and 'get' or 'get' + type)
+        try:
+            config[name] = getter(section, option)
+        except ValueError:
+            pass
+    return config
+
 class Application(object):
     
     def __init__(self):
+        gobject.threads_init()
+        dbus.mainloop.glib.threads_init()
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         self._loop = gobject.MainLoop()
         bus = dbus.SessionBus()
         self._timeout_id = 0
         self._bus_name = dbus.service.BusName(BUS_NAME, bus) # preserve well known bus name
-        self._player = Player(self.idle_callback)
+        self._player = Player(self.idle_callback, **load_config())
         self._player.add_to_connection(bus, OBJECT_PATH)
     
     def idle_callback(self, player, idle):
@@ -49,8 +88,14 @@ class Application(object):
     
     def quit(self):
         self._player.remove_from_connection()
+        self._player.close()
         self._loop.quit()
 
 def main():
+    try:
+        # SortBy uses collation of the user's locale
+        locale.setlocale(locale.LC_COLLATE, '')
+    except locale.Error:
+        pass
     app = Application()
     app.run()
@@ -0,0 +1,134 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import locale
+import os
+import urllib
+
+from myplay.common import uri_to_path
+from myplay.tagreader import TAGS, TAG_TITLE, TAG_ARTIST, TAG_ALBUM
+from myplay.trackstore import SHARED_TAGS
+
+SORT_PATH = 'path'
+
+SORT_KEYS = (TAG_ARTIST, TAG_ALBUM, TAG_TITLE, SORT_PATH)
+
+# indexes of tag keys in TAGS, for TrackStore.tag_value
+TAG_INDEXES = dict((tag, TAGS.index(tag)) for tag in SORT_KEYS if tag in TAGS)
+
+def collation_key(text, encoding='utf-8'):
+    """Return key of utf-8 text sorting case-insensitively by current collation locale
+
+    Encoding is the one of the collation locale.
+
+    """
+    text = text.decode('utf-8', 'replace').lower()
+    try:
+        return locale.strxfrm(text.encode(encoding))
+    except (LookupError, UnicodeError):
+        return locale.strxfrm(text.encode('utf-8'))
+
+def _collation_encoding():
+    return locale.getlocale(locale.LC_COLLATE)[1] or 'utf-8'
+
+def _sort_value(key, uri, value):
+    """Return text to sort by for key, given uri and value of the tag for tag keys"""
+    if key == SORT_PATH:
+        return uri_to_path(uri) or urllib.unquote(uri)
+    if not value and key == TAG_TITLE:
+        # untitled files sort by their file name
+        value = os.path.basename(uri_to_path(uri) or urllib.unquote(uri))
+    return value or ''
+
+class SortKeyCache(object):
+    """Collation keys of tracks of a TrackStore for keys in SORT_KEYS
+
+    Collation keys of tracks are computed by "update", which the owner
+    calls when tracks are added or their tags change, or else when they're
+    sorted first, and kept until tags change, so sorting a playlist is
+    mostly the cost of the sort itself. Keys are kept in lists indexed by
+    track id, like the tags in the store.
+
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._keys = dict((key, []) for key in SORT_KEYS)
+        # artists and albums repeat a lot, so every value is transformed
+        # once, these map values to their collation keys
+        self._collated = dict((key, {}) for key in SHARED_TAGS if key in SORT_KEYS)
+
+    def invalidate(self, track_id):
+        for keys in self._keys.itervalues():
+            if track_id < len(keys):
+                keys[track_id] = None
+
+    def clear(self):
+        for keys in self._keys.itervalues():
+            del keys[:]
+        for collated in self._collated.itervalues():
+            collated.clear()
+
+    def update(self, track_ids):
+        """Compute missing collation keys of tracks with given ids for all keys"""
+        encoding = _collation_encoding()
+        for key in SORT_KEYS:
+            self._fill(key, track_ids, encoding)
+
+    def _fill(self, key, ids, encoding):
+        keys = self._keys[key]
+        if ids:
+            missing = max(ids) + 1 - len(keys)
+            if missing > 0:
+                keys.extend([None] * missing)
+        store = self._store
+        tag_index = TAG_INDEXES.get(key)
+        collated = self._collated.get(key)
+        if collated is None:
+            collated = {}
+        for track_id in ids:
+            if keys[track_id] is None:
+                value = None
+                if tag_index is not None:
+                    value = store.tag_value(track_id, tag_index)
+                if key == SORT_PATH or key == TAG_TITLE and not value:
+                    text = _sort_value(key, store.uri(track_id), value)
+                else:
+                    text = value or ''
+                collation = collated.get(text)
+                if collation is None:
+                    collation = collated[text] = collation_key(text, encoding)
+                keys[track_id] = collation
+        return keys
+
+    def sorted_positions(self, playlist, keys, descending=False):
+        """Return positions of Playlist entries in the order given by list of sort keys
+
+        Sorting is stable, so entries with equal keys keep their order.
+
+        """
+        encoding = _collation_encoding()
+        ids = playlist.ids()
+        caches = [self._fill(key, ids, encoding) for key in keys]
+        # sorting by every key, from the last one, is stable and cheaper
+        # than building a tuple of keys for every entry
+        order = range(len(ids))
+        for cache in reversed(caches):
+            entry_keys = map(cache.__getitem__, ids)
+            order.sort(key=entry_keys.__getitem__, reverse=descending)
+        return order
@@ -0,0 +1,134 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Runtime counters and latency histograms
+
+Instrumented code checks "stats.enabled" before taking any measurements,
+so disabled statistics cost one attribute lookup on hot paths:
+
+    if stats.enabled:
+        start = time.time()
+    ...
+    if stats.enabled:
+        stats.observe('journal.flush', time.time() - start)
+
+Values can be recorded from any thread.
+
+"""
+import bisect
+import threading
+
+# upper bounds of histogram buckets in milliseconds, the last bucket is
+# for everything slower
+BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+PERCENTILES = (50, 90, 99)
+
+class Histogram(object):
+    """Distribution of durations in fixed logarithmic buckets"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, ms):
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+        self._buckets[bisect.bisect_left(BUCKETS, ms)] += 1
+
+    def percentile(self, percent):
+        """Return upper bound of the bucket holding given percentile"""
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self._buckets):
+            seen += count
+            if seen >= rank and count:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                return self.max
+        return self.max or 0.0
+
+    def to_dict(self):
+        result = {'count': float(self.count)}
+        if self.count:
+            result.update({
+                'total_ms': self.total,
+                'mean_ms': self.total / self.count,
+                'min_ms': self.min,
+                'max_ms': self.max,
+            })
+            for percent in PERCENTILES:
+                result['p%d_ms' % percent] = self.percentile(percent)
+        return result
+
+class Stats(object):
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def count(self, group, name, value=1):
+        """Add value to the counter name in group"""
+        self._lock.acquire()
+        try:
+            counters = self._counters.setdefault(group, {})
+            counters[name] = counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, seconds):
+        """Add duration in seconds to the histogram name"""
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds * 1000)
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._counters = {}
+            self._histograms = {}
+        finally:
+            self._lock.release()
+
+    def to_dict(self):
+        """Return {name: {field: value}} of counter groups and histograms"""
+        self._lock.acquire()
+        try:
+            result = dict((group, dict((name, float(value)) for name, value in counters.iteritems()))
+                          for group, counters in self._counters.iteritems())
+            for name, histogram in self._histograms.iteritems():
+                result[name] = histogram.to_dict()
+        finally:
+            self._lock.release()
+        return result
+
+stats = Stats()
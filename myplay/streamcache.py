@@ -0,0 +1,255 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import os
+import posixpath
+import threading
+import time
+import urlparse
+import cPickle as pickle
+
+import glib
+
+from myplay.common import path_to_uri
+
+CACHE_VERSION = 1
+
+CACHED_SCHEMES = ('http://', 'https://')
+
+# a single stream may take up to this part of the cache, so internet radio
+# and other endless streams are dropped instead of evicting everything
+MAX_ENTRY_FRACTION = 4
+
+def is_cacheable(uri):
+    return uri.startswith(CACHED_SCHEMES)
+
+class StreamCache(object):
+    """Size-bounded LRU cache of remote files on disk
+
+    Files are cached while they're played: the data read by the source
+    element of the playback pipeline is written to a ".part" file as it
+    arrives (see "attach"), and the file is added to the cache when the
+    source reaches the end of the stream, so nothing is downloaded twice.
+    Streams that are seeked, stopped before the end, bigger than a
+    fraction of the cache or of unknown length are dropped.
+
+    Cached files are returned by "lookup" and are played and scanned for
+    tags instead of fetching the uri again. When the total size goes over
+    max_size, least recently used files are removed.
+
+    Downloads are written from GStreamer streaming threads, everything else
+    is expected to be called from the main loop.
+
+    """
+
+    def __init__(self, directory, max_size):
+        self._dir = directory
+        self._index_path = os.path.join(directory, 'index')
+        self._max_size = max_size
+        self._entries = {}
+        self._size = 0
+        self._downloads = []
+        self._lock = threading.Lock()
+        self.dirty = False
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def _load(self):
+        try:
+            data = pickle.load(open(self._index_path, 'rb'))
+        except:
+            data = {}
+        if data.get('version') == CACHE_VERSION:
+            for uri, entry in data['entries'].iteritems():
+                if os.path.exists(os.path.join(self._dir, entry[0])):
+                    self._entries[uri] = entry
+                    self._size += entry[1]
+        # remove partial downloads and files left by a crash
+        known = set(entry[0] for entry in self._entries.itervalues())
+        known.add(os.path.basename(self._index_path))
+        for name in os.listdir(self._dir):
+            if name not in known:
+                try:
+                    os.unlink(os.path.join(self._dir, name))
+                except OSError:
+                    pass
+        self._evict()
+
+    def _filename(self, uri):
+        # keep the extension, it helps the fast tag reader
+        ext = posixpath.splitext(urlparse.urlsplit(uri).path)[1][:8]
+        return hashlib.sha1(uri).hexdigest() + ext
+
+    def lookup(self, uri):
+        """Return path of the cached file for uri or None, marking it as recently used"""
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry is None:
+                return None
+            path = os.path.join(self._dir, entry[0])
+            if not os.path.exists(path):
+                self._remove(uri)
+                return None
+            entry[2] = time.time()
+            self.dirty = True
+            return path
+
+    def lookup_uri(self, uri):
+        """Return file:// uri of the cached file for uri or uri itself"""
+        if not is_cacheable(uri):
+            return uri
+        path = self.lookup(uri)
+        if path is None:
+            return uri
+        return path_to_uri(path)
+
+    def attach(self, source, uri):
+        """Cache data of uri read by GStreamer source element, if it's not cached yet"""
+        if not is_cacheable(uri) or uri in self._entries:
+            return
+        path = os.path.join(self._dir, self._filename(uri) + '.part')
+        try:
+            download = _Download(self, uri, path, self._max_size // MAX_ENTRY_FRACTION)
+        except EnvironmentError:
+            return
+        with self._lock:
+            self._downloads.append(download)
+        pad = source.get_pad('src')
+        pad.add_buffer_probe(download.on_buffer)
+        pad.add_event_probe(download.on_event)
+
+    def abort_downloads(self):
+        """Drop unfinished downloads, called when the playback pipeline is stopped"""
+        with self._lock:
+            downloads, self._downloads = self._downloads, []
+        for download in downloads:
+            download.abort()
+
+    def _finished(self, download):
+        # called in the main loop
+        with self._lock:
+            if download not in self._downloads:
+                return False
+            self._downloads.remove(download)
+            self._remove(download.uri)
+            filename = self._filename(download.uri)
+            try:
+                os.rename(download.path, os.path.join(self._dir, filename))
+            except OSError:
+                return False
+            self._entries[download.uri] = [filename, download.written, time.time()]
+            self._size += download.written
+            self._evict()
+        # save the index right away, so files aren't lost on a crash
+        try:
+            self.save()
+        except EnvironmentError:
+            self.dirty = True
+        return False
+
+    def _remove(self, uri):
+        entry = self._entries.pop(uri, None)
+        if entry is not None:
+            self._size -= entry[1]
+            try:
+                os.unlink(os.path.join(self._dir, entry[0]))
+            except OSError:
+                pass
+
+    def _evict(self):
+        if self._size <= self._max_size:
+            return
+        entries = sorted(self._entries.iteritems(), key=lambda item: item[1][2])
+        for uri, entry in entries:
+            if self._size <= self._max_size:
+                break
+            self._remove(uri)
+        self.dirty = True
+
+    def save(self):
+        with self._lock:
+            data = {'version': CACHE_VERSION, 'entries': dict(self._entries)}
+            self.dirty = False
+        tmp_path = self._index_path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, self._index_path)
+
+class _Download(object):
+    """Data of a stream being written to a partial file from a streaming thread"""
+
+    def __init__(self, cache, uri, path, max_size):
+        self.uri = uri
+        self.path = path
+        self.written = 0
+        self._cache = cache
+        self._max_size = max_size
+        self._file = open(path, 'wb')
+        self._lock = threading.Lock()
+
+    def on_buffer(self, pad, buffer):
+        import gst
+        with self._lock:
+            if self._file is None:
+                return True
+            if buffer.offset not in (self.written, gst.BUFFER_OFFSET_NONE) or \
+                    self.written + buffer.size > self._max_size:
+                # seeked or too big
+                self._close(True)
+                return True
+            try:
+                self._file.write(str(buffer))
+            except EnvironmentError:
+                self._close(True)
+                return True
+            self.written += buffer.size
+        return True
+
+    def on_event(self, pad, event):
+        import gst
+        if event.type == gst.EVENT_EOS:
+            try:
+                size = pad.query_duration(gst.FORMAT_BYTES)[0]
+            except gst.QueryError:
+                size = -1
+            with self._lock:
+                if self._file is None:
+                    return True
+                # a cut connection ends the stream too, so it's complete
+                # only if the server told its length and all of it arrived
+                complete = self.written > 0 and size == self.written
+                self._close(not complete)
+                if complete:
+                    glib.idle_add(self._cache._finished, self)
+        return True
+
+    def abort(self):
+        with self._lock:
+            self._close(True)
+
+    def _close(self, remove):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if remove and os.path.exists(self.path):
+            os.unlink(self.path)
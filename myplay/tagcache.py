@@ -0,0 +1,180 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import cPickle as pickle
+
+from myplay.common import uri_to_path
+from myplay.tagreader import TAGS
+
+CACHE_VERSION = 3
+
+# number of entries pickled at once when saving
+SAVE_CHUNK = 1000
+
+class TagCache(object):
+    """Persistent tag cache for local files
+
+    Tags are stored together with modification time and size of the file
+    they were read from, so a cached entry is only returned while the file
+    is left untouched. Stale entries are dropped on lookup.
+
+    Only local (file://) uris are cached, because there's no cheap way
+    to tell whether a remote resource was changed.
+
+    The cache keeps no tags itself: cached tags are loaded into the
+    TrackStore, for tracks in it, and file modification times and sizes are
+    kept there too, so the cache only holds the tracks of the playlist.
+    Tracks removed from the store are passed to "retire" and kept until the
+    next "save", so removing and adding them again doesn't scan them again.
+
+    The file is written in chunks, made from the store when saving, so it
+    doesn't need a copy of all entries in memory.
+
+    """
+
+    def __init__(self, path, store):
+        self._path = path
+        self._store = store
+        self._retired = {}
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            f = open(self._path, 'rb')
+            try:
+                unpickler = pickle.Unpickler(f)
+                data = unpickler.load()
+                version = data.get('version')
+                if version == CACHE_VERSION:
+                    while True:
+                        try:
+                            chunk = unpickler.load()
+                        except EOFError:
+                            break
+                        for uri, mtime, size, values in chunk:
+                            self._add(uri, (mtime, size), values)
+                elif version == 2:
+                    for uri, (mtime, size, values) in data['entries'].iteritems():
+                        self._add(uri, (mtime, size), values)
+                    self.dirty = True
+                elif version == 1:
+                    for uri, (mtime, size, tags) in data['entries'].iteritems():
+                        self._add(uri, (mtime, size), [tags.get(tag) for tag in TAGS])
+                    self.dirty = True
+            finally:
+                f.close()
+        except:
+            return
+
+    def _add(self, uri, stat, values):
+        track_id = self._store.id(uri)
+        if track_id is not None:
+            self._store.set_tag_values(track_id, values)
+            self._store.set_file_stat(track_id, stat)
+
+    def _stat(self, uri):
+        path = uri_to_path(uri)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def lookup(self, uri):
+        """Return cached tags for uri or None if there's no valid entry
+
+        Tags of retired tracks are put back into the store.
+
+        """
+        track_id = self._store.id(uri)
+        if track_id is None:
+            return None
+        stat = self._store.file_stat(track_id)
+        if stat is None:
+            retired = self._retired.pop(uri, None)
+            if retired is None:
+                return None
+            stat, values = retired
+            self._store.set_tag_values(track_id, values)
+            self._store.set_file_stat(track_id, stat)
+        if self._stat(uri) != stat:
+            self._store.set_file_stat(track_id, None)
+            self.dirty = True
+            return None
+        return self._store.get_tags(track_id)
+
+    def store(self, uri):
+        """Remember the file of uri as the source of its tags in the store"""
+        track_id = self._store.id(uri)
+        if track_id is None:
+            return
+        self._store.set_file_stat(track_id, self._stat(uri))
+        self.dirty = True
+
+    def invalidate(self, uri):
+        self._retired.pop(uri, None)
+        track_id = self._store.id(uri)
+        if track_id is not None and self._store.file_stat(track_id) is not None:
+            self._store.set_file_stat(track_id, None)
+            self.dirty = True
+
+    def retire(self, tracks):
+        """Keep cached tags of (track id, uri) pairs of tracks just removed from the store until next save"""
+        store = self._store
+        for track_id, uri in tracks:
+            stat = store.file_stat(track_id)
+            if stat is not None:
+                self._retired[uri] = (stat, store.tag_values(track_id))
+
+    def save(self):
+        """Write entries of the tracks in the store to disk, dropping retired ones"""
+        self._retired = {}
+        store = self._store
+        tmp_path = self._path + '.tmp'
+        f = open(tmp_path, 'wb')
+        count = 0
+        try:
+            pickle.dump({'version': CACHE_VERSION}, f, pickle.HIGHEST_PROTOCOL)
+            chunk = []
+            for track_id in store.ids():
+                stat = store.file_stat(track_id)
+                if stat is None:
+                    continue
+                chunk.append((store.uri(track_id), stat[0], stat[1], store.tag_values(track_id)))
+                if len(chunk) == SAVE_CHUNK:
+                    pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+                count += len(chunk)
+        finally:
+            f.close()
+        if count:
+            os.rename(tmp_path, self._path)
+        else:
+            os.unlink(tmp_path)
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+        self.dirty = False
@@ -0,0 +1,311 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Lightweight tag reader for common local audio formats
+
+It reads only the tag headers of MP3 (ID3v2 and ID3v1), FLAC, Ogg Vorbis/Opus
+and MP4/M4A files, seeking over anything it's not interested in (like embedded
+pictures or audio data), so reading tags of a file costs a few small reads.
+
+The read_tags function returns None for everything it can't handle, so the
+caller can fall back to the full GStreamer-based scanning.
+
+"""
+import cStringIO
+import os
+import struct
+
+# same values as gst.TAG_TITLE, gst.TAG_ARTIST and gst.TAG_ALBUM
+TAG_TITLE = 'title'
+TAG_ARTIST = 'artist'
+TAG_ALBUM = 'album'
+
+TAGS = (TAG_TITLE, TAG_ARTIST, TAG_ALBUM)
+
+# maximum size of a single tag value or comment block we're going to read
+MAX_VALUE_SIZE = 64 * 1024
+
+# maximum size of ogg comment packet and unsynchronized ID3v2.3 tag
+MAX_HEADER_SIZE = 512 * 1024
+
+ID3V2_FRAMES = {
+    'TIT2': TAG_TITLE, 'TPE1': TAG_ARTIST, 'TALB': TAG_ALBUM,
+    'TT2': TAG_TITLE, 'TP1': TAG_ARTIST, 'TAL': TAG_ALBUM,
+}
+
+ID3V2_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+VORBIS_FIELDS = {'TITLE': TAG_TITLE, 'ARTIST': TAG_ARTIST, 'ALBUM': TAG_ALBUM}
+
+MP4_ITEMS = {'\xa9nam': TAG_TITLE, '\xa9ART': TAG_ARTIST, '\xa9alb': TAG_ALBUM}
+
+MP4_CONTAINERS = ('moov', 'udta', 'ilst')
+
+class UnsupportedFile(Exception):
+    pass
+
+def read_tags(path):
+    """Return dict of tags for file at given path or None if it's unsupported"""
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return _read_tags(f, path)
+        except (UnsupportedFile, IOError, struct.error, UnicodeError, ValueError):
+            return None
+    finally:
+        f.close()
+
+def _read_tags(f, path):
+    magic = f.read(12)
+    f.seek(0)
+    if magic.startswith('ID3'):
+        return _read_mp3(f)
+    elif magic.startswith('fLaC'):
+        f.seek(4)
+        return _read_flac(f)
+    elif magic.startswith('OggS'):
+        return _read_ogg(f)
+    elif magic[4:8] == 'ftyp':
+        return _read_mp4(f)
+    elif path.lower().endswith('.mp3'):
+        return _read_mp3(f)
+    raise UnsupportedFile
+
+def _decode(data, encoding='utf-8'):
+    value = data.decode(encoding).split(u'\x00')[0].strip()
+    return value.encode('utf-8')
+
+def _read_mp3(f):
+    tags = _read_id3v1(f)
+    tags.update(_read_id3v2(f))
+    return tags
+
+def _read_id3v1(f):
+    f.seek(0, os.SEEK_END)
+    if f.tell() < 128:
+        return {}
+    f.seek(-128, os.SEEK_END)
+    data = f.read(128)
+    if not data.startswith('TAG'):
+        return {}
+    tags = {}
+    for key, start in ((TAG_TITLE, 3), (TAG_ARTIST, 33), (TAG_ALBUM, 63)):
+        value = _decode(data[start:start + 30], 'latin-1')
+        if value:
+            tags[key] = value
+    return tags
+
+def _syncsafe(data):
+    b = struct.unpack('>4B', data)
+    return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+def _unsync(data):
+    return data.replace('\xff\x00', '\xff')
+
+def _read_id3v2(f):
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or not header.startswith('ID3'):
+        return {}
+    version, flags = ord(header[3]), ord(header[5])
+    if version not in (2, 3, 4):
+        raise UnsupportedFile
+    size = _syncsafe(header[6:10])
+    end = 10 + size
+
+    if flags & 0x80 and version < 4:
+        # whole tag is unsynchronized, so we have to read it at once
+        if size > MAX_HEADER_SIZE:
+            raise UnsupportedFile
+        f = cStringIO.StringIO(header + _unsync(f.read(size)))
+        end = f.len
+
+    f.seek(10)
+    if flags & 0x40 and version > 2:
+        ext_header = f.read(4)
+        if version == 3:
+            f.seek(struct.unpack('>I', ext_header)[0], os.SEEK_CUR)
+        else:
+            f.seek(_syncsafe(ext_header) - 4, os.SEEK_CUR)
+
+    if version == 2:
+        frame_header_size = 6
+    else:
+        frame_header_size = 10
+
+    tags = {}
+    while f.tell() + frame_header_size <= end and len(tags) < len(TAGS):
+        frame_header = f.read(frame_header_size)
+        if frame_header[0] == '\x00':
+            # padding
+            break
+        if version == 2:
+            frame_id = frame_header[:3]
+            frame_size = struct.unpack('>I', '\x00' + frame_header[3:6])[0]
+            frame_flags = 0
+        else:
+            frame_id = frame_header[:4]
+            if version == 3:
+                frame_size = struct.unpack('>I', frame_header[4:8])[0]
+            else:
+                frame_size = _syncsafe(frame_header[4:8])
+            frame_flags = struct.unpack('>H', frame_header[8:10])[0]
+
+        key = ID3V2_FRAMES.get(frame_id)
+        if key is None or frame_size > MAX_VALUE_SIZE:
+            f.seek(frame_size, os.SEEK_CUR)
+            continue
+
+        data = f.read(frame_size)
+        if version == 3 and frame_flags & 0x00c0:
+            # compressed or encrypted
+            continue
+        if version == 4:
+            if frame_flags & 0x000c:
+                continue
+            if frame_flags & 0x0002:
+                data = _unsync(data)
+            if frame_flags & 0x0001:
+                data = data[4:]
+        if not data or ord(data[0]) > 3:
+            continue
+        encoding, data = ord(data[0]), data[1:]
+        if encoding in (1, 2) and len(data) % 2:
+            data = data[:-1]
+        value = _decode(data, ID3V2_ENCODINGS[encoding])
+        if value:
+            tags[key] = value
+    return tags
+
+def _parse_vorbis_comment(data):
+    vendor_length = struct.unpack('<I', data[:4])[0]
+    pos = 4 + vendor_length
+    count = struct.unpack('<I', data[pos:pos + 4])[0]
+    pos += 4
+    tags = {}
+    for i in xrange(count):
+        length = struct.unpack('<I', data[pos:pos + 4])[0]
+        pos += 4
+        comment = data[pos:pos + length]
+        if len(comment) < length:
+            raise UnsupportedFile
+        pos += length
+        name, sep, value = comment.partition('=')
+        key = VORBIS_FIELDS.get(name.upper())
+        if key is not None and key not in tags:
+            value = _decode(value)
+            if value:
+                tags[key] = value
+    return tags
+
+def _read_flac(f):
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            raise UnsupportedFile
+        block_type = ord(header[0]) & 0x7f
+        is_last = ord(header[0]) & 0x80
+        length = struct.unpack('>I', '\x00' + header[1:])[0]
+        if block_type == 4:
+            if length > MAX_HEADER_SIZE:
+                raise UnsupportedFile
+            return _parse_vorbis_comment(f.read(length))
+        if is_last:
+            return {}
+        f.seek(length, os.SEEK_CUR)
+
+def _read_ogg_packets(f, count):
+    """Return first count packets of the first logical stream in ogg file"""
+    packets = []
+    packet = []
+    packet_size = 0
+    serial = None
+    while len(packets) < count:
+        header = f.read(27)
+        if len(header) < 27 or not header.startswith('OggS'):
+            raise UnsupportedFile
+        page_serial = struct.unpack('<I', header[14:18])[0]
+        lacing = struct.unpack('%dB' % ord(header[26]), f.read(ord(header[26])))
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            f.seek(sum(lacing), os.SEEK_CUR)
+            continue
+        for value in lacing:
+            packet.append(f.read(value))
+            packet_size += value
+            if packet_size > MAX_HEADER_SIZE:
+                raise UnsupportedFile
+            if value < 255:
+                packets.append(''.join(packet))
+                packet = []
+                packet_size = 0
+                if len(packets) == count:
+                    break
+    return packets
+
+def _read_ogg(f):
+    first, second = _read_ogg_packets(f, 2)
+    if first.startswith('\x01vorbis') and second.startswith('\x03vorbis'):
+        return _parse_vorbis_comment(second[7:])
+    elif first.startswith('OpusHead') and second.startswith('OpusTags'):
+        return _parse_vorbis_comment(second[8:])
+    raise UnsupportedFile
+
+def _read_mp4_atoms(f, end):
+    """Yield (type, data_start, data_end) of atoms between current position and end"""
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        size, atom_type = struct.unpack('>I4s', f.read(8))
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+        elif size == 0:
+            size = end - start
+        if size < 8:
+            raise UnsupportedFile
+        data_start = f.tell()
+        yield atom_type, data_start, start + size
+        f.seek(start + size)
+
+def _read_mp4(f, end=None, tags=None):
+    if end is None:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(0)
+        tags = {}
+    for atom_type, start, atom_end in _read_mp4_atoms(f, end):
+        if atom_type in MP4_CONTAINERS:
+            _read_mp4(f, atom_end, tags)
+        elif atom_type == 'meta':
+            # "meta" is a full atom, skip its version and flags
+            f.seek(start + 4)
+            _read_mp4(f, atom_end, tags)
+        elif atom_type in MP4_ITEMS and atom_end - start <= MAX_VALUE_SIZE:
+            data = f.read(atom_end - start)
+            # "data" atom: size, type, 4 bytes of type indicator, 4 bytes of locale
+            if data[4:8] == 'data' and struct.unpack('>I', data[8:12])[0] == 1:
+                value = _decode(data[16:struct.unpack('>I', data[:4])[0]])
+                if value:
+                    tags[MP4_ITEMS[atom_type]] = value
+        if atom_type == 'moov':
+            # all metadata is in "moov", don't bother seeking through the rest
+            break
+    return tags
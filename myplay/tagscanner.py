@@ -16,34 +16,325 @@
 # You should have received a copy of the GNU General Public License
 # along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
 #
-import gst
+import Queue
+import heapq
+import os
+import threading
+import time
+import cPickle as pickle
 
-USED_TAGS = (gst.TAG_TITLE, gst.TAG_ARTIST, gst.TAG_ALBUM)
+import glib
+
+from myplay.common import path_to_uri, uri_to_path
+from myplay.stats import stats
+from myplay.tagreader import TAGS, read_tags
+
+USED_TAGS = TAGS
+
+# number of files passed at once to the thread reading them with the fast
+# tag reader
+FAST_SCAN_BATCH = 50
+
+# scan priorities, lower values are scanned first
+PRIORITY_PLAYING = 0
+PRIORITY_VISIBLE = 1
+PRIORITY_NORMAL = 2
+
+class ScanQueue(object):
+    """Priority queue of distinct uris
+
+    Uris of the same priority are popped in the order they were added. Adding
+    a uri that is already queued only raises its priority if the new one is
+    higher, so every uri is popped once. Push and pop are O(log n), "in" and
+    len are O(1).
+
+    Raising priority leaves the old heap entry in place, it's skipped when
+    popped, and the heap is rebuilt when such stale entries outnumber the
+    live ones.
+
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, uri):
+        return uri in self._entries
+
+    def push(self, uri, priority=PRIORITY_NORMAL):
+        entry = self._entries.get(uri)
+        if entry is not None and entry[0] <= priority:
+            return
+        self._counter += 1
+        entry = (priority, self._counter, uri)
+        self._entries[uri] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 100:
+            self._heap = self._entries.values()
+            heapq.heapify(self._heap)
+
+    def raise_priority(self, uri, priority):
+        """Raise priority of uri if it's queued, return whether it is"""
+        if uri not in self._entries:
+            return False
+        self.push(uri, priority)
+        return True
+
+    def pop(self):
+        """Return (uri, priority) with the highest priority, raise IndexError if empty"""
+        while True:
+            entry = heapq.heappop(self._heap)
+            priority, counter, uri = entry
+            if self._entries.get(uri) is entry:
+                del self._entries[uri]
+                return uri, priority
+
+    def items(self):
+        """Return list of queued (uri, priority) pairs in the order they'd be popped"""
+        return [(uri, priority) for priority, counter, uri in sorted(self._entries.itervalues())]
 
 class TagScanner(object):
     """Asynchronous tag scanner
     
     Create it, passing a callback function with (uri_string, tags_dict) signature.
-    Then use it calling the "add(uris)" function.
+    Then use it calling the "add(uris, priority)" function.
     
-    It works by creating a GStreamer playbin2 pipeline and loading files until they
+    It works by creating GStreamer playbin2 pipelines and loading files until they
     can be played, while collecting their tags. After a file is loaded, it invokes
-    given callback passing uri and collected tags to it.
+    given callback passing uri and collected tags to it. The callback is invoked
+    for every scanned uri, even if no tags were found, so the tags_dict can be empty.
+
+    Up to "pipelines" files are loaded at the same time, each by its own pipeline,
+    so the callback is invoked in order files finish loading, not the order they
+    were added in. Pipelines are created on demand and reused afterwards.
+
+    Pending uris are kept in ScanQueues, so files of higher priority (see the
+    PRIORITY_* constants) are scanned first and a uri that is waiting for a
+    scan or being scanned isn't queued again.
+
+    GStreamer itself is only imported when the first pipeline is needed.
+
+    If "fast_path" is enabled, tags of local files are first read with the
+    lightweight tag reader and only files it can't handle are loaded by the
+    pipelines. Files are read in a worker thread, a batch at a time, so slow
+    or network filesystems don't block the main loop, and results are passed
+    back to it with an idle callback.
+
+    If "resolve_func" is given, it's called with remote uris and can return
+    the path of a local copy, e.g. from the stream cache, which is scanned
+    instead of fetching the uri.
+
+    If "busy_callback" attribute is set, it's called with the new value of
+    "busy" property whenever it changes.
+
+    Pending uris can be written to a file with "save" and queued again with
+    "load", so a restarted scanner continues where the previous one stopped.
 
     The tags_dict, passed to the callback is safe to use without copying, as it's
     not used by tag scanner any longer after callback has been called.
 
     """
     
+    def __init__(self, callback, pipelines=1, fast_path=True, resolve_func=None):
+        self._uris = ScanQueue()
+        self._pipeline_uris = ScanQueue()
+        # uris being loaded by pipelines and their priorities
+        self._scanning = {}
+        self._fast_path = fast_path
+        self._resolve_func = resolve_func
+        # uris being read by the fast scan thread and their priorities
+        self._reading = {}
+        self._fast_scan_requests = None
+        self._callback = callback
+        self._max_pipelines = max(1, pipelines)
+        self._pipelines = []
+        self._free_pipelines = []
+        self.busy_callback = None
+        self._was_busy = False
+
+    @property
+    def busy(self):
+        return (bool(self._uris or self._pipeline_uris or self._reading)
+                or len(self._free_pipelines) < len(self._pipelines))
+
+    @property
+    def queued(self):
+        """Number of uris waiting to be scanned"""
+        return len(self._uris) + len(self._pipeline_uris)
+
+    @property
+    def scanning(self):
+        """Number of uris being read by the fast scan thread or loaded by pipelines"""
+        return len(self._reading) + len(self._scanning)
+
+    def _check_busy(self):
+        busy = self.busy
+        if busy != self._was_busy:
+            self._was_busy = busy
+            if self.busy_callback is not None:
+                self.busy_callback(busy)
+
+    def _fast_scan(self):
+        """Pass the next batch of uris to the fast scan thread, unless it's busy"""
+        if self._reading or not self._uris:
+            return
+        batch = []
+        while self._uris and len(batch) < FAST_SCAN_BATCH:
+            uri, priority = self._uris.pop()
+            self._reading[uri] = priority
+            # the stream cache is only used from the main loop, so the
+            # cached copy is looked up here
+            batch.append((uri, uri_to_path(uri) or self._cached_path(uri)))
+        if self._fast_scan_requests is None:
+            self._fast_scan_requests = Queue.Queue()
+            thread = threading.Thread(target=self._fast_scan_thread, args=(self._fast_scan_requests,))
+            thread.setDaemon(True)
+            thread.start()
+        self._fast_scan_requests.put(batch)
+
+    def _fast_scan_thread(self, requests):
+        while True:
+            results = []
+            for uri, path in requests.get():
+                start = time.time()
+                tags = None
+                if path is not None:
+                    try:
+                        tags = read_tags(path)
+                    except Exception:
+                        # an unexpected error mustn't stop the thread, the
+                        # file is left for the pipelines
+                        pass
+                results.append((uri, tags, time.time() - start))
+            glib.idle_add(self._on_fast_scanned, results)
+
+    def _on_fast_scanned(self, results):
+        for uri, tags, elapsed in results:
+            priority = self._reading.pop(uri)
+            if tags is None:
+                self._pipeline_uris.push(uri, priority)
+            else:
+                if stats.enabled:
+                    stats.observe('scan.fast', elapsed)
+                    stats.count('scan', 'fast')
+                self._callback(uri, tags)
+        self._fast_scan()
+        self._next()
+        self._check_busy()
+        return False
+
+    def _cached_path(self, uri):
+        if self._resolve_func is None or uri.startswith('file://'):
+            return None
+        return self._resolve_func(uri)
+
+    def _next(self):
+        while self._pipeline_uris:
+            if self._free_pipelines:
+                pipeline = self._free_pipelines.pop()
+            elif len(self._pipelines) < self._max_pipelines:
+                pipeline = _ScanPipeline(self._on_pipeline_finished)
+                self._pipelines.append(pipeline)
+            else:
+                break
+            uri, priority = self._pipeline_uris.pop()
+            self._scanning[uri] = priority
+            path = self._cached_path(uri)
+            pipeline.start(uri, path and path_to_uri(path))
+
+    def _on_pipeline_finished(self, pipeline, uri, tags):
+        if stats.enabled and pipeline.start_time is not None:
+            stats.observe('scan.pipeline', time.time() - pipeline.start_time)
+            stats.count('scan', 'pipeline')
+        self._free_pipelines.append(pipeline)
+        del self._scanning[uri]
+        self._callback(uri, tags)
+        self._next()
+        self._check_busy()
+
+    def add(self, uris, priority=PRIORITY_NORMAL):
+        """Queue uris for scanning, raising priority of ones already queued"""
+        if self._fast_path:
+            queue = self._uris
+        else:
+            queue = self._pipeline_uris
+        for uri in uris:
+            if uri in self._pipeline_uris:
+                self._pipeline_uris.push(uri, priority)
+            elif uri not in self._scanning and uri not in self._reading:
+                queue.push(uri, priority)
+        self._fast_scan()
+        self._next()
+        self._check_busy()
+
+    def prioritize(self, uris, priority):
+        """Raise priority of given uris, if they are waiting to be scanned"""
+        for uri in uris:
+            if not self._uris.raise_priority(uri, priority):
+                self._pipeline_uris.raise_priority(uri, priority)
+
+    def save(self, path):
+        """Write uris waiting for scan or being scanned to file"""
+        # uris being loaded have already been tried by the fast reader, so
+        # they are queued for pipelines again
+        reading = sorted(self._reading.iteritems(), key=lambda item: item[1])
+        pipeline_uris = sorted(self._scanning.iteritems(), key=lambda item: item[1])
+        data = {'fast': reading + self._uris.items(), 'pipeline': pipeline_uris + self._pipeline_uris.items()}
+        tmp_path = path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def load(self, path, filter_func=None, start=True):
+        """Queue uris saved by save, skipping ones filter_func returns False for, return their number
+
+        If start is false, scanning isn't started, e.g. when the uris are
+        only loaded to be saved again.
+
+        """
+        try:
+            data = pickle.load(open(path, 'rb'))
+        except:
+            return 0
+        count = 0
+        if self._fast_path:
+            fast_queue = self._uris
+        else:
+            fast_queue = self._pipeline_uris
+        for key, queue in (('fast', fast_queue), ('pipeline', self._pipeline_uris)):
+            for uri, priority in data[key]:
+                if (uri in self._scanning or uri in self._reading
+                    or uri in self._uris or uri in self._pipeline_uris):
+                    continue
+                if filter_func is None or filter_func(uri):
+                    queue.push(uri, priority)
+                    count += 1
+        if start:
+            self._fast_scan()
+            self._next()
+            self._check_busy()
+        return count
+
+class _ScanPipeline(object):
+
     def __init__(self, callback):
-        self._uris = []
+        self.uri = None
+        self.start_time = None
         self._tags = {}
-        self._idle = True
         self._callback = callback
+        import gst
         self._player = gst.element_factory_make('playbin2')
         self._player.get_bus().add_watch(self._bus_watch_cb)
 
     def _bus_watch_cb(self, bus, message):
+        import gst
         if message.type == gst.MESSAGE_TAG:
             taglist = message.parse_tag()
             for key in taglist.keys():
@@ -52,28 +343,26 @@ class TagScanner(object):
         elif message.type == gst.MESSAGE_STATE_CHANGED:
             old, new, pending = message.parse_state_changed()
             if old == gst.STATE_READY and new == gst.STATE_PAUSED and pending == gst.STATE_PLAYING:
-                self._finish_current()
+                self._finish()
         elif message.type in (gst.MESSAGE_ERROR, gst.MESSAGE_EOS):
-            self._finish_current()
+            self._finish()
         return True
 
-    def _finish_current(self):
-        if self._tags:
-            self._callback(self._player.props.uri, self._tags)
-            self._tags = {}
-
+    def _finish(self):
+        if self.uri is None:
+            # already finished, e.g. error message after state change
+            return
+        uri, tags = self.uri, self._tags
+        self.uri = None
+        self._tags = {}
+        import gst
         self._player.set_state(gst.STATE_NULL)
-        if self._uris:
-            self._next()
-        else:
-            self._idle = True
+        self._callback(self, uri, tags)
 
-    def _next(self):
-        self._player.props.uri = self._uris.pop(0)
+    def start(self, uri, location=None):
+        """Scan uri, loading it from location uri if given"""
+        self.uri = uri
+        self.start_time = stats.enabled and time.time() or None
+        self._player.props.uri = location or uri
+        import gst
         self._player.set_state(gst.STATE_PLAYING)
-
-    def add(self, uris):
-        self._uris.extend(uris)
-        if self._idle:
-            self._idle = False
-            self._next()
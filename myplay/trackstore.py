@@ -0,0 +1,282 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Compact storage of playlist uris and their tags
+
+A big playlist is mostly made of long uris sharing a few directory prefixes
+and of tags repeating the same artist and album names, so instead of keeping
+a string per uri and a dict per track, tracks are numbered and stored in
+columns: the uri as an index into a table of directory prefixes plus the
+file name, and the tags as one list of values per tag with artist and album
+values deduplicated. Other per-track data, like the search index or the sort
+keys, is kept in lists and arrays indexed by track id as well. See
+benchmarks/memory.py for the difference.
+
+"""
+import bisect
+from array import array
+
+from myplay.tagreader import TAGS, TAG_ARTIST, TAG_ALBUM
+
+# values of these tags repeat a lot, so they are shared between tracks
+SHARED_TAGS = (TAG_ARTIST, TAG_ALBUM)
+
+def split_uri(uri):
+    """Return (directory prefix, file name) of uri"""
+    i = uri.rfind('/') + 1
+    return uri[:i], uri[i:]
+
+class TrackStore(object):
+    """Table of reference-counted tracks with integer ids
+
+    A track is added by the first "ref" of its uri and removed by the last
+    "unref", then its id is reused. Tags and file stat of a removed track
+    can still be read until that, e.g. to keep them in the tag cache.
+    Looking up a uri is a dict lookup of its directory and a binary search
+    among the file names of that directory, so there's no per-track dict
+    entry.
+
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._dir_ids = {}
+        self._dirs = []
+        # sorted file names of every directory and ids of their tracks
+        self._dir_names = []
+        self._dir_tracks = []
+        self._track_dirs = array('I')
+        self._track_names = []
+        self._refs = array('I')
+        self._has_tags = array('b')
+        self._tag_columns = [[] for tag in TAGS]
+        # modification time and size of the file tags were read from,
+        # -1 if they aren't known
+        self._mtimes = array('d')
+        self._sizes = array('d')
+        self._shared = [tag in SHARED_TAGS and {} or None for tag in TAGS]
+        self._free = []
+
+    def __len__(self):
+        return len(self._track_names) - len(self._free)
+
+    def id(self, uri):
+        """Return id of uri or None if it isn't in the store"""
+        prefix, name = split_uri(uri)
+        dir_id = self._dir_ids.get(prefix)
+        if dir_id is None:
+            return None
+        names = self._dir_names[dir_id]
+        i = bisect.bisect_left(names, name)
+        if i < len(names) and names[i] == name:
+            return self._dir_tracks[dir_id][i]
+        return None
+
+    def uri(self, track_id):
+        return self._dirs[self._track_dirs[track_id]] + self._track_names[track_id]
+
+    def ids(self):
+        """Return list of ids of all tracks"""
+        return [track_id for track_id, name in enumerate(self._track_names) if name is not None]
+
+    def dir_uris(self, prefix):
+        """Return uris of tracks in directory with given uri prefix"""
+        dir_id = self._dir_ids.get(prefix)
+        if dir_id is None:
+            return []
+        return [prefix + name for name in self._dir_names[dir_id]]
+
+    def refs(self, track_id):
+        return self._refs[track_id]
+
+    def ref(self, uri):
+        """Return id of uri, adding it if needed, and increase its reference count"""
+        return self.ref_all((uri, ))[0]
+
+    def ref_all(self, uris):
+        """Return array of ids of uris, like calling "ref" for each of them"""
+        result = array('I')
+        refs = self._refs
+        track_dirs = self._track_dirs
+        track_names = self._track_names
+        dir_ids = self._dir_ids
+        prefix = dir_id = names = tracks = None
+        for uri in uris:
+            i = uri.rfind('/') + 1
+            # uris usually come in groups from the same directory
+            if uri[:i] != prefix:
+                prefix = uri[:i]
+                dir_id = dir_ids.get(prefix)
+                if dir_id is None:
+                    dir_id = dir_ids[prefix] = len(self._dirs)
+                    self._dirs.append(prefix)
+                    self._dir_names.append([])
+                    self._dir_tracks.append(array('I'))
+                names = self._dir_names[dir_id]
+                tracks = self._dir_tracks[dir_id]
+            name = uri[i:]
+            if not names or name > names[-1]:
+                # files are usually added in sorted order
+                if self._free:
+                    track_id = self._new_track(dir_id, name)
+                else:
+                    track_id = len(track_names)
+                    track_dirs.append(dir_id)
+                    track_names.append(name)
+                    refs.append(0)
+                names.append(name)
+                tracks.append(track_id)
+            else:
+                i = bisect.bisect_left(names, name)
+                if names[i] == name:
+                    track_id = tracks[i]
+                else:
+                    track_id = self._new_track(dir_id, name)
+                    names.insert(i, name)
+                    tracks.insert(i, track_id)
+            refs[track_id] += 1
+            result.append(track_id)
+        return result
+
+    def _new_track(self, dir_id, name):
+        if self._free:
+            track_id = self._free.pop()
+            self._track_dirs[track_id] = dir_id
+            self._track_names[track_id] = name
+            # forget data of the removed track
+            if track_id < len(self._has_tags):
+                self._has_tags[track_id] = 0
+                for column in self._tag_columns:
+                    column[track_id] = None
+            if track_id < len(self._mtimes):
+                self._mtimes[track_id] = -1
+            return track_id
+        # tag columns are grown when tags are set
+        self._track_dirs.append(dir_id)
+        self._track_names.append(name)
+        self._refs.append(0)
+        return len(self._track_names) - 1
+
+    def unref(self, track_id):
+        """Decrease reference count of track, return True if it was removed"""
+        refs = self._refs[track_id] - 1
+        self._refs[track_id] = refs
+        if refs:
+            return False
+        dir_id = self._track_dirs[track_id]
+        names = self._dir_names[dir_id]
+        i = bisect.bisect_left(names, self._track_names[track_id])
+        del names[i]
+        del self._dir_tracks[dir_id][i]
+        self._track_names[track_id] = None
+        self._free.append(track_id)
+        return True
+
+    def get_tags(self, track_id):
+        """Return tags dict of track or None if it has no tags set"""
+        if track_id >= len(self._has_tags) or not self._has_tags[track_id]:
+            return None
+        tags = {}
+        for tag, column in zip(TAGS, self._tag_columns):
+            value = column[track_id]
+            if value is not None:
+                tags[tag] = value
+        return tags
+
+    def tag_values(self, track_id):
+        """Return tuple of tag values of track in the order of TAGS, None for missing ones"""
+        if track_id >= len(self._has_tags) or not self._has_tags[track_id]:
+            return (None, ) * len(TAGS)
+        return tuple([column[track_id] for column in self._tag_columns])
+
+    def tag_value(self, track_id, tag_index):
+        """Return value of TAGS[tag_index] of track or None"""
+        if track_id >= len(self._has_tags) or not self._has_tags[track_id]:
+            return None
+        return self._tag_columns[tag_index][track_id]
+
+    def set_tags(self, track_id, tags):
+        self.set_tag_values(track_id, [tags.get(tag) for tag in TAGS])
+
+    def set_tag_values(self, track_id, values):
+        """Set tags of track from a sequence of values in the order of TAGS"""
+        missing = track_id + 1 - len(self._has_tags)
+        if missing > 0:
+            self._has_tags.extend([0] * missing)
+            for column in self._tag_columns:
+                column.extend([None] * missing)
+        self._has_tags[track_id] = 1
+        for value, column, shared in zip(values, self._tag_columns, self._shared):
+            if value is not None and shared is not None:
+                value = shared.setdefault(value, value)
+            column[track_id] = value
+
+    def file_stat(self, track_id):
+        """Return (mtime, size) of the file tags of track were read from or None"""
+        if track_id >= len(self._mtimes) or self._mtimes[track_id] < 0:
+            return None
+        return self._mtimes[track_id], int(self._sizes[track_id])
+
+    def set_file_stat(self, track_id, stat):
+        """Set (mtime, size) of the file tags of track were read from, None if it's unknown"""
+        missing = track_id + 1 - len(self._mtimes)
+        if missing > 0:
+            self._mtimes.extend([-1] * missing)
+            self._sizes.extend([-1] * missing)
+        if stat is None:
+            self._mtimes[track_id] = -1
+        else:
+            self._mtimes[track_id], self._sizes[track_id] = stat
+
+class TagMap(object):
+    """Dict-like view of tags of tracks in a TrackStore, keyed by uri
+
+    Only tracks in the store can have tags, setting tags of other uris is
+    ignored. Returned dicts are new objects, changing them doesn't change
+    the store.
+
+    """
+
+    def __init__(self, store):
+        self._store = store
+
+    def __contains__(self, uri):
+        track_id = self._store.id(uri)
+        return track_id is not None and self._store.get_tags(track_id) is not None
+
+    def get(self, uri, default=None):
+        track_id = self._store.id(uri)
+        if track_id is None:
+            return default
+        tags = self._store.get_tags(track_id)
+        if tags is None:
+            return default
+        return tags
+
+    def __getitem__(self, uri):
+        tags = self.get(uri)
+        if tags is None:
+            raise KeyError(uri)
+        return tags
+
+    def __setitem__(self, uri, tags):
+        track_id = self._store.id(uri)
+        if track_id is not None:
+            self._store.set_tags(track_id, tags)
@@ -46,7 +46,8 @@ setup(
     entry_points={
         'console_scripts': [
             'myplay = myplay.gui:main',
-            'myplay-service = myplay.service:main'
+            'myplay-service = myplay.service:main',
+            'myplay-cli = myplay.cli:main',
         ]
     },
     include_package_data=True,
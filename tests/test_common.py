@@ -0,0 +1,42 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+
+from myplay.common import utf8_tracks
+
+class String(unicode):
+    """Stand-in for dbus.String, a unicode subclass"""
+
+class Utf8TracksTests(unittest.TestCase):
+
+    def test_non_ascii(self):
+        uri = String(u'file:///music/Bj\xf6rk/J\xf3ga.ogg')
+        tags = {String(u'artist'): String(u'Bj\xf6rk'), String(u'title'): String(u'J\xf3ga')}
+        result = utf8_tracks([(uri, tags)])
+        self.assertEqual(result, [('file:///music/Bj\xc3\xb6rk/J\xc3\xb3ga.ogg',
+                                   {'artist': 'Bj\xc3\xb6rk', 'title': 'J\xc3\xb3ga'})])
+        uri, tags = result[0]
+        self.assertTrue(type(uri) is str)
+        self.assertTrue(all(type(k) is str and type(v) is str for k, v in tags.iteritems()))
+
+    def test_str(self):
+        self.assertEqual(utf8_tracks([('file:///a.ogg', {})]), [('file:///a.ogg', {})])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#
+# This file is part of MyPlay.
+#
+# Copyright 2010 Dan Korostelev <nadako@gmail.com>
+#
+# MyPlay is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MyPlay is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MyPlay.  If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+
+from myplay.common import CURRENT_UNSET
+from myplay.playorder import PlayOrder, position_after_insert, position_after_remove
+
+class PositionTests(unittest.TestCase):
+
+    def test_insert_before(self):
+        self.assertEqual(position_after_insert(4, 0, 2), 6)
+
+    def test_insert_at(self):
+        self.assertEqual(position_after_insert(4, 4, 1), 5)
+
+    def test_insert_after(self):
+        self.assertEqual(position_after_insert(4, 5, 3), 4)
+
+    def test_remove_before(self):
+        # Add 5 uris, SetCurrent(4), Remove([0]) left current past the end
+        self.assertEqual(position_after_remove(4, [0]), 3)
+        self.assertEqual(position_after_remove(4, [0, 2, 3]), 1)
+
+    def test_remove_current(self):
+        self.assertEqual(position_after_remove(4, [4]), None)
+        self.assertEqual(position_after_remove(4, [1, 4]), None)
+
+    def test_remove_after(self):
+        self.assertEqual(position_after_remove(2, [3, 4]), 2)
+
+class QueueTests(unittest.TestCase):
+
+    def test_remove_renumbers_queue(self):
+        order = PlayOrder()
+        order.enqueue([4, 1, 2])
+        self.assertTrue(order.remove([0, 1], 5))
+        self.assertEqual(order.queue, [2, 0])
+
+    def test_insert_renumbers_queue(self):
+        order = PlayOrder()
+        order.enqueue([4, 1])
+        self.assertTrue(order.insert(2, 3, CURRENT_UNSET))
+        self.assertEqual(order.queue, [7, 1])
+
+    def test_shuffled_insert_after_current(self):
+        order = PlayOrder()
+        order.set_shuffle(True, 5, 4)
+        # the current entry moved from 4 to 6, new entries are played after it
+        order.insert(0, 2, 6)
+        played = []
+        position = order.next(6, 7)
+        while position != CURRENT_UNSET:
+            played.append(position)
+            position = order.next(position, 7)
+        self.assertEqual(sorted(played), [0, 1, 2, 3, 4, 5])
+
+if __name__ == '__main__':
+    unittest.main()